@@ -0,0 +1,81 @@
+"""
+Insert throughput and index footprint of prompt-shaped rows keyed two ways:
+
+  before: random uuid4 hex in a VARCHAR(255) unique index
+  after:  time-ordered UUIDv7 (core.make_guid) in a BINARY(16) unique index
+
+Each variant fills its own scratch table with the same number of rows, in multi-row inserts of
+--batch rows per transaction, and reports rows per second, the buffer pool page reads the
+inserts caused (pages that had to come from disk) and the resulting index size. The scratch
+tables are dropped afterwards. Needs the database from .env; run it on an otherwise idle server,
+with more rows than fit in the buffer pool to see the locality difference in page reads.
+
+    python -m benchmarks.guid_inserts [--rows 200000] [--batch 1000]
+"""
+import argparse
+import time
+import uuid
+
+from core import make_guid, guid_to_bytes
+from data import DatabaseContext
+
+VARIANTS = {
+    'before': ("VARCHAR(255)", lambda: uuid.uuid4().hex),
+    'after': ("BINARY(16)", lambda: guid_to_bytes(make_guid())),
+}
+
+
+def buffer_pool_reads(db) -> int:
+    db.cursor.execute("SHOW GLOBAL STATUS LIKE 'Innodb_buffer_pool_reads'")
+    return int(db.cursor.fetchone()['Value'])
+
+
+def run(name: str, rows: int, batch: int) -> None:
+    column_type, next_guid = VARIANTS[name]
+    table = f"bench_guid_{name}"
+    with DatabaseContext() as db:
+        db.cursor.execute(f"""
+            CREATE TABLE {table} (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                guid {column_type} NOT NULL,
+                author_id INT,
+                content TEXT NOT NULL,
+                UNIQUE INDEX {table}_U1 (guid),
+                INDEX {table}_I1 (author_id, id, guid)
+            )""")
+        try:
+            reads, start = buffer_pool_reads(db), time.perf_counter()
+            for offset in range(0, rows, batch):
+                db.begin_transaction()
+                db.cursor.executemany(f"INSERT INTO {table} (guid, author_id, content) VALUES (%s, %s, %s)",
+                                      [(next_guid(), i % 100 or None, f"Prompt {i}")
+                                       for i in range(offset, min(offset + batch, rows))])
+                db.commit_transaction()
+            elapsed = time.perf_counter() - start
+            reads = buffer_pool_reads(db) - reads
+
+            db.cursor.execute(f"ANALYZE TABLE {table}")
+            db.cursor.fetchall()
+            db.cursor.execute("""
+                SELECT index_length AS index_length FROM information_schema.tables
+                WHERE table_schema = DATABASE() AND table_name = %s
+            """, (table,))
+            index_mb = db.cursor.fetchone()['index_length'] / 2 ** 20
+        finally:
+            db.cursor.execute(f"DROP TABLE {table}")
+    print(f"{name}: {column_type:<12} {rows / elapsed:,.0f} rows/s, {reads:,} pages read from disk, "
+          f"secondary indexes {index_mb:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--batch', type=int, default=1000)
+    args = parser.parse_args()
+
+    for name in VARIANTS:
+        run(name, args.rows, args.batch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Requests per second, on one core, for a 100-prompt list page rendered two ways:
+
+  before: validated Prompt(...) construction and response_model=List[Prompt]
+  after:  construct_trusted(Prompt, ...) and PromptListResponse
+
+The app is driven in-process through ASGI with the database left out, so the numbers measure
+model construction, response validation and JSON rendering, the part this path changes.
+
+    python -m benchmarks.list_responses [--page-size 100] [--seconds 5]
+"""
+import argparse
+import asyncio
+import functools
+import time
+from datetime import datetime
+from typing import List
+
+from fastapi import FastAPI
+
+from core.models import Prompt, Variable, construct_trusted
+from web.responses import PromptListResponse
+
+
+def make_rows(count: int) -> List[dict]:
+    now = datetime(2023, 10, 1, 12, 0, 0, 123456)
+    return [{'guid': f'{i:032x}', 'id': i, 'author_id': 7, 'classification_name': 'coding',
+             'content': f'Explain {{topic}} to a {{audience}} in {{length}} words. Prompt {i}. ' * 8,
+             'created_at': now, 'updated_at': now,
+             'variables': [{'name': name, 'description': f'the {name}', 'type': kind, 'expected_format': 'text/plain'}
+                           for name, kind in (('topic', 'input'), ('audience', 'input'), ('answer', 'output'))],
+             'tags': ['python', 'teaching', 'explain']} for i in range(count)]
+
+
+def build(rows: List[dict], trusted: bool) -> List[Prompt]:
+    prompt_type = functools.partial(construct_trusted, Prompt) if trusted else Prompt
+    variable_type = functools.partial(construct_trusted, Variable) if trusted else Variable
+    prompts = []
+    for row in rows:
+        variables = [variable_type(**var) for var in row['variables']]
+        prompts.append(prompt_type(guid=row['guid'], id=row['id'], content=row['content'],
+                                   input_variables=[v for v in variables if v.type == 'input'],
+                                   output_variables=[v for v in variables if v.type == 'output'],
+                                   tags=row['tags'], classification=row['classification_name'],
+                                   author=row['author_id'], created_at=row['created_at'],
+                                   updated_at=row['updated_at']))
+    return prompts
+
+
+def make_app(rows: List[dict]) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/before", response_model=List[Prompt])
+    async def before():
+        return build(rows, trusted=False)
+
+    @app.get("/after", response_model=List[Prompt])
+    async def after():
+        return PromptListResponse(build(rows, trusted=True))
+
+    return app
+
+
+async def call(app, path: str) -> bytes:
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+             'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+             'root_path': '', 'headers': [(b'host', b'bench')], 'client': ('127.0.0.1', 1),
+             'server': ('bench', 80)}
+    body = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.body':
+            body.append(message.get('body', b''))
+
+    await app(scope, receive, send)
+    return b''.join(body)
+
+
+async def measure(app, path: str, seconds: float) -> float:
+    for _ in range(20):
+        await call(app, path)
+    count, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        await call(app, path)
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+
+    app = make_app(make_rows(args.page_size))
+    before = asyncio.run(measure(app, '/before', args.seconds))
+    after = asyncio.run(measure(app, '/after', args.seconds))
+    print(f"page size {args.page_size}: before {before:.0f} req/s, after {after:.0f} req/s, "
+          f"{after / before:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import argparse
+import contextlib
+import sys
+
+from data.prompt_repository import MySQLPromptRepository
+from service.catalog_service import CatalogService, CATALOG_FORMATS
+from service.documents import backfill_documents, backfill_hashes, backfill_stats, backfill_usage, \
+    check_documents
+from service.sharding import abort_move, move_author, pin_authors, plan_rebalance, resume_move
+from service.tracing import run_collector
+
+
+def export_catalog(args):
+    service = CatalogService(MySQLPromptRepository())
+    with (open(args.output, 'wb') if args.output != '-' else contextlib.nullcontext(sys.stdout.buffer)) as out:
+        for chunk in service.export_prompts(args.format, all_scopes=(args.scope == 'all')):
+            out.write(chunk)
+
+
+def import_catalog(args):
+    service = CatalogService(MySQLPromptRepository())
+    with open(args.input, 'rb') as source:
+        result = service.import_prompts(source, args.format)
+    print(f"imported={result.imported} skipped={result.skipped}")
+
+
+def backfill(args):
+    batches = backfill_documents(MySQLPromptRepository(), only_missing=args.missing)
+    print(f"batches={batches}")
+
+
+def backfill_prompt_stats(args):
+    batches = backfill_stats(MySQLPromptRepository(), only_missing=args.missing)
+    print(f"batches={batches}")
+
+
+def backfill_content_hashes(args):
+    batches = backfill_hashes(MySQLPromptRepository(), only_missing=args.missing)
+    print(f"batches={batches}")
+
+
+def backfill_usage_rows(args):
+    batches = backfill_usage(MySQLPromptRepository())
+    print(f"batches={batches}")
+
+
+def check(args):
+    missing, stale = check_documents(MySQLPromptRepository())
+    for guid in missing:
+        print(f"missing {guid}")
+    for guid in stale:
+        print(f"stale {guid}")
+    print(f"missing={len(missing)} stale={len(stale)}")
+    if missing or stale:
+        sys.exit(1)
+
+
+def rebalance(args):
+    repo = MySQLPromptRepository()
+    if args.pin:
+        print(f"pinned={pin_authors(repo)}")
+        return
+    if args.resume is not None:
+        move = resume_move(repo, args.resume)
+        print(f"moved author={move.author_id} {move.source}->{move.target} prompts={move.prompts}")
+        return
+    if args.abort is not None:
+        move = abort_move(repo, args.abort)
+        print(f"aborted author={move.author_id} {move.source}->{move.target}")
+        return
+    if args.author is not None:
+        if args.to is None:
+            sys.exit("--author needs --to")
+        move = move_author(repo, args.author, args.to)
+        print(f"moved author={move.author_id} {move.source}->{move.target} prompts={move.prompts}")
+        return
+    moves = plan_rebalance(args.limit)
+    for move in moves:
+        if args.dry_run:
+            print(f"would move author={move.author_id} {move.source}->{move.target}")
+            continue
+        move = move_author(repo, move.author_id, move.target)
+        print(f"moved author={move.author_id} {move.source}->{move.target} prompts={move.prompts}")
+    print(f"moves={len(moves)}")
+
+
+def trace_collector(args):
+    print(f"collecting traces on http://localhost:{args.port}/v1/traces into {args.output}")
+    run_collector(args.port, args.output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="codepromptu maintenance commands")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help="Stream the prompt catalog to a file")
+    export_parser.add_argument('--format', choices=CATALOG_FORMATS, default='ndjson')
+    export_parser.add_argument('--scope', choices=('all', 'public'), default='all')
+    export_parser.add_argument('--output', default='-', help="Output file, '-' for stdout")
+    export_parser.set_defaults(handler=export_catalog)
+
+    import_parser = commands.add_parser('import', help="Load a catalog export into the database")
+    import_parser.add_argument('--format', choices=CATALOG_FORMATS, default='ndjson')
+    import_parser.add_argument('--input', required=True)
+    import_parser.set_defaults(handler=import_catalog)
+
+    backfill_parser = commands.add_parser('backfill-documents', help="Rebuild the prompts' document column")
+    backfill_parser.add_argument('--missing', action='store_true', help="Only prompts without a document")
+    backfill_parser.set_defaults(handler=backfill)
+
+    stats_parser = commands.add_parser('backfill-stats',
+                                       help="Recompute the prompts' character, token and variable counts")
+    stats_parser.add_argument('--missing', action='store_true', help="Only prompts without counts")
+    stats_parser.set_defaults(handler=backfill_prompt_stats)
+
+    hashes_parser = commands.add_parser('backfill-hashes',
+                                        help="Recompute the prompts' normalized content hashes")
+    hashes_parser.add_argument('--missing', action='store_true', help="Only prompts without a hash")
+    hashes_parser.set_defaults(handler=backfill_content_hashes)
+
+    usage_parser = commands.add_parser('backfill-usage',
+                                       help="Add the prompt_usage rows that sort=popular needs to list a prompt")
+    usage_parser.set_defaults(handler=backfill_usage_rows)
+
+    check_parser = commands.add_parser('check-documents',
+                                       help="Report prompts whose document is missing or out of date")
+    check_parser.set_defaults(handler=check)
+
+    rebalance_parser = commands.add_parser('rebalance',
+                                           help="Move authors to the shard the hash ring places them on")
+    rebalance_parser.add_argument('--pin', action='store_true',
+                                  help="Only pin unplaced authors to the shard holding their prompts")
+    rebalance_parser.add_argument('--dry-run', action='store_true', help="List the moves without making them")
+    rebalance_parser.add_argument('--author', type=int, help="Move this author only, to --to")
+    rebalance_parser.add_argument('--to', type=int, help="Target shard of --author")
+    rebalance_parser.add_argument('--limit', type=int, help="Move at most this many authors")
+    rebalance_parser.add_argument('--resume', type=int, metavar='AUTHOR', help="Finish an interrupted move")
+    rebalance_parser.add_argument('--abort', type=int, metavar='AUTHOR',
+                                  help="Roll back an interrupted move that has not reached the directory")
+    rebalance_parser.set_defaults(handler=rebalance)
+
+    collector_parser = commands.add_parser('trace-collector',
+                                           help="Receive OTLP/HTTP JSON trace exports into a file, for development")
+    collector_parser.add_argument('--port', type=int, default=4318)
+    collector_parser.add_argument('--output', default='traces.jsonl')
+    collector_parser.set_defaults(handler=trace_collector)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
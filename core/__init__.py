@@ -1,6 +1,57 @@
-import uuid
+import hashlib
+import os
+import time
+import unicodedata
+from typing import Optional
 
 
 def make_guid() -> str:
-    guid = str(uuid.uuid4()).replace("-", "")
-    return guid
+    """
+    Make a UUIDv7 as 32 hex digits: a 48-bit millisecond timestamp, then version, variant and
+    random bits. Guids made later sort later, so new rows land at the right-hand edge of the
+    BINARY(16) unique indexes instead of at random pages.
+    """
+    value = bytearray((time.time_ns() // 1_000_000).to_bytes(6, 'big') + os.urandom(10))
+    value[6] = 0x70 | (value[6] & 0x0F)  # Version 7
+    value[8] = 0x80 | (value[8] & 0x3F)  # RFC 4122 variant
+    return value.hex()
+
+
+def guid_to_bytes(guid: Optional[str]) -> Optional[bytes]:
+    """
+    The 16 bytes stored for a guid given at the API, or None if it is not one. Both UUIDv7 and
+    the older uuid4 guids are 32 hex digits; the dashed form is accepted too.
+    """
+    if guid is None:
+        return None
+    try:
+        value = bytes.fromhex(guid.replace('-', ''))
+    except ValueError:
+        return None
+    return value if len(value) == 16 else None
+
+
+def guid_from_bytes(value: Optional[bytes]) -> Optional[str]:
+    """The API form of a stored guid."""
+    return value.hex() if value is not None else None
+
+
+def normalize_guid(guid: str) -> str:
+    """
+    The API form of a guid given in any form guid_to_bytes accepts, so that in-process keys (indexes,
+    usage counts, events) match the stored guid; a string that is not a guid is returned as it is.
+    """
+    value = guid_to_bytes(guid)
+    return guid_from_bytes(value) if value is not None else guid
+
+
+def make_content_hash(content: str) -> str:
+    """
+    Hash prompt content for exact duplicate detection.
+
+    The content is normalized first (Unicode NFC, LF line endings, no trailing whitespace
+    on lines or around the text) so that copies differing only in those details collide.
+    """
+    normalized = unicodedata.normalize("NFC", content).replace("\r\n", "\n").replace("\r", "\n")
+    normalized = "\n".join(line.rstrip() for line in normalized.split("\n")).strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
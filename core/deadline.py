@@ -0,0 +1,71 @@
+import contextvars
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from core.exceptions import DeadlineExceededError
+
+
+class Deadline:
+    """
+    The time by which the current request must finish, and whether its client has gone away.
+
+    Work checks the deadline before each statement; cancel hooks registered for in-flight
+    statements are run when the client disconnects, so those statements stop on the server too.
+    """
+
+    def __init__(self, timeout: Optional[float] = None, explicit: bool = False):
+        self.expires_at = None if timeout is None else time.monotonic() + timeout
+        self.explicit = explicit  # Set by the client; per-route defaults do not override it
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.cancel_hooks: Dict[int, Callable[[], None]] = {}
+
+    def apply_default(self, timeout: Optional[float]) -> None:
+        if not self.explicit:
+            self.expires_at = None if timeout is None else time.monotonic() + timeout
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left, or None when there is no time limit."""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.cancelled or self.remaining() == 0.0
+
+    def check(self) -> None:
+        if self.cancelled:
+            raise DeadlineExceededError("The client disconnected before the request completed.")
+        if self.remaining() == 0.0:
+            raise DeadlineExceededError()
+
+    def add_cancel_hook(self, key: int, hook: Callable[[], None]) -> None:
+        with self.lock:
+            self.cancel_hooks[key] = hook
+
+    def remove_cancel_hook(self, key: int) -> None:
+        with self.lock:
+            self.cancel_hooks.pop(key, None)
+
+    def cancel(self) -> None:
+        with self.lock:
+            self.cancelled = True
+            hooks = list(self.cancel_hooks.values())
+        for hook in hooks:
+            hook()
+
+
+_current_deadline: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar('deadline', default=None)
+
+
+def set_deadline(deadline: Optional[Deadline]) -> contextvars.Token:
+    return _current_deadline.set(deadline)
+
+
+def reset_deadline(token: contextvars.Token) -> None:
+    _current_deadline.reset(token)
+
+
+def get_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
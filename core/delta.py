@@ -0,0 +1,46 @@
+import difflib
+import json
+import os
+from typing import List
+
+
+def make_delta(old: str, new: str) -> str:
+    """
+    Encode `new` as a compact delta against `old`.
+
+    The delta is a JSON list of operations: a two-element list `[start, end]` copies
+    `old[start:end]`, a string is inserted verbatim. Its size grows with the edit,
+    not with the length of the text.
+    """
+    # Edits are usually local, so only diff the region between the common prefix and suffix
+    prefix = len(os.path.commonprefix([old, new]))
+    max_suffix = min(len(old), len(new)) - prefix
+    suffix = 0
+    while suffix < max_suffix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    old_mid = old[prefix:len(old) - suffix]
+    new_mid = new[prefix:len(new) - suffix]
+
+    ops = []
+    if prefix:
+        ops.append([0, prefix])
+    matcher = difflib.SequenceMatcher(None, old_mid, new_mid, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([prefix + i1, prefix + i2])
+        elif j2 > j1:
+            ops.append(new_mid[j1:j2])
+    if suffix:
+        ops.append([len(old) - suffix, len(old)])
+    return json.dumps(ops, separators=(',', ':'), ensure_ascii=False)
+
+
+def apply_delta(old: str, delta: str) -> str:
+    """Rebuild the text encoded by `delta` from the text it was computed against."""
+    parts: List[str] = []
+    for op in json.loads(delta):
+        if isinstance(op, str):
+            parts.append(op)
+        else:
+            parts.append(old[op[0]:op[1]])
+    return ''.join(parts)
@@ -54,6 +54,34 @@ class AuthenticationError(PromptException):
     def __init__(self, message="Authentication failed."):
         super().__init__(message)
 
+
+class RateLimitExceededError(PromptException):
+    def __init__(self, message="Too many requests.", retry_after: int = 1):
+        self.retry_after = retry_after  # Seconds, sent back as the Retry-After header
+        super().__init__(message)
+
+
+class DeadlineExceededError(PromptException):
+    def __init__(self, message="The request did not complete within its deadline."):
+        super().__init__(message)
+
+
+class ServiceUnavailableError(PromptException):
+    def __init__(self, message="The service is temporarily overloaded.", retry_after: int = 1):
+        self.retry_after = retry_after
+        super().__init__(message)
+
+
+class TransactionConflictError(ServiceUnavailableError):
+    def __init__(self, message="The write kept conflicting with concurrent ones; please retry.", retry_after: int = 1):
+        super().__init__(message, retry_after)
+
+
+class CursorExpiredError(PromptException):
+    def __init__(self, message="The cursor is older than the retained change log; re-list and start again."):
+        super().__init__(message)
+
+
 EXCEPTION_STATUS_CODES = {
     DataValidationError: 400,       # Bad Request
     ConstraintViolationError: 409,  # Conflict
@@ -65,4 +93,20 @@ EXCEPTION_STATUS_CODES = {
     BadRequestError: 400,           # Bad Request
     EndpointNotFoundError: 404,     # Not Found
     AuthenticationError: 401,       # Unauthorized
+    RateLimitExceededError: 429,    # Too Many Requests
+    ServiceUnavailableError: 503,   # Service Unavailable
+    TransactionConflictError: 503,  # Service Unavailable
+    DeadlineExceededError: 504,     # Gateway Timeout
+    CursorExpiredError: 410,        # Gone
 }
+
+
+def find_in_chain(exc: BaseException, exc_type):
+    """Return the first exception of exc_type among exc and the exceptions it was raised from, or None."""
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        if isinstance(exc, exc_type):
+            return exc
+        seen.add(id(exc))
+        exc = exc.__cause__ or exc.__context__
+    return None
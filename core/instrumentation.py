@@ -0,0 +1,118 @@
+"""
+Hooks marking the layers a request passes through: the middleware stack, auth, services,
+repositories and response serialization.
+
+Code marks a stretch of work with `span(layer, name)`, and the dependency factories wrap the
+objects they hand out with `instrument(obj, layer)`, which times each public method call.
+Observers attached to a request context with `attach` receive the start and end of every span
+in that context, across the threads the request runs on. While no observer is attached
+anywhere in the process, `span` returns a shared no-op and `instrument` returns the object
+itself, so unobserved requests run exactly the code they would without the hooks.
+"""
+import contextvars
+import functools
+import threading
+from typing import Optional, Tuple
+
+# Layers whose spans stay open across awaits; observers that follow a thread skip them
+ASYNC_LAYERS = ('request', 'app')
+
+
+class Observer:
+    """Receives the spans of the requests it is attached to. Called from any thread."""
+
+    def start(self, layer: str, name: str):
+        """Called when a span opens; the return value is handed back to `end`."""
+
+    def end(self, layer: str, name: str, handle, error: Optional[BaseException]) -> None:
+        pass
+
+
+_observers: contextvars.ContextVar[Tuple[Observer, ...]] = contextvars.ContextVar('observers', default=())
+_attached = 0  # Observers attached anywhere in the process; the hooks do nothing while it is 0
+_attached_lock = threading.Lock()
+
+
+def attach(observer: Observer) -> contextvars.Token:
+    """Attach an observer to the current context and the work it spawns; undo with `detach`."""
+    global _attached
+    with _attached_lock:
+        _attached += 1
+    return _observers.set(_observers.get() + (observer,))
+
+
+def detach(token: contextvars.Token) -> None:
+    global _attached
+    _observers.reset(token)
+    with _attached_lock:
+        _attached -= 1
+
+
+def observers() -> Tuple[Observer, ...]:
+    return _observers.get() if _attached else ()
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ('observers', 'layer', 'name', 'handles')
+
+    def __init__(self, current: Tuple[Observer, ...], layer: str, name: str):
+        self.observers = current
+        self.layer = layer
+        self.name = name
+
+    def __enter__(self):
+        self.handles = [observer.start(self.layer, self.name) for observer in self.observers]
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for observer, handle in zip(reversed(self.observers), reversed(self.handles)):
+            observer.end(self.layer, self.name, handle, exc_val)
+        return False
+
+
+def span(layer: str, name: str = ''):
+    """A context manager marking `name` as work of `layer` for the observers of this context."""
+    if not _attached:
+        return _NO_SPAN
+    current = _observers.get()
+    return _Span(current, layer, name) if current else _NO_SPAN
+
+
+class _Instrumented:
+    """Wraps an object so each call of one of its public methods is a span of the layer."""
+
+    def __init__(self, target, layer: str):
+        self._target = target
+        self._layer = layer
+        self._prefix = type(target).__name__ + '.'
+
+    def __getattr__(self, name: str):
+        value = getattr(self._target, name)
+        if name.startswith('_') or not callable(value):
+            return value
+
+        @functools.wraps(value)
+        def call(*args, **kwargs):
+            with span(self._layer, self._prefix + name):
+                return value(*args, **kwargs)
+        return call
+
+
+def instrument(target, layer: str):
+    """The object, wrapped to time its method calls if the current request is being observed."""
+    if not _attached or not _observers.get():
+        return target
+    return _Instrumented(target, layer)
@@ -1,6 +1,8 @@
 from pydantic import BaseModel
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional, Type, TypeVar
+
+M = TypeVar('M', bound=BaseModel)
 
 
 class Variable(BaseModel):
@@ -25,6 +27,205 @@ class Prompt(PromptUpdate):
     author: Optional[int]  # Could be a public prompt, no author
     created_at: datetime
     updated_at: Optional[datetime]  # It's optional since it'll be updated by the service
+    char_count: Optional[int] = None  # Length statistics, stored at write time; None until backfilled
+    token_count: Optional[int] = None  # Approximate
+    input_variable_count: Optional[int] = None
+    output_variable_count: Optional[int] = None
+
+
+class PromptRecord(PromptCreate):
+    """A prompt as written by catalog export and read back by import."""
+    guid: str
+    author: Optional[int] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+
+class ImportResult(BaseModel):
+    imported: int
+    skipped: int  # Prompts whose guid already exists
+
+
+class TagRename(BaseModel):
+    old_name: str
+    new_name: str
+
+
+class TagMerge(BaseModel):
+    source: str  # Removed once its prompts are tagged with the target
+    target: str  # Created if it does not exist
+
+
+class TagRetag(BaseModel):
+    """Add and remove tags on every prompt matching all of the given filters."""
+    add: List[str] = []
+    remove: List[str] = []
+    tags: Optional[List[str]] = None  # Prompts with any of these tags
+    classification: Optional[str] = None
+    query: Optional[str] = None  # Prompts whose content contains this text
+    scope: str = 'all'  # 'all' prompts or only 'public' ones
+
+
+class TagOperationResult(BaseModel):
+    affected_prompts: int
+
+
+class NameSuggestion(BaseModel):
+    name: str
+    kind: str  # 'tag' or 'classification'
+    score: float  # 1 for names starting with the prefix, trigram similarity of the beginning otherwise
+
+
+class ReplicaStats(BaseModel):
+    """The public catalog replica of the worker answering the request."""
+    enabled: bool
+    loaded: bool
+    prompts: int = 0
+    tags: int = 0
+    classifications: int = 0
+    memory_bytes: int = 0  # Estimated from the object sizes, counting shared strings once
+    bytes_per_10k_prompts: int = 0
+    built_at: Optional[datetime] = None
+    refreshes: int = 0  # Snapshots swapped in since the load
+
+
+class ShardStats(BaseModel):
+    shard: int
+    prompts: int
+    public: int  # Prompts without an author
+    authors: int
+    pinned_authors: int  # Authors the shard directory places on this shard
+
+
+class ShardMove(BaseModel):
+    author_id: int
+    source: int
+    target: int
+    prompts: int = 0  # Copied to the target, once moved
+
+
+class ProfileRequest(BaseModel):
+    """Which requests to profile: the next `count` matching the method (any when None) and path prefix."""
+    path: str = '/'
+    method: Optional[str] = None
+    count: int = 1
+    mode: str = 'sampling'  # 'sampling' stacks for flamegraphs, or 'deterministic' cProfile for pstats
+    header: bool = False  # Only requests sending the session id in an X-Profile header
+
+
+class ProfileSession(BaseModel):
+    id: str
+    method: Optional[str]
+    path: str
+    mode: str
+    remaining: int  # Requests still to be profiled
+    header: bool
+    created_at: datetime
+
+
+class ProfileSummary(BaseModel):
+    id: str
+    session_id: str
+    request_id: Optional[str]
+    method: str
+    path: str
+    status: int
+    mode: str
+    duration_ms: float
+    layers_ms: Dict[str, float]  # Inclusive: service time includes the repository calls it made
+    samples: int  # Stack samples taken, in sampling mode
+    created_at: datetime
+
+
+class PromptRevisionInfo(BaseModel):
+    revision: int
+    is_snapshot: bool
+    size: int  # Bytes stored for this revision: the full text for snapshots, the delta otherwise
+    created_at: datetime
+
+
+class PromptRevision(BaseModel):
+    guid: str
+    revision: int
+    content: str
+    created_at: datetime
+
+
+class PromptDiff(BaseModel):
+    guid: str
+    from_revision: int
+    to_revision: int
+    diff: str  # Unified diff of the two revisions' content
+
+
+class SimilarPrompt(BaseModel):
+    guid: str
+    score: float  # Estimated Jaccard similarity of the two prompts' word shingles
+
+
+class FacetCount(BaseModel):
+    name: str
+    count: int
+
+
+class PromptFacets(BaseModel):
+    tags: List[FacetCount]
+    classifications: List[FacetCount]
+
+
+class PromptFields(BaseModel):
+    """A prompt restricted to the fields requested with `?fields=`; unrequested fields are left unset."""
+    id: Optional[int] = None
+    guid: Optional[str] = None
+    content: Optional[str] = None
+    input_variables: Optional[List[Variable]] = None
+    output_variables: Optional[List[Variable]] = None
+    tags: Optional[List[str]] = None
+    classification: Optional[str] = None
+    author: Optional[int] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    char_count: Optional[int] = None
+    token_count: Optional[int] = None
+    input_variable_count: Optional[int] = None
+    output_variable_count: Optional[int] = None
+
+
+class PromptQueryOptions(BaseModel):
+    fields: Optional[List[str]] = None  # None returns every field
+    skip: int = 0
+    limit: Optional[int] = None
+    sort: str = 'id'  # 'id', 'popular' for the most used first, or 'tokens' or 'chars' for the shortest first
+    min_tokens: Optional[int] = None
+    max_tokens: Optional[int] = None
+
+
+class PromptChange(BaseModel):
+    seq: int  # Position in the change log; increases with every write
+    guid: str
+    author: Optional[int]
+    op: str  # 'create', 'update' or 'delete'
+    created_at: datetime
+    tag_renamed: bool = False  # Logged by a tag rename or merge
+    shard: int = 0  # Database whose change log the seq belongs to
+
+
+class PromptEvent(BaseModel):
+    """A prompt write as pushed to event stream subscribers; the seq is the SSE event id."""
+    seq: int
+    op: str  # 'create', 'update' or 'delete'
+    guid: str
+    author: Optional[int]
+    tags: Optional[List[str]] = None  # Not known for deletes
+    classification: Optional[str] = None
+
+
+class PromptChanges(BaseModel):
+    """One page of a delta sync: the current state of what changed after the cursor, and what was deleted."""
+    prompts: List[PromptFields]
+    deleted: List[str]  # Tombstones: guids of prompts deleted after the cursor
+    next_cursor: int  # Pass as `since` to fetch the next page
+    has_more: bool
 
 
 class User(BaseModel):
@@ -32,3 +233,27 @@ class User(BaseModel):
     guid: str
     username: str
     password: str
+
+
+_model_defaults: Dict[type, dict] = {}
+
+
+def construct_trusted(model: Type[M], **values) -> M:
+    """
+    Build a model from values that are known to be valid, such as rows read from our own schema,
+    without running pydantic validation. Cheaper than `model_construct`, which still walks every
+    field in Python. Fields missing from `values` take their defaults and are left unset.
+    """
+    defaults = _model_defaults.get(model)
+    if defaults is None:
+        defaults = _model_defaults[model] = {name: field.get_default() for name, field in model.model_fields.items()
+                                             if not field.is_required()}
+    instance = model.__new__(model)
+    fields_set = set(values)
+    if len(fields_set) < len(model.model_fields):
+        values = {**defaults, **values}
+    object.__setattr__(instance, '__dict__', values)
+    object.__setattr__(instance, '__pydantic_fields_set__', fields_set)
+    object.__setattr__(instance, '__pydantic_extra__', None)
+    object.__setattr__(instance, '__pydantic_private__', None)
+    return instance
@@ -0,0 +1,32 @@
+"""
+An offline approximation of BPE token counts, for budgeting rather than for encoding.
+
+Text is split the way cl100k-style tokenizers pre-tokenize it: words with their leading space,
+runs of up to three digits, punctuation runs, and whitespace. Each piece is then charged what
+such a vocabulary typically spends on it: one token per short ASCII word and one more per
+further WORD_CHARS letters, one per digit group, one per few punctuation marks, and one per
+character outside ASCII. The counts are estimates, close enough to budget with on English
+prose and code, and meant to err high rather than low on other scripts.
+"""
+import re
+
+WORD_CHARS = 6  # ASCII letters a vocabulary token covers, on average, in words longer than one token
+PUNCTUATION_CHARS = 3  # Punctuation marks per token in a run like '!==' or '```'
+
+_PIECES = re.compile(r"'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d{1,3}| ?(?:[^\s\w]|_)+|\s+", re.IGNORECASE)
+
+
+def _piece_tokens(piece: str) -> int:
+    text = piece.lstrip(' ') or piece
+    if not text.isascii():
+        return len(text)
+    if text[0].isalpha() or text[0] == "'":
+        return -(-len(text) // WORD_CHARS)
+    if text[0].isdigit() or text[0].isspace():
+        return 1
+    return -(-len(text) // PUNCTUATION_CHARS)
+
+
+def count_tokens(text: str) -> int:
+    """The approximate number of tokens in `text`."""
+    return sum(_piece_tokens(piece) for piece in _PIECES.findall(text))
@@ -1,9 +1,20 @@
 # data/init.py
 
+import mysql.connector
 from mysql.connector import pooling
+from mysql.connector.errors import PoolError
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import math
 import os
+import re
 import threading
+import traceback
+
+from core.deadline import Deadline, get_deadline
+from core.exceptions import DBConnectionError, DeadlineExceededError, ServiceUnavailableError, find_in_chain
+from core.instrumentation import observers, span
 
 load_dotenv()
 
@@ -18,18 +29,331 @@ config = {
 }
 
 
+def _shard_config(entry: str) -> dict:
+    """A shard's connection settings from a host[:port]/database entry; the user and password are shared."""
+    address, _, database = entry.strip().partition('/')
+    host, _, port = address.partition(':')
+    return {**config, 'host': host, 'port': port or '3306', 'database': database}
+
+
+# Shard 0 is the primary database above, which also holds the users and the shard directory. DB_SHARDS adds
+# more prompt databases, as comma-separated host[:port]/database entries; see data/shards.py for the routing
+shard_configs = [config] + [_shard_config(entry) for entry in os.getenv('DB_SHARDS', '').split(',') if entry.strip()]
+SHARD_COUNT = len(shard_configs)
+
+
 # Create a thread-local storage
 local_storage = threading.local()
 
-# Create a connection pool
-db_pool = pooling.MySQLConnectionPool(pool_name="mypool", pool_size=10, **config)
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+# Seconds a request waits for a free connection before it is shed with a 503
+ADMISSION_TIMEOUT = float(os.getenv('DB_ADMISSION_TIMEOUT', '2.0'))
+
+# The connection pools, one per shard, are created by init_db_pool, from the app's lifespan or on first use
+_db_pools = None
+_db_pool_lock = threading.Lock()
+
+
+def init_db_pool():
+    """
+    Create the connection pools, one of POOL_SIZE per shard, opening all of their connections in
+    parallel rather than one after another as MySQLConnectionPool does. Calling it again returns
+    the existing primary pool.
+
+    Raises:
+        DBConnectionError: If any connection cannot be opened.
+    """
+    global _db_pools
+    with _db_pool_lock:
+        if _db_pools is not None:
+            return _db_pools[0]
+
+        pools = []
+        for shard, shard_config in enumerate(shard_configs):
+            # Without connection arguments the pool starts empty and is filled below
+            pool = pooling.MySQLConnectionPool(pool_name=f"mypool{shard}" if shard else "mypool", pool_size=POOL_SIZE)
+            pool.set_config(**shard_config)
+            pools.append(pool)
+
+        def connect(shard):
+            cnx = mysql.connector.connect(**shard_configs[shard])
+            # Mark it as made with the pool's current config, so get_connection does not reconnect it.
+            # The connector has no public way to do this (nor to close a pool's idle connections, see
+            # close_db_pool); both rely on MySQLConnectionPool internals checked against the version
+            # pinned in requirements.txt, so re-check them when that pin moves
+            cnx.pool_config_version = pools[shard]._config_version
+            return shard, cnx
+
+        with ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix='db-connect') as executor:
+            futures = [executor.submit(connect, shard) for shard in range(SHARD_COUNT) for _ in range(POOL_SIZE)]
+        connections, errors = [], []
+        for future in futures:
+            try:
+                connections.append(future.result())
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            for _, cnx in connections:
+                cnx.close()
+            raise DBConnectionError(f"Failed to open {len(errors)} of {len(futures)} database connections: "
+                                    f"{errors[0]}") from errors[0]
+
+        for shard, cnx in connections:
+            pools[shard].add_connection(cnx)
+        _db_pools = pools
+        return pools[0]
+
+
+def get_db_pool(shard: int = 0):
+    if _db_pools is None:
+        init_db_pool()
+    return _db_pools[shard]
+
+
+def db_pool_ready() -> bool:
+    return _db_pools is not None
+
+
+def close_db_pool() -> None:
+    """Close the idle connections of the pools; the next use creates new ones."""
+    global _db_pools
+    with _db_pool_lock:
+        if _db_pools is not None:
+            for pool in _db_pools:
+                pool._remove_connections()  # Internal, see the pin note in init_db_pool
+            _db_pools = None
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class ConnectionAdmission:
+    """
+    Hands out the pool's connections as slots, so that callers queue for a bounded time instead
+    of failing at once with PoolError when the pool is exhausted. A caller on an event loop thread
+    never queues, as waiting there would stall every other request on the loop; it is shed at once.
+    """
+
+    def __init__(self, size: int, shard: int = 0):
+        self.size = size
+        self.shard = shard
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.in_use = 0
+
+    def acquire(self):
+        timeout = ADMISSION_TIMEOUT
+        deadline = get_deadline()
+        if deadline is not None:
+            deadline.check()
+            remaining = deadline.remaining()
+            if remaining is not None:
+                timeout = min(timeout, remaining)
+        if _on_event_loop():
+            acquired = self.slots.acquire(blocking=False)
+        else:
+            acquired = self.slots.acquire(timeout=timeout)
+        if not acquired:
+            if deadline is not None:
+                deadline.check()
+            raise ServiceUnavailableError("The database is busy, please retry shortly.", retry_after=1)
+        with self.lock:
+            self.in_use += 1
+
+    def release(self):
+        with self.lock:
+            self.in_use -= 1
+        self.slots.release()
+
+    def get_connection(self):
+        self.acquire()
+        try:
+            return get_db_pool(self.shard).get_connection()
+        except PoolError as e:
+            self.release()
+            raise ServiceUnavailableError("The database is busy, please retry shortly.", retry_after=1) from e
+        except BaseException:
+            self.release()
+            raise
+
+    def available(self) -> int:
+        return self.size - self.in_use
+
+
+admissions = [ConnectionAdmission(POOL_SIZE, shard) for shard in range(SHARD_COUNT)]
+admission = admissions[0]
+
+
+# Seconds the connection sending a KILL QUERY may take to open
+KILL_CONNECT_TIMEOUT = 5
+
+
+def kill_query(connection_id: int, shard: int = 0) -> None:
+    """Abort the statement running on a connection, from a short-lived connection outside the pool."""
+    try:
+        cnx = mysql.connector.connect(**shard_configs[shard], connection_timeout=KILL_CONNECT_TIMEOUT)
+        try:
+            cnx.cmd_query(f"KILL QUERY {int(connection_id)}")
+        finally:
+            cnx.close()
+    except mysql.connector.Error:
+        traceback.print_exc()
+
+
+class QueryKiller:
+    """
+    The cancel hook of one statement. The KILL QUERY is sent from its own thread, as the hook runs
+    on whatever cancels the deadline, and the statement's thread waits for it in `finish` so that
+    it lands while the connection still belongs to this request, never after it went back to the pool.
+    """
+
+    def __init__(self, connection_id: int, shard: int = 0):
+        self.connection_id = connection_id
+        self.shard = shard
+        self.lock = threading.Lock()
+        self.thread = None
+        self.finished = False
+
+    def __call__(self):
+        with self.lock:
+            if self.finished or self.thread is not None:
+                return
+            self.thread = threading.Thread(target=kill_query, args=(self.connection_id, self.shard), daemon=True)
+            self.thread.start()
+
+    def finish(self) -> None:
+        """Refuse any later kill and wait for one already sent."""
+        with self.lock:
+            self.finished = True
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+
+_select_pattern = re.compile(r'^\s*SELECT\b', re.IGNORECASE)
+_locking_read_pattern = re.compile(r'\bFOR\s+(UPDATE|SHARE)\b|\bLOCK\s+IN\s+SHARE\s+MODE\b', re.IGNORECASE)
+ER_DUP_ENTRY = 1062
+ER_LOCK_WAIT_TIMEOUT = 1205
+ER_SPECIFIC_ACCESS_DENIED = 1227
+ER_LOCK_DEADLOCK = 1213
+ER_QUERY_INTERRUPTED = 1317
+ER_QUERY_TIMEOUT = 3024
+
+
+def transient_error_code(exc: BaseException):
+    """
+    The MySQL error number if exc was caused by a deadlock or lock wait timeout, which a retry of
+    the whole transaction may get past; None otherwise. Repositories wrap driver errors, so the
+    exceptions exc was raised from are searched too.
+    """
+    if find_in_chain(exc, DeadlineExceededError):
+        return None
+    error = find_in_chain(exc, mysql.connector.Error)
+    if error is not None and error.errno in (ER_LOCK_DEADLOCK, ER_LOCK_WAIT_TIMEOUT):
+        return error.errno
+    return None
+
+
+class DeadlineCursor:
+    """
+    A cursor that bounds every statement by the request's deadline: plain SELECTs get a
+    MAX_EXECUTION_TIME hint, writes and locking reads a session lock wait timeout, and no
+    statement starts once the deadline has passed or the client has disconnected. A statement
+    in flight when the client disconnects is stopped with KILL QUERY, leaving the connection
+    usable, so it goes back to the pool as soon as the request unwinds; the statement does not
+    return until the kill has been delivered, so it cannot reach the connection's next user.
+    """
+
+    def __init__(self, cursor, conn, deadline: Deadline, shard: int = 0):
+        self.cursor = cursor
+        self.conn = conn
+        self.deadline = deadline
+        self.shard = shard
+        self.lock_wait_bounded = False
+
+    def execute(self, operation, params=()):
+        return self._run(self.cursor.execute, operation, params)
+
+    def executemany(self, operation, seq_params):
+        return self._run(self.cursor.executemany, operation, seq_params)
+
+    def _run(self, method, operation, params):
+        key = id(self)
+        killer = QueryKiller(self.conn.connection_id, self.shard)
+        self.deadline.add_cancel_hook(key, killer)
+        try:
+            return method(self._bound(operation), params)
+        except mysql.connector.Error as e:
+            if e.errno in (ER_QUERY_INTERRUPTED, ER_QUERY_TIMEOUT) or \
+                    (e.errno == ER_LOCK_WAIT_TIMEOUT and self.deadline.expired()):
+                self.deadline.check()
+                raise DeadlineExceededError() from e
+            raise
+        finally:
+            self.deadline.remove_cancel_hook(key)
+            killer.finish()
+
+    def _bound(self, operation):
+        self.deadline.check()
+        remaining = self.deadline.remaining()
+        if remaining is None:
+            return operation
+        if _select_pattern.match(operation) and not _locking_read_pattern.search(operation):
+            return _select_pattern.sub(f"SELECT /*+ MAX_EXECUTION_TIME({max(1, int(remaining * 1000))}) */",
+                                       operation, count=1)
+        if not self.lock_wait_bounded:
+            self.cursor.execute("SET SESSION innodb_lock_wait_timeout = %s", (max(1, math.ceil(remaining)),))
+            self.lock_wait_bounded = True
+        return operation
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class SpanCursor:
+    """A cursor marking each statement as a span of the 'sql' layer, for an observed request."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, operation, params=()):
+        with span('sql', operation):
+            return self.cursor.execute(operation, params)
+
+    def executemany(self, operation, seq_params):
+        with span('sql', operation):
+            return self.cursor.executemany(operation, seq_params)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
 
 
 class DatabaseContext:
+    def __init__(self, shard: int = 0):
+        self.shard = shard  # Which database; 0 is the primary
+
     def __enter__(self):
-        self.conn = db_pool.get_connection()
-        self.cursor = self.conn.cursor(dictionary=True)
-        # Store the context in thread-local storage
+        with span('pool', 'checkout'):
+            self.conn = admissions[self.shard].get_connection()
+        try:
+            self.cursor = self.conn.cursor(dictionary=True)
+            if observers():
+                self.cursor = SpanCursor(self.cursor)
+            deadline = get_deadline()
+            if deadline is not None:
+                self.cursor = DeadlineCursor(self.cursor, self.conn, deadline, self.shard)
+        except BaseException:
+            self.conn.close()
+            admissions[self.shard].release()
+            raise
+        # Store the context in thread-local storage; one opened inside another, e.g. on another shard,
+        # puts the outer one back on exit
+        self._outer = get_current_db_context()
         local_storage.db_context = self
         return self
 
@@ -40,8 +364,12 @@ class DatabaseContext:
             self.cursor.close()
             self.conn.close()  # Close the connection regardless of exception status
         finally:
+            admissions[self.shard].release()
             # Remove context from local storage
-            del local_storage.db_context
+            if self._outer is not None:
+                local_storage.db_context = self._outer
+            else:
+                del local_storage.db_context
 
     @property
     def cursor(self):
@@ -65,3 +393,43 @@ class DatabaseContext:
 # Provide a global function to fetch the current context
 def get_current_db_context():
     return getattr(local_storage, "db_context", None)
+
+
+class StreamingCursor:
+    """
+    An unbuffered cursor on its own pooled connection, for reading large result sets in
+    constant memory. Rows stay on the server until fetched.
+
+    Unlike DatabaseContext it is not bound to the current thread, so a generator may hold
+    it across steps that run on different worker threads.
+    """
+
+    def __init__(self, query, params=(), shard: int = 0):
+        self.query = query
+        self.params = params
+        self.shard = shard
+
+    def __enter__(self):
+        with span('pool', 'checkout'):
+            self.conn = admissions[self.shard].get_connection()
+        try:
+            self.cursor = self.conn.cursor(dictionary=True, buffered=False)
+            with span('sql', self.query):
+                self.cursor.execute(self.query, self.params)
+        except BaseException:
+            self.conn.close()
+            admissions[self.shard].release()
+            raise
+        return self
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            # Drain unread rows, otherwise the connection cannot be returned to the pool
+            self.conn.consume_results()
+            self.cursor.close()
+        finally:
+            self.conn.close()
+            admissions[self.shard].release()
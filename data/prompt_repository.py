@@ -1,10 +1,29 @@
+import os
+import re
 import traceback
-from typing import List, Optional
-
-from core import make_guid
-from core.exceptions import ConstraintViolationError, DataValidationError, UnauthorizedError
-from core.models import Prompt, Variable, User, PromptCreate, PromptUpdate
-from data import get_current_db_context
+import json
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
+
+import mysql.connector
+
+from core import make_guid, make_content_hash, guid_to_bytes, guid_from_bytes
+from core.delta import make_delta, apply_delta
+from core.tokenizer import count_tokens
+from core.exceptions import ConstraintViolationError, DataValidationError, UnauthorizedError, RecordNotFoundError, \
+    ServiceUnavailableError
+from core.models import Prompt, Variable, User, PromptCreate, PromptUpdate, PromptFacets, FacetCount, \
+    PromptRevisionInfo, PromptRevision, PromptRecord, PromptFields, PromptQueryOptions, PromptChange, construct_trusted
+from data import get_current_db_context, StreamingCursor, ER_DUP_ENTRY, ER_SPECIFIC_ACCESS_DENIED
+from data.shards import shard_router
+
+# Every Nth revision is stored in full, so rebuilding any revision applies at most N-1 deltas
+SNAPSHOT_INTERVAL = int(os.getenv('PROMPT_SNAPSHOT_INTERVAL', '10'))
+# Seconds between when an open transaction started and when the entry after a hole was written, beyond which the
+# hole cannot be that transaction's; covers both timestamps being truncated to the second
+HOLE_CLOCK_MARGIN = 2
+MAX_MATCH_GRAMS = 16  # Query ngrams looked up in the FULLTEXT index; the LIKE check makes up for fewer
 
 
 class PromptRepositoryInterface:
@@ -17,10 +36,16 @@ class PromptRepositoryInterface:
     def delete_prompt(self, guid: str, user: Optional[User] = None) -> None:
         raise NotImplementedError
 
-    def get_prompt(self, guid: str, user: Optional[User] = None) -> Prompt:
+    def get_prompt(self, guid: str, user: Optional[User] = None,
+                   options: Optional[PromptQueryOptions] = None) -> Union[Prompt, PromptFields]:
+        raise NotImplementedError
+
+    def get_prompts_by_guids(self, guids: List[str], user: Optional[User] = None,
+                             options: Optional[PromptQueryOptions] = None) -> List[Union[Prompt, PromptFields]]:
         raise NotImplementedError
 
-    def list_prompts(self, user: Optional[User] = None) -> List[Prompt]:
+    def list_prompts(self, user: Optional[User] = None,
+                     options: Optional[PromptQueryOptions] = None) -> List[Union[Prompt, PromptFields]]:
         raise NotImplementedError
 
     def add_remove_tags_for_prompt(self, guid: str, tags: List[str], user: Optional[User] = None) -> None:
@@ -29,15 +54,150 @@ class PromptRepositoryInterface:
     def add_remove_classification_for_prompt(self, guid: str, classification: str, user: Optional[User] = None) -> None:
         raise NotImplementedError
 
-    def search_prompts(self, query: str, user: Optional[User] = None) -> List[Prompt]:
+    def search_prompts(self, query: str, user: Optional[User] = None,
+                       options: Optional[PromptQueryOptions] = None) -> List[Union[Prompt, PromptFields]]:
+        raise NotImplementedError
+
+    def get_prompts_by_tags(self, tags_list: List[str], user: Optional[User] = None,
+                            options: Optional[PromptQueryOptions] = None) -> List[Union[Prompt, PromptFields]]:
+        raise NotImplementedError
+
+    def get_prompts_by_classification(self, classification: str, user: Optional[User] = None,
+                                      options: Optional[PromptQueryOptions] = None
+                                      ) -> List[Union[Prompt, PromptFields]]:
+        raise NotImplementedError
+
+    def get_facets(self, query: Optional[str] = None, tags_list: Optional[List[str]] = None,
+                   user: Optional[User] = None) -> PromptFacets:
+        raise NotImplementedError
+
+    def find_prompt_guid_by_hash(self, content_hash: str, user: Optional[User] = None) -> Optional[str]:
+        raise NotImplementedError
+
+    def create_prompt_once(self, prompt: PromptCreate, author: Optional[User] = None) -> Tuple[str, bool]:
+        raise NotImplementedError
+
+    def list_revisions(self, guid: str, user: Optional[User] = None) -> List[PromptRevisionInfo]:
+        raise NotImplementedError
+
+    def get_revision(self, guid: str, revision: int, user: Optional[User] = None) -> PromptRevision:
+        raise NotImplementedError
+
+    def iter_prompt_contents(self, batch_size: int = 1000) -> Iterator[List[dict]]:
+        raise NotImplementedError
+
+    def stream_prompt_rows(self, user: Optional[User] = None, all_scopes: bool = False,
+                           batch_size: int = 1000, shard: Optional[int] = None) -> Iterator[List[dict]]:
+        raise NotImplementedError
+
+    def hydrate_prompts(self, rows: List[dict]) -> List[Prompt]:
+        raise NotImplementedError
+
+    def refresh_documents(self, after_id: int, batch_size: int = 1000, only_missing: bool = False) -> Optional[int]:
+        raise NotImplementedError
+
+    def refresh_prompt_stats(self, after_id: int, batch_size: int = 1000,
+                             only_missing: bool = False) -> Optional[int]:
+        raise NotImplementedError
+
+    def refresh_content_hashes(self, after_id: int, batch_size: int = 1000,
+                               only_missing: bool = False) -> Optional[int]:
+        raise NotImplementedError
+
+    def add_missing_usage(self, after_id: int, batch_size: int = 1000) -> Optional[int]:
+        raise NotImplementedError
+
+    def check_documents(self, after_id: int, batch_size: int = 1000) -> Tuple[Optional[int], List[str], List[str]]:
+        raise NotImplementedError
+
+    def bulk_insert_prompts(self, records: List[PromptRecord]) -> List[PromptRecord]:
+        raise NotImplementedError
+
+    def rename_tag(self, old_name: str, new_name: str) -> int:
+        raise NotImplementedError
+
+    def merge_tags(self, source: str, target: str) -> int:
+        raise NotImplementedError
+
+    def retag_prompts(self, add: List[str], remove: List[str], tags_list: Optional[List[str]] = None,
+                      classification: Optional[str] = None, query: Optional[str] = None,
+                      all_scopes: bool = True, batch_size: int = 1000) -> int:
+        raise NotImplementedError
+
+    def add_prompt_usage(self, counts: Dict[str, int]) -> Counter:
+        raise NotImplementedError
+
+    def record_prompt_change(self, guid: str, author_id: Optional[int], op: str) -> int:
+        raise NotImplementedError
+
+    def record_prompt_changes(self, changes: List[tuple], tag_renamed: bool = False) -> None:
+        raise NotImplementedError
+
+    def get_changes_since(self, seq: int, limit: int = 1000) -> List[PromptChange]:
+        raise NotImplementedError
+
+    def get_latest_change_seq(self) -> int:
+        raise NotImplementedError
+
+    def get_prompt_changes(self, since: int, upto: int, limit: int,
+                           user: Optional[User] = None) -> List[PromptChange]:
+        raise NotImplementedError
+
+    def get_change_horizon(self, settle_seconds: float) -> int:
         raise NotImplementedError
 
-    def get_prompts_by_tags(self, tags_list: List[str], user: Optional[User] = None) -> List[Prompt]:
+    def get_oldest_change_seq(self) -> Optional[int]:
         raise NotImplementedError
 
-    def get_prompts_by_classification(self, classification: str, user: Optional[User] = None) -> List[Prompt]:
+    def get_prompt_contents(self, guids: List[str]) -> List[dict]:
         raise NotImplementedError
 
+    def get_prompt_labels(self, guids: List[str]) -> Dict[str, dict]:
+        raise NotImplementedError
+
+    def get_label_names(self) -> Dict[str, List[Tuple[str, Optional[int]]]]:
+        raise NotImplementedError
+
+    def get_tag_names(self) -> List[str]:
+        raise NotImplementedError
+
+    def prune_changes(self, retention_days: int, batch_size: int = 10000) -> int:
+        raise NotImplementedError
+
+    def count_prompts(self) -> Dict[str, int]:
+        raise NotImplementedError
+
+    def get_author_ids(self) -> List[int]:
+        raise NotImplementedError
+
+    def get_prompt_history(self, guids: List[str]) -> Dict[str, dict]:
+        raise NotImplementedError
+
+    def put_prompt_history(self, history: Dict[str, dict]) -> None:
+        raise NotImplementedError
+
+    def get_usage_counts(self, guids: List[str]) -> Dict[str, dict]:
+        raise NotImplementedError
+
+    def put_usage_counts(self, usage: Dict[str, dict]) -> None:
+        raise NotImplementedError
+
+    def purge_prompts(self, guids: List[str]) -> int:
+        raise NotImplementedError
+
+    def fence_author(self, author_id: int, target: int) -> None:
+        raise NotImplementedError
+
+    def unfence_author(self, author_id: int) -> None:
+        raise NotImplementedError
+
+    def begin_author_move(self, author_id: int, target: int) -> None:
+        raise NotImplementedError
+
+    def get_author_move(self, author_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+
 
 class MySQLPromptRepository(PromptRepositoryInterface):
 
@@ -46,9 +206,15 @@ class MySQLPromptRepository(PromptRepositoryInterface):
         try:
             prompt_guid = make_guid()
             # Insert main prompt data
-            db.cursor.execute("INSERT INTO prompts (guid, content, author_id ) VALUES (%s, %s, %s)",
-                              (prompt_guid, prompt.content, author.id if author else None,))
+            db.cursor.execute("""
+                INSERT INTO prompts (guid, content, content_hash, author_id, char_count, token_count,
+                                     input_variable_count, output_variable_count)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """, (guid_to_bytes(prompt_guid), prompt.content, make_content_hash(prompt.content),
+                  author.id if author else None) + self._stats(prompt))
             prompt_id = db.cursor.lastrowid
+            db.cursor.execute("INSERT INTO prompt_usage (prompt_id, author_id) VALUES (%s, %s)",
+                              (prompt_id, author.id if author else None))
 
             # Handle I/O variables
             for var in prompt.input_variables + prompt.output_variables:
@@ -56,13 +222,15 @@ class MySQLPromptRepository(PromptRepositoryInterface):
                 db.cursor.execute(
                     "INSERT INTO io_variables (guid, name, description, expected_format, type) VALUES (%s, %s, %s, %s, %s)",
                     (
-                        guid, var.name, var.description, var.expected_format,
+                        guid_to_bytes(guid), var.name, var.description, var.expected_format,
                         'input' if var in prompt.input_variables else 'output'))
                 io_variable_id = db.cursor.lastrowid
                 db.cursor.execute("INSERT INTO prompt_io_variables (prompt_id, io_variable_id) VALUES (%s, %s)",
                                   (prompt_id, io_variable_id))
 
             self._store_tags_classification(prompt, prompt_id)
+            self._refresh_documents("prompts.id = %s", (prompt_id,))
+            self._record_revision(prompt_id, None, prompt.content)
 
             return prompt_guid
         except Exception as e:
@@ -72,6 +240,12 @@ class MySQLPromptRepository(PromptRepositoryInterface):
             else:
                 raise DataValidationError(message=f"Error occurred while saving the prompt: {e}")
 
+    @staticmethod
+    def _stats(prompt) -> tuple:
+        """char_count, token_count, input_variable_count and output_variable_count for a prompt being written."""
+        return (len(prompt.content), count_tokens(prompt.content), len(prompt.input_variables or []),
+                len(prompt.output_variables or []))
+
     def _store_tags_classification(self, prompt, prompt_id):
         db = get_current_db_context()
 
@@ -81,91 +255,66 @@ class MySQLPromptRepository(PromptRepositoryInterface):
         # Clear existing classification for the prompt
         db.cursor.execute("UPDATE prompts SET classification_id = NULL WHERE id = %s", (prompt_id,))
 
-        # Handle tags
+        # Handle tags. Existing tags are looked up without locking and only missing ones are inserted,
+        # in sorted order, and links are added in ascending tag id order: concurrent writers sharing
+        # tags then take their locks in the same order instead of deadlocking on each other's gaps
         if prompt.tags:
-            for tag in prompt.tags:
-                db.cursor.execute(
-                    "INSERT INTO tags (tag_name) VALUES (%s) AS new ON DUPLICATE KEY UPDATE tag_name=new.tag_name",
-                    (tag,))
-                db.cursor.execute("SELECT id FROM tags WHERE tag_name = %s", (tag,))
-                tag_id = db.cursor.fetchone()['id']
-                db.cursor.execute("INSERT INTO prompt_tags (prompt_id, tag_id) VALUES (%s, %s)", (prompt_id, tag_id))
+            tag_ids = self._ensure_names('tags', 'tag_name', set(prompt.tags))
+            db.cursor.executemany("INSERT INTO prompt_tags (prompt_id, tag_id) VALUES (%s, %s)",
+                                  [(prompt_id, tag_id) for tag_id in sorted(set(tag_ids.values()))])
         if prompt.classification:
-            db.cursor.execute("INSERT INTO classifications (classification_name) VALUES (%s) AS new ON DUPLICATE KEY UPDATE classification_name=new.classification_name",
-                              (prompt.classification,))
-            db.cursor.execute("SELECT id FROM classifications WHERE classification_name = %s", (prompt.classification,))
-            classification_id = db.cursor.fetchone()['id']
+            classification_id = self._ensure_names('classifications', 'classification_name',
+                                                   {prompt.classification})[prompt.classification]
             db.cursor.execute("UPDATE prompts SET classification_id = %s WHERE id = %s",
                               (classification_id, prompt_id))
 
-    def get_prompt(self, guid: str, user: Optional[User] = None) -> Optional[Prompt]:
+    def _record_revision(self, prompt_id, previous_content, content):
         db = get_current_db_context()
-        try:
-            # Fetch basic prompt data
-            if user:
-                db.cursor.execute("""
-                            SELECT * FROM prompts WHERE guid = %s AND author_id = %s
-                        """, (guid, user.id))
-            else:
-                db.cursor.execute("""
-                            SELECT * FROM prompts WHERE guid = %s AND author_id IS NULL
-                        """, (guid,))
 
+        db.cursor.execute("""
+            SELECT MAX(revision) AS latest,
+                   MAX(CASE WHEN is_snapshot THEN revision END) AS latest_snapshot
+            FROM prompt_revisions WHERE prompt_id = %s
+        """, (prompt_id,))
+        history = db.cursor.fetchone()
+        latest, latest_snapshot = history['latest'], history['latest_snapshot']
+
+        # Prompts created before versioning existed start their history from the content being replaced
+        if latest is None and previous_content is not None:
+            db.cursor.execute("""
+                INSERT INTO prompt_revisions (prompt_id, revision, is_snapshot, body) VALUES (%s, 1, TRUE, %s)
+            """, (prompt_id, previous_content))
+            latest = latest_snapshot = 1
+
+        revision = (latest or 0) + 1
+        if latest_snapshot is None or revision - latest_snapshot >= SNAPSHOT_INTERVAL:
+            is_snapshot, body = True, content
+        else:
+            body = make_delta(previous_content, content)
+            # Fall back to a snapshot when the edit rewrote most of the prompt anyway
+            is_snapshot = len(body) >= len(content)
+            if is_snapshot:
+                body = content
+
+        db.cursor.execute("""
+            INSERT INTO prompt_revisions (prompt_id, revision, is_snapshot, body) VALUES (%s, %s, %s, %s)
+        """, (prompt_id, revision, is_snapshot, body))
+
+    def get_prompt(self, guid: str, user: Optional[User] = None,
+                   options: Optional[PromptQueryOptions] = None) -> Optional[Union[Prompt, PromptFields]]:
+        db = get_current_db_context()
+        if options and options.fields:
+            where, params = self._author_scope(user)
+            prompts = self._select_prompts(f"prompts.guid = %s AND {where}", (guid_to_bytes(guid),) + params, options)
+            return prompts[0] if prompts else None
+        try:
+            # One row: the variables, tags and classification come from the prompt's document
+            where, params = self._author_scope(user)
+            db.cursor.execute(f"SELECT * FROM prompts WHERE guid = %s AND {where}", (guid_to_bytes(guid),) + params)
             prompt_row = db.cursor.fetchone()
             if not prompt_row:
                 return None
-
-            # Fetch associated I/O variables
-            db.cursor.execute("SELECT * FROM prompt_io_variables WHERE prompt_id = %s", (prompt_row['id'],))
-            io_variable_ids = [row['io_variable_id'] for row in db.cursor.fetchall()]
-            # Using IN with a list of ids
-            input_vars = []
-            output_vars = []
-            if len(io_variable_ids) > 0:
-                placeholders = ', '.join(['%s'] * len(io_variable_ids))
-                query = f"SELECT * FROM io_variables WHERE id IN ({placeholders})"
-                db.cursor.execute(query, io_variable_ids)
-
-                for row in db.cursor.fetchall():
-                    var = Variable(name=row['name'],
-                                   description=row['description'],
-                                   type=row['type'],
-                                   expected_format=row['expected_format'])
-                    # Assuming you have a field to distinguish between input and output variables
-                    if row['type'] == 'input':
-                        input_vars.append(var)
-                    else:
-                        output_vars.append(var)
-
-            # Fetch associated tags
-            db.cursor.execute(
-                "SELECT tag_name FROM tags WHERE id IN (SELECT tag_id FROM prompt_tags WHERE prompt_id = %s)",
-                (prompt_row['id'],))
-            tags = [row['tag_name'] for row in db.cursor.fetchall()]
-
-            # Fetch classification
-            db.cursor.execute("SELECT classification_name FROM classifications WHERE id = %s",
-                              (prompt_row['classification_id'],))
-            result = db.cursor.fetchone()
-            if result is None or result['classification_name'] is None:
-                classification = None
-            else:
-                classification = result['classification_name']
-
-            # Construct and return the Prompt model
-            return Prompt(
-                guid=prompt_row['guid'],
-                id=prompt_row['id'],
-                content=prompt_row['content'],
-                input_variables=input_vars,
-                output_variables=output_vars,
-                tags=tags,
-                classification=classification,
-                author=prompt_row['author_id'],  # assuming author_id maps to an author name or similar
-                created_at=prompt_row['created_at'],
-                updated_at=prompt_row['updated_at'] if 'updated_at' in prompt_row else None,
-
-            )
+            return self.hydrate_prompts([prompt_row])[0]
         except Exception as e:
             traceback.print_exc()
             if 'constraint' in str(e).lower():
@@ -179,13 +328,23 @@ class MySQLPromptRepository(PromptRepositoryInterface):
         self._check_prompt_ownership(prompt.guid, user)
 
         try:
+            # Lock the row and keep the previous content for the revision history
+            db.cursor.execute("SELECT id, content FROM prompts WHERE guid = %s FOR UPDATE",
+                              (guid_to_bytes(prompt.guid),))
+            prompt_row = db.cursor.fetchone()
+            prompt_id = prompt_row['id']
+
+            # A deduplicating create must no longer find this prompt by its previous content
+            db.cursor.execute("DELETE FROM prompt_hash_claims WHERE prompt_id = %s", (prompt_id,))
+
             # Update main prompt content
-            db.cursor.execute("UPDATE prompts SET content = %s  WHERE guid = %s",
-                              (prompt.content, prompt.guid))
+            db.cursor.execute("""
+                UPDATE prompts SET content = %s, content_hash = %s, char_count = %s, token_count = %s,
+                                   input_variable_count = %s, output_variable_count = %s
+                WHERE id = %s
+            """, (prompt.content, make_content_hash(prompt.content)) + self._stats(prompt) + (prompt_id,))
 
             # Update I/O variables. For simplicity, we'll remove all current associations and re-add them
-            db.cursor.execute("SELECT id FROM prompts WHERE guid = %s", (prompt.guid,))
-            prompt_id = db.cursor.fetchone()['id']
             db.cursor.execute("DELETE FROM prompt_io_variables WHERE prompt_id = %s", (prompt_id,))
 
             for var in prompt.input_variables + prompt.output_variables:
@@ -196,7 +355,7 @@ class MySQLPromptRepository(PromptRepositoryInterface):
                     ON DUPLICATE KEY UPDATE name = %s, description = %s, expected_format = %s
                 
                 """,
-                    (variable_guid, var.name, var.description, var.expected_format,
+                    (guid_to_bytes(variable_guid), var.name, var.description, var.expected_format,
                      'input' if var in prompt.input_variables else 'output',
                      var.name, var.description, var.expected_format))
                 io_variable_id = db.cursor.lastrowid
@@ -204,6 +363,8 @@ class MySQLPromptRepository(PromptRepositoryInterface):
                                   (prompt_id, io_variable_id))
 
             self._store_tags_classification(prompt, prompt_id)
+            self._refresh_documents("prompts.id = %s", (prompt_id,))
+            self._record_revision(prompt_id, prompt_row['content'], prompt.content)
 
         except Exception as e:
             traceback.print_exc()
@@ -216,7 +377,7 @@ class MySQLPromptRepository(PromptRepositoryInterface):
     def _check_prompt_ownership(guid, user):
         db = get_current_db_context()
         query = "SELECT author_id FROM prompts WHERE guid = %s"
-        params = (guid,)
+        params = (guid_to_bytes(guid),)
         db.cursor.execute(query, params)
         author_id = db.cursor.fetchone()['author_id']
         if author_id != (user.id if user else None):
@@ -228,12 +389,14 @@ class MySQLPromptRepository(PromptRepositoryInterface):
 
         try:
             # Fetch the ID for the given prompt guid
-            db.cursor.execute("SELECT id FROM prompts WHERE guid = %s", (guid,))
+            db.cursor.execute("SELECT id FROM prompts WHERE guid = %s", (guid_to_bytes(guid),))
             prompt_id = db.cursor.fetchone()['id']
 
             # Remove associations
             db.cursor.execute("DELETE FROM prompt_io_variables WHERE prompt_id = %s", (prompt_id,))
             db.cursor.execute("DELETE FROM prompt_tags WHERE prompt_id = %s", (prompt_id,))
+            db.cursor.execute("DELETE FROM prompt_revisions WHERE prompt_id = %s", (prompt_id,))
+            db.cursor.execute("DELETE FROM prompt_usage WHERE prompt_id = %s", (prompt_id,))
             # Remove the main prompt
             db.cursor.execute("DELETE FROM prompts WHERE id = %s", (prompt_id,))
         except Exception as e:
@@ -243,66 +406,10 @@ class MySQLPromptRepository(PromptRepositoryInterface):
             else:
                 raise DataValidationError(message=f"Error occurred while deleting the prompt: {e}")
 
-    def list_prompts(self, user: Optional[User] = None) -> List[Prompt]:
-        db = get_current_db_context()
-
+    def list_prompts(self, user: Optional[User] = None,
+                     options: Optional[PromptQueryOptions] = None) -> List[Union[Prompt, PromptFields]]:
         try:
-            # Adjust the query based on the presence of the user parameter
-            if user:
-                db.cursor.execute("""
-                            SELECT * FROM prompts WHERE author_id = %s
-                        """, (user.id,))
-            else:
-                db.cursor.execute("""
-                            SELECT * FROM prompts WHERE author_id IS NULL
-                        """)
-            prompt_datas = db.cursor.fetchall()
-
-            prompts = []
-            for prompt_data in prompt_datas:
-                # For each prompt, fetch the associated I/O variables
-                db.cursor.execute("""
-                    SELECT io_variables.*
-                    FROM io_variables 
-                    INNER JOIN prompt_io_variables ON io_variables.id = prompt_io_variables.io_variable_id 
-                    WHERE prompt_io_variables.prompt_id = %s
-                """, (prompt_data['id'],))
-                io_vars = db.cursor.fetchall()
-                input_vars = [Variable(**var) for var in io_vars if var['type'] == 'input']
-                output_vars = [Variable(**var) for var in io_vars if var['type'] == 'output']
-
-                # Fetch associated tags
-                db.cursor.execute("""
-                    SELECT tags.tag_name
-                    FROM tags
-                    INNER JOIN prompt_tags ON tags.id = prompt_tags.tag_id
-                    WHERE prompt_tags.prompt_id = %s
-                """, (prompt_data['id'],))
-                tags = [row['tag_name'] for row in db.cursor.fetchall()]
-
-                # Fetch classification
-                db.cursor.execute("SELECT classification_name FROM classifications WHERE id = %s",
-                                  (prompt_data['classification_id'],))
-                result = db.cursor.fetchone()
-
-                if result is None or result['classification_name'] is None:
-                    classification = None
-                else:
-                    classification = result['classification_name']
-
-                # Construct and append the Prompt object to the list
-                prompts.append(Prompt(guid=prompt_data['guid'],
-                                      id=prompt_data['id'],
-                                      content=prompt_data['content'],
-                                      input_variables=input_vars,
-                                      output_variables=output_vars,
-                                      tags=tags,
-                                      classification=classification,
-                                      author=prompt_data['author_id'],
-                                      created_at=prompt_data['created_at'],
-                                      updated_at=prompt_data['updated_at']))
-
-            return prompts
+            return self._query_prompts(*self._author_scope(user), options, user)
         except Exception as e:
             traceback.print_exc()
             if 'constraint' in str(e).lower():
@@ -318,11 +425,11 @@ class MySQLPromptRepository(PromptRepositoryInterface):
             if user:
                 db.cursor.execute("""
                             SELECT id FROM prompts WHERE guid = %s AND author_id = %s
-                        """, (guid, user.id,))
+                        """, (guid_to_bytes(guid), user.id,))
             else:
                 db.cursor.execute("""
                             SELECT id FROM prompts WHERE guid = %s AND author_id IS NULL
-                        """, (guid,))
+                        """, (guid_to_bytes(guid),))
             prompt_id = db.cursor.fetchone()['id']
 
             # Get the existing tags for the prompt
@@ -338,22 +445,18 @@ class MySQLPromptRepository(PromptRepositoryInterface):
             tags_to_add = set(tags) - set(existing_tags)
             tags_to_remove = set(existing_tags) - set(tags)
 
-            for tag in tags_to_add:
-                # Check if tag exists in the main tags table
-                db.cursor.execute("SELECT id FROM tags WHERE tag_name = %s", (tag,))
-                tag_id = db.cursor.fetchone()
-                if not tag_id:
-                    db.cursor.execute("INSERT INTO tags(tag_name) VALUES (%s)", (tag,))
-                    tag_id = db.cursor.fetchone()['id']
-
-                # Add the tag association to the prompt
-                db.cursor.execute("INSERT INTO prompt_tags(prompt_id, tag_id) VALUES (%s, %s)", (prompt_id, tag_id))
+            # Create missing tags and add the associations in ascending tag id order, as in _store_tags_classification
+            tag_ids = self._ensure_names('tags', 'tag_name', tags_to_add)
+            if tag_ids:
+                db.cursor.executemany("INSERT INTO prompt_tags(prompt_id, tag_id) VALUES (%s, %s)",
+                                      [(prompt_id, tag_id) for tag_id in sorted(set(tag_ids.values()))])
 
             for tag in tags_to_remove:
                 db.cursor.execute("""
                         DELETE FROM prompt_tags 
                         WHERE prompt_id = %s AND tag_id = (SELECT id FROM tags WHERE tag_name = %s)
                     """, (prompt_id, tag))
+            self._refresh_documents("prompts.id = %s", (prompt_id,))
         except Exception as e:
             traceback.print_exc()
             if 'constraint' in str(e).lower():
@@ -374,7 +477,9 @@ class MySQLPromptRepository(PromptRepositoryInterface):
                 classification_id = db.cursor.fetchone()['id']
 
             # Update the prompt's classification
-            db.cursor.execute("UPDATE prompts SET classification_id = %s WHERE guid = %s", (classification_id, guid))
+            db.cursor.execute("UPDATE prompts SET classification_id = %s WHERE guid = %s",
+                              (classification_id, guid_to_bytes(guid)))
+            self._refresh_documents("prompts.guid = %s", (guid_to_bytes(guid),))
         except Exception as e:
             traceback.print_exc()
             if 'constraint' in str(e).lower():
@@ -383,71 +488,1148 @@ class MySQLPromptRepository(PromptRepositoryInterface):
             else:
                 raise DataValidationError(message=f"Error occurred while add_remove_classifications_for_prompt: {e}")
 
-    def search_prompts(self, query: str, user: Optional[User] = None) -> List[Prompt]:
+    def search_prompts(self, query: str, user: Optional[User] = None,
+                       options: Optional[PromptQueryOptions] = None) -> List[Union[Prompt, PromptFields]]:
+        where, params = self._author_scope(user)
+        match, match_params = self._content_match(query)
+        return self._query_prompts(f"{match} AND {where}", match_params + params, options, user)
+
+    def get_prompts_by_tags(self, tags_list: List[str], user: Optional[User] = None,
+                            options: Optional[PromptQueryOptions] = None) -> List[Union[Prompt, PromptFields]]:
+        # Prompts with any of the tags, each once
+        where, params = self._author_scope(user)
+        return self._query_prompts(f"""prompts.id IN (
+                SELECT prompt_tags.prompt_id FROM prompt_tags
+                JOIN tags ON prompt_tags.tag_id = tags.id
+                WHERE tags.tag_name IN ({', '.join(['%s'] * len(tags_list))})) AND {where}""",
+                                   tuple(tags_list) + params, options, user)
+
+    def get_prompts_by_classification(self, classification: str, user: Optional[User] = None,
+                                      options: Optional[PromptQueryOptions] = None
+                                      ) -> List[Union[Prompt, PromptFields]]:
+        where, params = self._author_scope(user)
+        return self._query_prompts(f"""prompts.classification_id = (
+                SELECT id FROM classifications WHERE classification_name = %s) AND {where}""",
+                                   (classification,) + params, options, user)
+
+    def get_facets(self, query: Optional[str] = None, tags_list: Optional[List[str]] = None,
+                   user: Optional[User] = None) -> PromptFacets:
         db = get_current_db_context()
 
-        # Fetch matching prompt guids based on the query (I assume a simple LIKE clause for now)
-        # Adjust the query based on the presence of the user parameter
+        try:
+            # Narrow the prompts in scope by the optional search query and tag selection
+            where, params = self._author_scope(user)
+            if query:
+                match, match_params = self._content_match(query)
+                where += f" AND {match}"
+                params += match_params
+            if tags_list:
+                where += """ AND prompts.id IN (
+                    SELECT prompt_tags.prompt_id FROM prompt_tags
+                    JOIN tags ON prompt_tags.tag_id = tags.id
+                    WHERE tags.tag_name IN ({}))""".format(', '.join(['%s'] * len(tags_list)))
+                params += tuple(tags_list)
+
+            # Count tags in a single aggregate pass over prompt_tags
+            db.cursor.execute(f"""
+                SELECT tags.tag_name AS name, COUNT(*) AS count
+                FROM prompts
+                JOIN prompt_tags ON prompts.id = prompt_tags.prompt_id
+                JOIN tags ON prompt_tags.tag_id = tags.id
+                WHERE {where}
+                GROUP BY tags.tag_name
+                ORDER BY count DESC, name
+            """, params)
+            tags = [FacetCount(name=row['name'], count=row['count']) for row in db.cursor.fetchall()]
+
+            # Count classifications the same way
+            db.cursor.execute(f"""
+                SELECT classifications.classification_name AS name, COUNT(*) AS count
+                FROM prompts
+                JOIN classifications ON prompts.classification_id = classifications.id
+                WHERE {where}
+                GROUP BY classifications.classification_name
+                ORDER BY count DESC, name
+            """, params)
+            classifications = [FacetCount(name=row['name'], count=row['count']) for row in db.cursor.fetchall()]
+
+            return PromptFacets(tags=tags, classifications=classifications)
+        except Exception as e:
+            traceback.print_exc()
+            raise DataValidationError(message=f"Error occurred while computing facets: {e}")
+
+    @staticmethod
+    def _content_match(query: str) -> Tuple[str, tuple]:
+        """
+        The WHERE fragment and params for prompts whose content contains the query. Every pair of
+        adjacent word characters in the query must be in the content's ngram FULLTEXT index, which
+        narrows the candidates without a scan; LIKE then checks the exact substring.
+        """
+        like = ("prompts.content LIKE %s", (f"%{query}%",))
+        grams = list(dict.fromkeys(gram.lower() for word in re.findall(r'\w{2,}', query)
+                                   for gram in (word[i:i + 2] for i in range(len(word) - 1))))[:MAX_MATCH_GRAMS]
+        if not grams:
+            # Shorter than an ngram: nothing to look up, so scan
+            return like
+        return (f"MATCH (prompts.content) AGAINST (%s IN BOOLEAN MODE) AND {like[0]}",
+                (' '.join(f'+{gram}' for gram in grams),) + like[1])
+
+    @staticmethod
+    def _author_scope(user: Optional[User], table: str = 'prompts'):
+        """Return the WHERE fragment and params restricting prompts to the user's scope (or public)."""
         if user:
+            return f"{table}.author_id = %s", (user.id,)
+        return f"{table}.author_id IS NULL", ()
+
+    def list_revisions(self, guid: str, user: Optional[User] = None) -> List[PromptRevisionInfo]:
+        db = get_current_db_context()
+        prompt_id = self._get_prompt_id(guid, user)
+
+        db.cursor.execute("""
+            SELECT revision, is_snapshot, LENGTH(body) AS size, created_at
+            FROM prompt_revisions WHERE prompt_id = %s ORDER BY revision
+        """, (prompt_id,))
+        return [PromptRevisionInfo(revision=row['revision'],
+                                   is_snapshot=bool(row['is_snapshot']),
+                                   size=row['size'],
+                                   created_at=row['created_at']) for row in db.cursor.fetchall()]
+
+    def get_revision(self, guid: str, revision: int, user: Optional[User] = None) -> PromptRevision:
+        db = get_current_db_context()
+        prompt_id = self._get_prompt_id(guid, user)
+
+        # Fetch the nearest snapshot at or before the revision and the deltas that follow it
+        db.cursor.execute("""
+            SELECT revision, is_snapshot, body, created_at FROM prompt_revisions
+            WHERE prompt_id = %s AND revision <= %s AND revision >= (
+                SELECT MAX(revision) FROM prompt_revisions
+                WHERE prompt_id = %s AND is_snapshot AND revision <= %s)
+            ORDER BY revision
+        """, (prompt_id, revision, prompt_id, revision))
+        rows = db.cursor.fetchall()
+        if not rows or rows[-1]['revision'] != revision:
+            raise RecordNotFoundError(f"Revision {revision} of prompt {guid} was not found.")
+
+        content = rows[0]['body']
+        for row in rows[1:]:
+            content = apply_delta(content, row['body'])
+
+        return PromptRevision(guid=guid, revision=revision, content=content, created_at=rows[-1]['created_at'])
+
+    def find_prompt_guid_by_hash(self, content_hash: str, user: Optional[User] = None) -> Optional[str]:
+        db = get_current_db_context()
+        where, params = self._author_scope(user)
+        db.cursor.execute(f"""
+            SELECT guid FROM prompts WHERE {where} AND content_hash = %s ORDER BY id LIMIT 1
+        """, params + (content_hash,))
+        row = db.cursor.fetchone()
+        return guid_from_bytes(row['guid']) if row else None
+
+    def create_prompt_once(self, prompt: PromptCreate, author: Optional[User] = None) -> Tuple[str, bool]:
+        """
+        Create the prompt unless one in the author's scope has the same normalized content; returns
+        the guid and whether it was created. Concurrent identical creates claim the content hash in
+        prompt_hash_claims first: the later one waits on the unique key until the first commits,
+        then reads its prompt, where locking reads of the absent hash would deadlock on the gap.
+        """
+        db = get_current_db_context()
+        content_hash = make_content_hash(prompt.content)
+        guid = self.find_prompt_guid_by_hash(content_hash, author)
+        if guid is not None:
+            return guid, False
+        scope = (author.id if author else 0, content_hash)
+        try:
+            db.cursor.execute("INSERT INTO prompt_hash_claims (scope_id, content_hash) VALUES (%s, %s)", scope)
+        except mysql.connector.IntegrityError as e:
+            if e.errno != ER_DUP_ENTRY:
+                raise
+            # A locking read sees the committed claim, past this transaction's snapshot
             db.cursor.execute("""
-                    SELECT guid FROM prompts 
-                    WHERE content LIKE %s AND author_id = %s
-                """, (f"%{query}%", user.id))
-        else:
+                SELECT prompts.guid FROM prompt_hash_claims JOIN prompts ON prompts.id = prompt_hash_claims.prompt_id
+                WHERE prompt_hash_claims.scope_id = %s AND prompt_hash_claims.content_hash = %s LOCK IN SHARE MODE
+            """, scope)
+            row = db.cursor.fetchone()
+            if row is None:
+                raise ConstraintViolationError(f"Error occurred while saving the prompt: {e}")
+            return guid_from_bytes(row['guid']), False
+        guid = self.create_prompt(prompt, author)
+        db.cursor.execute("""
+            UPDATE prompt_hash_claims SET prompt_id = (SELECT id FROM prompts WHERE guid = %s)
+            WHERE scope_id = %s AND content_hash = %s
+        """, (guid_to_bytes(guid),) + scope)
+        return guid, True
+
+    def iter_prompt_contents(self, batch_size: int = 1000) -> Iterator[List[dict]]:
+        """Yield batches of guid/author_id/content rows for every prompt, walking the primary key."""
+        db = get_current_db_context()
+        last_id = 0
+        while True:
             db.cursor.execute("""
-                    SELECT guid FROM prompts 
-                    WHERE content LIKE %s AND author_id IS NULL
-                """, (f"%{query}%",))
+                SELECT id, guid, author_id, content FROM prompts WHERE id > %s ORDER BY id LIMIT %s
+            """, (last_id, batch_size))
+            rows = db.cursor.fetchall()
+            if not rows:
+                return
+            last_id = rows[-1]['id']
+            for row in rows:
+                row['guid'] = guid_from_bytes(row['guid'])
+            yield rows
+
+    def stream_prompt_rows(self, user: Optional[User] = None, all_scopes: bool = False,
+                           batch_size: int = 1000, shard: Optional[int] = None) -> Iterator[List[dict]]:
+        """
+        Yield batches of prompt rows from an unbuffered cursor on the given shard, by default
+        the current DatabaseContext's.
+
+        The cursor has its own connection, so batches can be hydrated through the current
+        DatabaseContext while the stream is open.
+        """
+        where, params = ("1 = 1", ()) if all_scopes else self._author_scope(user)
+        if shard is None:
+            shard = get_current_db_context().shard
+        with StreamingCursor(f"SELECT prompts.* FROM prompts WHERE {where} ORDER BY prompts.id", params,
+                             shard) as stream:
+            while True:
+                rows = stream.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield rows
+
+    def hydrate_prompts(self, rows: List[dict]) -> List[Prompt]:
+        """
+        Build Prompt models for prompt rows. Variables, tags and classification come from each row's
+        document; rows without one yet are read from the child tables, for the whole batch at once.
+        """
+        documents = self._row_documents(rows, ('input_variables', 'output_variables', 'tags', 'classification'))
+        # Trusted construction: the rows come from our own schema, so skip pydantic validation
+        return [construct_trusted(Prompt,
+                                  guid=guid_from_bytes(row['guid']),
+                                  id=row['id'],
+                                  content=row['content'],
+                                  author=row['author_id'],
+                                  created_at=row['created_at'],
+                                  updated_at=row['updated_at'],
+                                  char_count=row['char_count'],
+                                  token_count=row['token_count'],
+                                  input_variable_count=row['input_variable_count'],
+                                  output_variable_count=row['output_variable_count'],
+                                  **documents[row['id']]) for row in rows]
+
+    def _row_documents(self, rows: List[dict], fields) -> Dict[int, dict]:
+        """Prompt id -> the requested document fields, parsed from the rows or rebuilt for rows without a document."""
+        documents, missing = {}, []
+        for row in rows:
+            document = row.get('document')
+            if document is None:
+                missing.append(row['id'])
+                continue
+            document = json.loads(document)
+            documents[row['id']] = {field: self._document_field(document, field) for field in fields}
+        if missing:
+            for prompt_id, document in self._build_documents(missing).items():
+                documents[prompt_id] = {field: document[field] for field in fields}
+        return documents
 
-        prompt_guids = [row['guid'] for row in db.cursor.fetchall()]
+    @staticmethod
+    def _document_field(document: dict, field: str):
+        if field.endswith('_variables'):
+            return [construct_trusted(Variable, **var) for var in document[field]]
+        return document[field]
 
-        # Map guids to their full details
-        return [self.get_prompt(guid, user) for guid in prompt_guids]
+    @staticmethod
+    def _build_documents(prompt_ids: List[int]) -> Dict[int, dict]:
+        """Read the variables, tags and classification of the prompts from the child tables, one query each."""
+        db = get_current_db_context()
+        placeholders = ', '.join(['%s'] * len(prompt_ids))
+        documents = {prompt_id: {'input_variables': [], 'output_variables': [], 'tags': [], 'classification': None}
+                     for prompt_id in prompt_ids}
+
+        db.cursor.execute(f"""
+            SELECT prompt_io_variables.prompt_id, io_variables.*
+            FROM io_variables
+            INNER JOIN prompt_io_variables ON io_variables.id = prompt_io_variables.io_variable_id
+            WHERE prompt_io_variables.prompt_id IN ({placeholders})
+        """, prompt_ids)
+        for row in db.cursor.fetchall():
+            documents[row['prompt_id']][f"{row['type']}_variables"].append(
+                construct_trusted(Variable, name=row['name'], description=row['description'], type=row['type'],
+                                  expected_format=row['expected_format']))
+
+        db.cursor.execute(f"""
+            SELECT prompt_tags.prompt_id, tags.tag_name
+            FROM tags
+            INNER JOIN prompt_tags ON tags.id = prompt_tags.tag_id
+            WHERE prompt_tags.prompt_id IN ({placeholders})
+        """, prompt_ids)
+        for row in db.cursor.fetchall():
+            documents[row['prompt_id']]['tags'].append(row['tag_name'])
+
+        db.cursor.execute(f"""
+            SELECT prompts.id, classifications.classification_name
+            FROM prompts JOIN classifications ON classifications.id = prompts.classification_id
+            WHERE prompts.id IN ({placeholders})
+        """, prompt_ids)
+        for row in db.cursor.fetchall():
+            documents[row['id']]['classification'] = row['classification_name']
+        return documents
+
+    # The document column: what _build_documents reads, as one expression over a prompts row
+    _VARIABLES_DOCUMENT = """COALESCE((
+            SELECT JSON_ARRAYAGG(JSON_OBJECT('name', io_variables.name, 'description', io_variables.description,
+                                             'type', io_variables.type,
+                                             'expected_format', io_variables.expected_format))
+            FROM prompt_io_variables JOIN io_variables ON io_variables.id = prompt_io_variables.io_variable_id
+            WHERE prompt_io_variables.prompt_id = prompts.id AND io_variables.type = '{}'), JSON_ARRAY())"""
+    _DOCUMENT = f"""JSON_OBJECT(
+        'input_variables', {_VARIABLES_DOCUMENT.format('input')},
+        'output_variables', {_VARIABLES_DOCUMENT.format('output')},
+        'tags', COALESCE((
+            SELECT JSON_ARRAYAGG(tags.tag_name) FROM prompt_tags JOIN tags ON tags.id = prompt_tags.tag_id
+            WHERE prompt_tags.prompt_id = prompts.id), JSON_ARRAY()),
+        'classification', (
+            SELECT classification_name FROM classifications WHERE classifications.id = prompts.classification_id))"""
+
+    def _refresh_documents(self, where: str, params: tuple) -> int:
+        """
+        Rebuild the document of the prompts matching `where` from the child tables, in the caller's
+        transaction, with one statement; returns the number of documents that changed.
+        Every write to a prompt's variables, tags or classification ends with this.
+        """
+        db = get_current_db_context()
+        # The document is derived data: rewriting it is not an edit of the prompt
+        db.cursor.execute(f"UPDATE prompts SET document = {self._DOCUMENT}, updated_at = updated_at WHERE {where}",
+                          params)
+        return db.cursor.rowcount
+
+    def refresh_documents(self, after_id: int, batch_size: int = 1000, only_missing: bool = False) -> Optional[int]:
+        """
+        Rebuild the documents of the next batch_size prompts after `after_id` (only those without a
+        document, if only_missing); returns the last prompt id handled, or None when there are no more.
+        """
+        db = get_current_db_context()
+        missing = " AND document IS NULL" if only_missing else ""
+        db.cursor.execute(f"SELECT id FROM prompts WHERE id > %s{missing} ORDER BY id LIMIT %s",
+                          (after_id, batch_size))
+        prompt_ids = [row['id'] for row in db.cursor.fetchall()]
+        if not prompt_ids:
+            return None
+        self._refresh_documents(f"prompts.id BETWEEN %s AND %s{missing}", (prompt_ids[0], prompt_ids[-1]))
+        return prompt_ids[-1]
+
+    def refresh_prompt_stats(self, after_id: int, batch_size: int = 1000,
+                             only_missing: bool = False) -> Optional[int]:
+        """
+        Recompute the length statistics of the next batch_size prompts after `after_id` (only those
+        without them, if only_missing); returns the last prompt id handled, or None when there are no more.
+        """
+        db = get_current_db_context()
+        missing = " AND token_count IS NULL" if only_missing else ""
+        db.cursor.execute(f"SELECT id, content FROM prompts WHERE id > %s{missing} ORDER BY id LIMIT %s FOR UPDATE",
+                          (after_id, batch_size))
+        rows = db.cursor.fetchall()
+        if not rows:
+            return None
+        variables = {row['id']: {'input': 0, 'output': 0} for row in rows}
+        db.cursor.execute(f"""
+            SELECT prompt_io_variables.prompt_id, io_variables.type, COUNT(*) AS count
+            FROM prompt_io_variables JOIN io_variables ON io_variables.id = prompt_io_variables.io_variable_id
+            WHERE prompt_io_variables.prompt_id IN ({', '.join(['%s'] * len(rows))})
+            GROUP BY prompt_io_variables.prompt_id, io_variables.type
+        """, [row['id'] for row in rows])
+        for row in db.cursor.fetchall():
+            variables[row['prompt_id']][row['type']] = row['count']
+        db.cursor.executemany("""
+            UPDATE prompts SET char_count = %s, token_count = %s, input_variable_count = %s,
+                               output_variable_count = %s, updated_at = updated_at
+            WHERE id = %s
+        """, [(len(row['content']), count_tokens(row['content']), variables[row['id']]['input'],
+               variables[row['id']]['output'], row['id']) for row in rows])
+        return rows[-1]['id']
+
+    def refresh_content_hashes(self, after_id: int, batch_size: int = 1000,
+                               only_missing: bool = False) -> Optional[int]:
+        """
+        Recompute the normalized content hash of the next batch_size prompts after `after_id` (only
+        those without one, if only_missing); returns the last prompt id handled, or None when there are no more.
+        """
+        db = get_current_db_context()
+        missing = " AND content_hash IS NULL" if only_missing else ""
+        db.cursor.execute(f"SELECT id, content FROM prompts WHERE id > %s{missing} ORDER BY id LIMIT %s FOR UPDATE",
+                          (after_id, batch_size))
+        rows = db.cursor.fetchall()
+        if not rows:
+            return None
+        db.cursor.executemany("UPDATE prompts SET content_hash = %s, updated_at = updated_at WHERE id = %s",
+                              [(make_content_hash(row['content']), row['id']) for row in rows])
+        return rows[-1]['id']
+
+    def add_missing_usage(self, after_id: int, batch_size: int = 1000) -> Optional[int]:
+        """
+        Give each of the next batch_size prompts after `after_id` that has no prompt_usage row one with no
+        uses, as sort=popular only walks prompt_usage; returns the last prompt id handled, or None when
+        there are no more. A row added meanwhile by a usage flush is left as it is.
+        """
+        db = get_current_db_context()
+        db.cursor.execute("""
+            SELECT prompts.id, prompts.author_id, prompt_usage.prompt_id AS usage_id
+            FROM prompts LEFT JOIN prompt_usage ON prompt_usage.prompt_id = prompts.id
+            WHERE prompts.id > %s ORDER BY prompts.id LIMIT %s
+        """, (after_id, batch_size))
+        rows = db.cursor.fetchall()
+        if not rows:
+            return None
+        missing = [(row['id'], row['author_id']) for row in rows if row['usage_id'] is None]
+        if missing:
+            db.cursor.executemany("""
+                INSERT INTO prompt_usage (prompt_id, author_id) VALUES (%s, %s)
+                AS new ON DUPLICATE KEY UPDATE author_id = prompt_usage.author_id
+            """, missing)
+        return rows[-1]['id']
+
+    def check_documents(self, after_id: int, batch_size: int = 1000) -> Tuple[Optional[int], List[str], List[str]]:
+        """
+        Compare the documents of the next batch_size prompts after `after_id` with their child tables.
+        Returns the last prompt id checked (None when there are no more), and the guids of the prompts
+        without a document and of those whose document differs.
+        """
+        db = get_current_db_context()
+        db.cursor.execute("SELECT id, guid, document FROM prompts WHERE id > %s ORDER BY id LIMIT %s",
+                          (after_id, batch_size))
+        rows = db.cursor.fetchall()
+        if not rows:
+            return None, [], []
+        missing = [guid_from_bytes(row['guid']) for row in rows if row['document'] is None]
+        stored = [row for row in rows if row['document'] is not None]
+        built = self._build_documents([row['id'] for row in stored]) if stored else {}
+        stale = []
+        for row in stored:
+            document = json.loads(row['document'])
+            expected = built[row['id']]
+            # Aggregation order is not defined, so lists are compared as sets
+            if (sorted(document['tags']) != sorted(expected['tags'])
+                    or document['classification'] != expected['classification']
+                    or any(sorted(tuple(sorted(var.items())) for var in document[field])
+                           != sorted(tuple(sorted(var.model_dump().items())) for var in expected[field])
+                           for field in ('input_variables', 'output_variables'))):
+                stale.append(guid_from_bytes(row['guid']))
+        return rows[-1]['id'], missing, stale
+
+    def bulk_insert_prompts(self, records: List[PromptRecord]) -> List[PromptRecord]:
+        """
+        Insert a chunk of exported prompts with a handful of multi-row statements, keeping their guids.
+        Records whose guid already exists, or repeats an earlier record's, are skipped; the inserted ones are
+        returned.
+        """
+        db = get_current_db_context()
+        try:
+            keys = {record.guid: guid_to_bytes(record.guid) for record in records}
+            malformed = [guid for guid, key in keys.items() if key is None]
+            if malformed:
+                raise DataValidationError(f"Malformed guid '{malformed[0]}'.")
+            db.cursor.execute("SELECT guid FROM prompts WHERE guid IN ({})".format(', '.join(['%s'] * len(keys))),
+                              list(keys.values()))
+            existing = {bytes(row['guid']) for row in db.cursor.fetchall()}
+            # A guid repeated within the chunk, in any spelling, is kept once, as its first record
+            fresh = []
+            for record in records:
+                if keys[record.guid] not in existing:
+                    existing.add(keys[record.guid])
+                    fresh.append(record)
+            records = fresh
+            if not records:
+                return []
+
+            classification_ids = self._ensure_names(
+                'classifications', 'classification_name',
+                {record.classification for record in records if record.classification})
+            tag_ids = self._ensure_names('tags', 'tag_name', {tag for record in records for tag in record.tags or []})
+
+            # Keep exported timestamps; records without them take the column defaults
+            dated = [record for record in records if record.created_at]
+            undated = [record for record in records if not record.created_at]
+            if dated:
+                db.cursor.executemany("""
+                    INSERT INTO prompts (guid, content, content_hash, author_id, classification_id, char_count,
+                                         token_count, input_variable_count, output_variable_count, created_at,
+                                         updated_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                """, [(keys[record.guid], record.content, make_content_hash(record.content), record.author,
+                       classification_ids.get(record.classification)) + self._stats(record) +
+                      (record.created_at, record.updated_at or record.created_at) for record in dated])
+            if undated:
+                db.cursor.executemany("""
+                    INSERT INTO prompts (guid, content, content_hash, author_id, classification_id, char_count,
+                                         token_count, input_variable_count, output_variable_count)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                """, [(keys[record.guid], record.content, make_content_hash(record.content), record.author,
+                       classification_ids.get(record.classification)) + self._stats(record) for record in undated])
+            ids = self._ids_by_guid('prompts', [keys[record.guid] for record in records])
+            prompt_ids = {record.guid: ids[keys[record.guid]] for record in records}
+            db.cursor.executemany("INSERT INTO prompt_usage (prompt_id, author_id) VALUES (%s, %s)",
+                                  [(prompt_ids[record.guid], record.author) for record in records])
+
+            variable_rows = []
+            for record in records:
+                for var_type, variables in (('input', record.input_variables), ('output', record.output_variables)):
+                    for var in variables or []:
+                        variable_rows.append((record.guid, guid_to_bytes(make_guid()), var, var_type))
+            if variable_rows:
+                db.cursor.executemany("""
+                    INSERT INTO io_variables (guid, name, description, expected_format, type)
+                    VALUES (%s, %s, %s, %s, %s)
+                """, [(guid, var.name, var.description, var.expected_format, var_type)
+                      for _, guid, var, var_type in variable_rows])
+                variable_ids = self._ids_by_guid('io_variables', [guid for _, guid, _, _ in variable_rows])
+                db.cursor.executemany("INSERT INTO prompt_io_variables (prompt_id, io_variable_id) VALUES (%s, %s)",
+                                      [(prompt_ids[prompt_guid], variable_ids[guid])
+                                       for prompt_guid, guid, _, _ in variable_rows])
+
+            tag_rows = [(prompt_ids[record.guid], tag_ids[tag]) for record in records for tag in set(record.tags or [])]
+            if tag_rows:
+                db.cursor.executemany("INSERT INTO prompt_tags (prompt_id, tag_id) VALUES (%s, %s)", tag_rows)
+            self._refresh_documents(f"prompts.id IN ({', '.join(['%s'] * len(prompt_ids))})",
+                                    tuple(prompt_ids.values()))
+
+            db.cursor.executemany("""
+                INSERT INTO prompt_revisions (prompt_id, revision, is_snapshot, body) VALUES (%s, %s, %s, %s)
+            """, [(prompt_ids[record.guid], 1, True, record.content) for record in records])
+
+            return records
+        except Exception as e:
+            traceback.print_exc()
+            if 'constraint' in str(e).lower():
+                raise ConstraintViolationError(message=f"Error occurred while importing prompts: {e}")
+            else:
+                raise DataValidationError(message=f"Error occurred while importing prompts: {e}")
 
-    def get_prompts_by_tags(self, tags_list: List[str], user: Optional[User] = None) -> List[Prompt]:
+    def rename_tag(self, old_name: str, new_name: str) -> int:
+        """Rename a tag in place, for every prompt carrying it; returns the number of those prompts."""
+        db = get_current_db_context()
+        source_id = self._lock_tag(old_name)
+        db.cursor.execute("SELECT id FROM tags WHERE tag_name = %s", (new_name,))
+        row = db.cursor.fetchone()
+        # Under the column's collation a change of case only can find the tag itself
+        if row and row['id'] != source_id:
+            raise ConstraintViolationError(f"Tag '{new_name}' already exists; merge the tags instead.")
+        affected = self._record_tag_changes(source_id)
+        db.cursor.execute("UPDATE tags SET tag_name = %s WHERE id = %s", (new_name, source_id))
+        self._refresh_documents("prompts.id IN (SELECT prompt_id FROM prompt_tags WHERE tag_id = %s)", (source_id,))
+        return affected
+
+    def merge_tags(self, source: str, target: str) -> int:
+        """Move every prompt from the source tag to the target and drop the source; returns the prompts moved."""
         db = get_current_db_context()
+        source_id = self._lock_tag(source)
+        target_id = self._ensure_names('tags', 'tag_name', {target})[target]
+        if target_id == source_id:
+            raise DataValidationError(f"Cannot merge tag '{source}' into itself.")
+        affected = self._record_tag_changes(source_id)
+        # Prompts that already have the target only lose the source
+        db.cursor.execute("""
+            INSERT INTO prompt_tags (prompt_id, tag_id)
+            SELECT source.prompt_id, %s FROM prompt_tags AS source
+            WHERE source.tag_id = %s AND NOT EXISTS (
+                SELECT 1 FROM prompt_tags AS target WHERE target.prompt_id = source.prompt_id AND target.tag_id = %s)
+        """, (target_id, source_id, target_id))
+        db.cursor.execute("DELETE FROM prompt_tags WHERE tag_id = %s", (source_id,))
+        db.cursor.execute("DELETE FROM tags WHERE id = %s", (source_id,))
+        # Every prompt that had the source now has the target; those that only had the target are rewritten unchanged
+        self._refresh_documents("prompts.id IN (SELECT prompt_id FROM prompt_tags WHERE tag_id = %s)", (target_id,))
+        return affected
+
+    def retag_prompts(self, add: List[str], remove: List[str], tags_list: Optional[List[str]] = None,
+                      classification: Optional[str] = None, query: Optional[str] = None,
+                      all_scopes: bool = True, batch_size: int = 1000) -> int:
+        """
+        Add and remove tags on every prompt matching the filters; returns the number of prompts changed.
+
+        The matching prompts are locked with one query, then handled batch_size at a time with one
+        multi-row statement each for the existing links, the inserts, the deletes and the change log.
+        """
+        db = get_current_db_context()
+        conditions, params = ["1 = 1" if all_scopes else "prompts.author_id IS NULL"], []
+        if tags_list:
+            tag_placeholders = ', '.join(['%s'] * len(tags_list))
+            conditions.append(f"""EXISTS (
+                SELECT 1 FROM prompt_tags JOIN tags ON tags.id = prompt_tags.tag_id
+                WHERE prompt_tags.prompt_id = prompts.id AND tags.tag_name IN ({tag_placeholders}))""")
+            params += tags_list
+        if classification:
+            conditions.append("prompts.classification_id = "
+                              "(SELECT id FROM classifications WHERE classification_name = %s)")
+            params.append(classification)
+        if query:
+            conditions.append("prompts.content LIKE %s")
+            params.append(f"%{query}%")
+        db.cursor.execute(f"""
+            SELECT id, guid, author_id FROM prompts WHERE {' AND '.join(conditions)} ORDER BY id FOR UPDATE
+        """, params)
+        prompts = db.cursor.fetchall()
+
+        add_ids = sorted(set(self._ensure_names('tags', 'tag_name', set(add)).values()))
+        remove_ids = []
+        if remove:
+            db.cursor.execute(f"SELECT id FROM tags WHERE tag_name IN ({', '.join(['%s'] * len(remove))})", remove)
+            remove_ids = sorted(row['id'] for row in db.cursor.fetchall())
+        if not prompts or not (add_ids or remove_ids):
+            return 0
+
+        affected = 0
+        for start in range(0, len(prompts), batch_size):
+            batch = prompts[start:start + batch_size]
+            prompt_ids = [row['id'] for row in batch]
+            id_placeholders = ', '.join(['%s'] * len(prompt_ids))
+            tag_ids = add_ids + remove_ids
+            db.cursor.execute(f"""
+                SELECT prompt_id, tag_id FROM prompt_tags
+                WHERE prompt_id IN ({id_placeholders}) AND tag_id IN ({', '.join(['%s'] * len(tag_ids))})
+            """, prompt_ids + tag_ids)
+            linked = {(row['prompt_id'], row['tag_id']) for row in db.cursor.fetchall()}
+
+            missing = [(prompt_id, tag_id) for prompt_id in prompt_ids for tag_id in add_ids
+                       if (prompt_id, tag_id) not in linked]
+            removed = [(prompt_id, tag_id) for prompt_id, tag_id in linked if tag_id in remove_ids]
+            if missing:
+                db.cursor.executemany("INSERT INTO prompt_tags (prompt_id, tag_id) VALUES (%s, %s)", missing)
+            if removed:
+                db.cursor.execute(f"""
+                    DELETE FROM prompt_tags
+                    WHERE prompt_id IN ({id_placeholders}) AND tag_id IN ({', '.join(['%s'] * len(remove_ids))})
+                """, prompt_ids + remove_ids)
+
+            changed = {prompt_id for prompt_id, _ in missing + removed}
+            if changed:
+                self._refresh_documents(f"prompts.id IN ({', '.join(['%s'] * len(changed))})", tuple(sorted(changed)))
+            self.record_prompt_changes([(guid_from_bytes(row['guid']), row['author_id'], 'update')
+                                        for row in batch if row['id'] in changed])
+            affected += len(changed)
+        return affected
 
-        # Adjust the query based on the presence of the user parameter
-        if user:
-            query = """
-                SELECT prompts.guid FROM prompts 
-                JOIN prompt_tags ON prompts.id = prompt_tags.prompt_id 
-                JOIN tags ON prompt_tags.tag_id = tags.id 
-                WHERE tags.tag_name IN ({}) AND prompts.author_id = %s
-            """.format(', '.join(['%s'] * len(tags_list)))
-            params = (tags_list + [user.id])
+    @staticmethod
+    def _lock_tag(name: str) -> int:
+        db = get_current_db_context()
+        db.cursor.execute("SELECT id FROM tags WHERE tag_name = %s FOR UPDATE", (name,))
+        row = db.cursor.fetchone()
+        if not row:
+            raise RecordNotFoundError(f"Tag '{name}' was not found.")
+        return row['id']
+
+    def _record_tag_changes(self, tag_id: int, batch_size: int = 1000) -> int:
+        """
+        Log an update for every prompt carrying the tag; returns how many were logged. The rows are
+        written with multi-row VALUES inserts of known size, as INSERT ... SELECT reserves AUTO_INCREMENT
+        values in growing blocks and would leave unused seqs that the change log readers wait on.
+        """
+        db = get_current_db_context()
+        db.cursor.execute("""
+            SELECT prompts.guid, prompts.author_id
+            FROM prompt_tags JOIN prompts ON prompts.id = prompt_tags.prompt_id
+            WHERE prompt_tags.tag_id = %s ORDER BY prompts.id LOCK IN SHARE MODE
+        """, (tag_id,))
+        changes = [(guid_from_bytes(row['guid']), row['author_id'], 'update') for row in db.cursor.fetchall()]
+        for start in range(0, len(changes), batch_size):
+            self.record_prompt_changes(changes[start:start + batch_size], tag_renamed=True)
+        return len(changes)
+
+    def add_prompt_usage(self, counts: Dict[str, int]) -> Counter:
+        """
+        Add use counts, keyed by prompt guid, to prompt_usage with one multi-row upsert. Guids of
+        prompts deleted since they were counted are ignored. The uses of authors being moved off this
+        database are held back and returned, keyed by (author id, guid), for the caller to add where
+        the author is placed next.
+        """
+        if not counts:
+            return Counter()
+        db = get_current_db_context()
+        # Keyed by the stored form, which also folds any differently spelled guids of one prompt together
+        uses = Counter()
+        for guid, count in counts.items():
+            uses[guid_to_bytes(guid)] += count
+        uses.pop(None, None)
+        if not uses:
+            return Counter()
+        db.cursor.execute(f"SELECT id, guid, author_id FROM prompts WHERE guid IN ({', '.join(['%s'] * len(uses))})",
+                          list(uses))
+        found = db.cursor.fetchall()
+        # Share-locks the fence like every other write, so the fence waits for this flush to commit
+        moving = self._moving_authors({row['author_id'] for row in found})
+        held = Counter({(row['author_id'], guid_from_bytes(row['guid'])): uses[bytes(row['guid'])]
+                        for row in found if row['author_id'] in moving})
+        now = datetime.now()
+        # Ascending key order, so concurrent flushes from other workers take their row locks in the same order
+        rows = sorted((row['id'], row['author_id'], uses[bytes(row['guid'])], now)
+                      for row in found if row['author_id'] not in moving)
+        if rows:
+            db.cursor.executemany("""
+                INSERT INTO prompt_usage (prompt_id, author_id, use_count, last_used_at) VALUES (%s, %s, %s, %s)
+                AS new ON DUPLICATE KEY UPDATE use_count = prompt_usage.use_count + new.use_count,
+                                               last_used_at = new.last_used_at
+            """, rows)
+        return held
+
+    def record_prompt_change(self, guid: str, author_id: Optional[int], op: str) -> int:
+        """Append a write to the change log, in the caller's transaction, and return its seq."""
+        db = get_current_db_context()
+        self._check_not_moving([author_id])
+        db.cursor.execute("INSERT INTO change_log (prompt_guid, author_id, op) VALUES (%s, %s, %s)",
+                          (guid_to_bytes(guid), author_id, op))
+        return db.cursor.lastrowid
+
+    def record_prompt_changes(self, changes: List[tuple], tag_renamed: bool = False) -> None:
+        """
+        Append (guid, author_id, op) rows to the change log in one statement; `tag_renamed` marks them
+        as logged by a tag rename or merge, for the workers to drop the old name.
+        """
+        if changes:
+            db = get_current_db_context()
+            self._check_not_moving({author_id for _, author_id, _ in changes})
+            db.cursor.executemany("""
+                INSERT INTO change_log (prompt_guid, author_id, op, tag_renamed) VALUES (%s, %s, %s, %s)
+            """, [(guid_to_bytes(guid), author_id, op, tag_renamed) for guid, author_id, op in changes])
+
+    def get_changes_since(self, seq: int, limit: int = 1000) -> List[PromptChange]:
+        """Change log entries after `seq`, oldest first."""
+        db = get_current_db_context()
+        db.cursor.execute("""
+            SELECT seq, prompt_guid, author_id, op, tag_renamed, created_at FROM change_log
+            WHERE seq > %s ORDER BY seq LIMIT %s
+        """, (seq, limit))
+        return [construct_trusted(PromptChange, seq=row['seq'], guid=guid_from_bytes(row['prompt_guid']),
+                                  author=row['author_id'], op=row['op'], created_at=row['created_at'],
+                                  tag_renamed=bool(row['tag_renamed']))
+                for row in db.cursor.fetchall()]
+
+    def get_latest_change_seq(self) -> int:
+        db = get_current_db_context()
+        db.cursor.execute("SELECT COALESCE(MAX(seq), 0) AS seq FROM change_log")
+        return db.cursor.fetchone()['seq']
+
+    def get_prompt_changes(self, since: int, upto: int, limit: int,
+                           user: Optional[User] = None) -> List[PromptChange]:
+        """Change log entries for prompts in the user's scope with since < seq <= upto, oldest first."""
+        db = get_current_db_context()
+        db.cursor.execute("""
+            SELECT seq, prompt_guid, author_id, op, created_at FROM change_log
+            WHERE author_id <=> %s AND seq > %s AND seq <= %s ORDER BY seq LIMIT %s
+        """, (user.id if user else None, since, upto, limit))
+        return [construct_trusted(PromptChange, seq=row['seq'], guid=guid_from_bytes(row['prompt_guid']),
+                                  author=row['author_id'],
+                                  op=row['op'], created_at=row['created_at'])
+                for row in db.cursor.fetchall()]
+
+    def get_change_horizon(self, settle_seconds: float) -> int:
+        """
+        The highest seq up to which the change log is complete: no entry at or below it can still appear.
+
+        Seqs are assigned at insert but become visible at commit, so a hole may yet be filled by a
+        transaction in flight. Such a transaction started before the entry after the hole was written;
+        when no transaction that has written rows has been open that long (per information_schema.innodb_trx)
+        the hole is a rollback. When innodb_trx cannot be read, as it needs the PROCESS privilege, holes
+        older than settle_seconds are taken to be rollbacks; when it can, the entries written since the
+        oldest open write are checked, however long ago it started.
+        """
+        db = get_current_db_context()
+        # Read the open transactions first: the change log read below then sees whatever they committed since
+        readable, oldest_write = self._oldest_open_write()
+        if readable and oldest_write is not None:
+            db.cursor.execute("""
+                SELECT seq, created_at FROM change_log
+                WHERE created_at >= LEAST(NOW() - INTERVAL %s SECOND, %s - INTERVAL %s SECOND) ORDER BY seq
+            """, (settle_seconds, oldest_write, HOLE_CLOCK_MARGIN))
         else:
-            query = """
-                SELECT prompts.guid FROM prompts 
-                JOIN prompt_tags ON prompts.id = prompt_tags.prompt_id 
-                JOIN tags ON prompt_tags.tag_id = tags.id 
-                WHERE tags.tag_name IN ({}) AND prompts.author_id IS NULL
-            """.format(', '.join(['%s'] * len(tags_list)))
-            params = tuple(tags_list)
+            db.cursor.execute("""
+                SELECT seq, created_at FROM change_log WHERE created_at >= NOW() - INTERVAL %s SECOND ORDER BY seq
+            """, (settle_seconds,))
+        recent = db.cursor.fetchall()
+        if not recent:
+            return self.get_latest_change_seq()
+        db.cursor.execute("SELECT MAX(seq) AS seq FROM change_log WHERE seq < %s", (recent[0]['seq'],))
+        previous = db.cursor.fetchone()['seq']
+        expected = previous + 1 if previous is not None else recent[0]['seq']
+        for row in recent:
+            if row['seq'] != expected:
+                settled = readable and (oldest_write is None or
+                                        (oldest_write - row['created_at']).total_seconds() > HOLE_CLOCK_MARGIN)
+                if not settled:
+                    break
+            expected = row['seq'] + 1
+        return expected - 1
+
+    def _oldest_open_write(self) -> Tuple[bool, Optional[datetime]]:
+        """Whether innodb_trx could be read, and when the oldest other transaction that has written rows started."""
+        db = get_current_db_context()
+        try:
+            db.cursor.execute("""
+                SELECT MIN(trx_started) AS started FROM information_schema.innodb_trx
+                WHERE trx_rows_modified > 0 AND trx_mysql_thread_id <> CONNECTION_ID()
+            """)
+        except mysql.connector.Error as e:
+            if e.errno != ER_SPECIFIC_ACCESS_DENIED:
+                raise
+            return False, None
+        return True, db.cursor.fetchone()['started']
+
+    def get_oldest_change_seq(self) -> Optional[int]:
+        db = get_current_db_context()
+        db.cursor.execute("SELECT MIN(seq) AS seq FROM change_log")
+        return db.cursor.fetchone()['seq']
 
-        db.cursor.execute(query, params)
-        prompt_guids = [row['guid'] for row in db.cursor.fetchall()]
+    def get_prompt_contents(self, guids: List[str]) -> List[dict]:
+        """guid/author_id/content rows for the given prompts, in any scope; missing guids are left out."""
+        if not guids:
+            return []
+        db = get_current_db_context()
+        placeholders = ', '.join(['%s'] * len(guids))
+        db.cursor.execute(f"SELECT guid, author_id, content FROM prompts WHERE guid IN ({placeholders})",
+                          [guid_to_bytes(guid) for guid in guids])
+        rows = db.cursor.fetchall()
+        for row in rows:
+            row['guid'] = guid_from_bytes(row['guid'])
+        return rows
+
+    def get_prompt_labels(self, guids: List[str]) -> Dict[str, dict]:
+        """guid -> {'tags': [...], 'classification': ...} for the given prompts, in any scope."""
+        if not guids:
+            return {}
+        db = get_current_db_context()
+        placeholders = ', '.join(['%s'] * len(guids))
+        db.cursor.execute(f"SELECT id, guid, document FROM prompts WHERE guid IN ({placeholders})",
+                          [guid_to_bytes(guid) for guid in guids])
+        rows = db.cursor.fetchall()
+        documents = self._row_documents(rows, ('tags', 'classification'))
+        return {guid_from_bytes(row['guid']): documents[row['id']] for row in rows}
+
+    def get_label_names(self) -> Dict[str, List[Tuple[str, Optional[int]]]]:
+        """
+        The tag and classification names in use, each with every author whose prompts carry it (None
+        for public prompts), as {'tag': [(name, author_id), ...], 'classification': [...]}.
+        """
+        db = get_current_db_context()
+        db.cursor.execute("""
+            SELECT DISTINCT tags.tag_name, prompts.author_id
+            FROM tags JOIN prompt_tags ON prompt_tags.tag_id = tags.id
+                JOIN prompts ON prompts.id = prompt_tags.prompt_id
+        """)
+        tags = [(row['tag_name'], row['author_id']) for row in db.cursor.fetchall()]
+        db.cursor.execute("""
+            SELECT DISTINCT classifications.classification_name, prompts.author_id
+            FROM classifications JOIN prompts ON prompts.classification_id = classifications.id
+        """)
+        return {'tag': tags,
+                'classification': [(row['classification_name'], row['author_id']) for row in db.cursor.fetchall()]}
+
+    def get_tag_names(self) -> List[str]:
+        """Every tag name, used or not."""
+        db = get_current_db_context()
+        db.cursor.execute("SELECT tag_name FROM tags")
+        return [row['tag_name'] for row in db.cursor.fetchall()]
+
+    def prune_changes(self, retention_days: int, batch_size: int = 10000) -> int:
+        """
+        Delete one batch of change log entries older than the retention period; returns the count.
+        The newest entry is always kept, so the log still knows the latest seq after a quiet spell.
+        """
+        db = get_current_db_context()
+        latest = self.get_latest_change_seq()
+        db.cursor.execute("""
+            DELETE FROM change_log WHERE created_at < NOW() - INTERVAL %s DAY AND seq < %s ORDER BY seq LIMIT %s
+        """, (retention_days, latest, batch_size))
+        return db.cursor.rowcount
+
+    @classmethod
+    def _check_not_moving(cls, author_ids) -> None:
+        """
+        Refuse a write for authors the rebalance is moving off this shard. Every sharded write
+        transaction ends with this share-locking read, so the fence cannot be raised while one is
+        in flight, and none can commit once it is up.
+        """
+        if cls._moving_authors(author_ids):
+            raise ServiceUnavailableError("These prompts are being moved to another database, please retry shortly.",
+                                          retry_after=5)
 
-        # Map guids to their full details
-        return [self.get_prompt(guid, user) for guid in prompt_guids]
-    def get_prompts_by_classification(self, classification: str, user: Optional[User] = None) -> List[Prompt]:
+    @staticmethod
+    def _moving_authors(author_ids) -> Set[int]:
+        """The authors among these whose writes are fenced off this shard, share-locking their move rows."""
+        author_ids = [author_id for author_id in author_ids if author_id is not None]
+        if not shard_router.sharded or not author_ids:
+            return set()
+        db = get_current_db_context()
+        db.cursor.execute(f"""
+            SELECT author_id, state FROM shard_moves WHERE author_id IN ({', '.join(['%s'] * len(author_ids))})
+            LOCK IN SHARE MODE
+        """, author_ids)
+        return {row['author_id'] for row in db.cursor.fetchall() if row['state'] == 'fenced'}
+
+    def count_prompts(self) -> Dict[str, int]:
+        """The prompts on this database, how many are public, and how many authors they have."""
+        db = get_current_db_context()
+        db.cursor.execute("""
+            SELECT COUNT(*) AS prompts, COUNT(*) - COUNT(author_id) AS public, COUNT(DISTINCT author_id) AS authors
+            FROM prompts
+        """)
+        return {name: int(value) for name, value in db.cursor.fetchone().items()}
+
+    def get_author_ids(self) -> List[int]:
+        """The authors with prompts on this database."""
         db = get_current_db_context()
+        db.cursor.execute("SELECT DISTINCT author_id FROM prompts WHERE author_id IS NOT NULL ORDER BY author_id")
+        return [row['author_id'] for row in db.cursor.fetchall()]
 
-        # Fetch prompt guids that have the given classification
-        # Adjust the query based on the presence of the user parameter
-        if user:
-            db.cursor.execute("""
-                    SELECT prompts.guid FROM prompts 
-                    JOIN classifications ON prompts.classification_id = classifications.id 
-                    WHERE classifications.classification_name = %s AND prompts.author_id = %s
-                """, (classification, user.id))
+    def get_prompt_history(self, guids: List[str]) -> Dict[str, dict]:
+        """guid -> {'revisions': [...], 'use_count': ..., 'last_used_at': ...}, for copying prompts elsewhere."""
+        if not guids:
+            return {}
+        db = get_current_db_context()
+        placeholders = ', '.join(['%s'] * len(guids))
+        keys = [guid_to_bytes(guid) for guid in guids]
+        history = {}
+        db.cursor.execute(f"""
+            SELECT prompts.guid, prompt_revisions.revision, prompt_revisions.is_snapshot, prompt_revisions.body,
+                   prompt_revisions.created_at
+            FROM prompt_revisions JOIN prompts ON prompts.id = prompt_revisions.prompt_id
+            WHERE prompts.guid IN ({placeholders}) ORDER BY prompt_revisions.prompt_id, prompt_revisions.revision
+        """, keys)
+        for row in db.cursor.fetchall():
+            entry = history.setdefault(guid_from_bytes(row.pop('guid')), {'revisions': []})
+            entry['revisions'].append(row)
+        for guid, usage in self.get_usage_counts(guids).items():
+            history.setdefault(guid, {'revisions': []}).update(usage)
+        return history
+
+    def put_prompt_history(self, history: Dict[str, dict]) -> None:
+        """Replace the revisions and use counts of prompts with those read by get_prompt_history."""
+        if not history:
+            return
+        db = get_current_db_context()
+        ids = self._ids_by_guid('prompts', [guid_to_bytes(guid) for guid in history])
+        prompt_ids = {guid: ids[guid_to_bytes(guid)] for guid in history if guid_to_bytes(guid) in ids}
+        if not prompt_ids:
+            return
+        db.cursor.execute(f"DELETE FROM prompt_revisions WHERE prompt_id IN ({', '.join(['%s'] * len(prompt_ids))})",
+                          list(prompt_ids.values()))
+        revisions = [(prompt_ids[guid], row['revision'], row['is_snapshot'], row['body'], row['created_at'])
+                     for guid, entry in history.items() if guid in prompt_ids for row in entry['revisions']]
+        if revisions:
+            db.cursor.executemany("""
+                INSERT INTO prompt_revisions (prompt_id, revision, is_snapshot, body, created_at)
+                VALUES (%s, %s, %s, %s, %s)
+            """, revisions)
+        self.put_usage_counts({guid: entry for guid, entry in history.items() if 'use_count' in entry})
+
+    def get_usage_counts(self, guids: List[str]) -> Dict[str, dict]:
+        """guid -> {'use_count': ..., 'last_used_at': ...} of the prompts with a prompt_usage row."""
+        if not guids:
+            return {}
+        db = get_current_db_context()
+        db.cursor.execute(f"""
+            SELECT prompts.guid, prompt_usage.use_count, prompt_usage.last_used_at
+            FROM prompt_usage JOIN prompts ON prompts.id = prompt_usage.prompt_id
+            WHERE prompts.guid IN ({', '.join(['%s'] * len(guids))})
+        """, [guid_to_bytes(guid) for guid in guids])
+        return {guid_from_bytes(row['guid']): {'use_count': row['use_count'], 'last_used_at': row['last_used_at']}
+                for row in db.cursor.fetchall()}
+
+    def put_usage_counts(self, usage: Dict[str, dict]) -> None:
+        """Overwrite the use counts of prompts with those read by get_usage_counts."""
+        if not usage:
+            return
+        db = get_current_db_context()
+        ids = self._ids_by_guid('prompts', [guid_to_bytes(guid) for guid in usage])
+        rows = [(entry['use_count'], entry['last_used_at'], ids[guid_to_bytes(guid)])
+                for guid, entry in usage.items() if guid_to_bytes(guid) in ids]
+        if rows:
+            db.cursor.executemany("UPDATE prompt_usage SET use_count = %s, last_used_at = %s WHERE prompt_id = %s",
+                                  rows)
+
+    def purge_prompts(self, guids: List[str]) -> int:
+        """
+        Delete prompts without logging the deletes, for prompts that live on in another database;
+        returns how many were found.
+        """
+        if not guids:
+            return 0
+        db = get_current_db_context()
+        prompt_ids = list(self._ids_by_guid('prompts', [guid_to_bytes(guid) for guid in guids]).values())
+        if not prompt_ids:
+            return 0
+        placeholders = ', '.join(['%s'] * len(prompt_ids))
+        for table in ('prompt_io_variables', 'prompt_tags', 'prompt_revisions', 'prompt_usage'):
+            db.cursor.execute(f"DELETE FROM {table} WHERE prompt_id IN ({placeholders})", prompt_ids)
+        db.cursor.execute(f"DELETE FROM prompts WHERE id IN ({placeholders})", prompt_ids)
+        return len(prompt_ids)
+
+    def fence_author(self, author_id: int, target: int) -> None:
+        """Stop writes for the author on this database; waits for those in flight to commit."""
+        db = get_current_db_context()
+        db.cursor.execute("""
+            INSERT INTO shard_moves (author_id, target, state) VALUES (%s, %s, 'fenced') AS new
+            ON DUPLICATE KEY UPDATE target = new.target, state = new.state
+        """, (author_id, target))
+
+    def unfence_author(self, author_id: int) -> None:
+        db = get_current_db_context()
+        db.cursor.execute("DELETE FROM shard_moves WHERE author_id = %s", (author_id,))
+
+    def begin_author_move(self, author_id: int, target: int) -> None:
+        """Record a move before anything is copied, so an interrupted one can be resumed or aborted."""
+        db = get_current_db_context()
+        db.cursor.execute("INSERT INTO shard_moves (author_id, target, state) VALUES (%s, %s, 'copying')",
+                          (author_id, target))
+
+    def get_author_move(self, author_id: int) -> Optional[dict]:
+        """The author's recorded move off this database, with its target and state, if there is one."""
+        db = get_current_db_context()
+        db.cursor.execute("SELECT target, state FROM shard_moves WHERE author_id = %s", (author_id,))
+        return db.cursor.fetchone()
+
+    @staticmethod
+    def _ensure_names(table, column, names):
+        """Insert the missing names into a tags-like dictionary table and return a name -> id map."""
+        db = get_current_db_context()
+        if not names:
+            return {}
+        names = sorted(names)
+        # Join against the requested spellings so the table's collation decides what matches
+        requested = ' UNION ALL '.join(['SELECT %s AS name'] * len(names))
+        query = f"""
+            SELECT requested.name, {table}.id FROM ({requested}) AS requested
+            JOIN {table} ON {table}.{column} = requested.name
+        """
+        db.cursor.execute(query, names)
+        ids = {row['name']: row['id'] for row in db.cursor.fetchall()}
+        missing = [name for name in names if name not in ids]
+        if missing:
+            db.cursor.executemany(
+                f"INSERT INTO {table} ({column}) VALUES (%s) AS new ON DUPLICATE KEY UPDATE {column}=new.{column}",
+                [(name,) for name in missing])
+            db.cursor.execute(query, names)
+            ids = {row['name']: row['id'] for row in db.cursor.fetchall()}
+        return ids
+
+    @staticmethod
+    def _ids_by_guid(table, guids):
+        """Stored guid bytes -> id for the rows of a table with a guid column."""
+        db = get_current_db_context()
+        db.cursor.execute(f"SELECT id, guid FROM {table} WHERE guid IN ({', '.join(['%s'] * len(guids))})", guids)
+        return {bytes(row['guid']): row['id'] for row in db.cursor.fetchall()}
+
+    def get_prompts_by_guids(self, guids: List[str], user: Optional[User] = None,
+                             options: Optional[PromptQueryOptions] = None) -> List[Union[Prompt, PromptFields]]:
+        """Fetch prompts in scope by guid, in the order given; guids not found are left out."""
+        if not guids:
+            return []
+        where, params = self._author_scope(user)
+        where = f"prompts.guid IN ({', '.join(['%s'] * len(guids))}) AND {where}"
+        params = tuple(guid_to_bytes(guid) for guid in guids) + params
+        if options and options.fields:
+            prompts = self._select_prompts(where, params,
+                                           options.model_copy(update={'skip': 0, 'limit': None, 'sort': 'id'}))
         else:
-            db.cursor.execute("""
-                    SELECT prompts.guid FROM prompts 
-                    JOIN classifications ON prompts.classification_id = classifications.id 
-                    WHERE classifications.classification_name = %s AND prompts.author_id IS NULL
-                """, (classification,))
-        prompt_guids = [row['guid'] for row in db.cursor.fetchall()]
-
-        # Map guids to their full details
-        return [self.get_prompt(guid, user) for guid in prompt_guids]
+            db = get_current_db_context()
+            where, params = self._length_filter(where, params, options)
+            db.cursor.execute(f"SELECT prompts.* FROM prompts WHERE {where}", params)
+            prompts = self.hydrate_prompts(db.cursor.fetchall())
+        by_guid = {prompt.guid: prompt for prompt in prompts}
+        return [by_guid[guid] for guid in guids if guid in by_guid]
+
+    # Columns for each sparse scalar field; content is only read when asked for. Variables, tags
+    # and classification are taken from the document, so a ?fields= read stays a single statement
+    _DOCUMENT_FIELDS = ('input_variables', 'output_variables', 'tags', 'classification')
+    _FIELD_COLUMNS = {
+        'id': "prompts.id",
+        'guid': "prompts.guid",
+        'content': "prompts.content",
+        'author': "prompts.author_id AS author",
+        'created_at': "prompts.created_at",
+        'updated_at': "prompts.updated_at",
+        'char_count': "prompts.char_count",
+        'token_count': "prompts.token_count",
+        'input_variable_count': "prompts.input_variable_count",
+        'output_variable_count': "prompts.output_variable_count",
+    }
+
+    def _query_prompts(self, where: str, params: tuple, options: Optional[PromptQueryOptions],
+                       user: Optional[User]) -> List[Union[Prompt, PromptFields]]:
+        """Read the prompts matching `where` in the requested order and page, with all or only the requested fields."""
+        options = options or PromptQueryOptions()
+        if options.fields:
+            return self._select_prompts(where, params, options, user)
+        db = get_current_db_context()
+        source, where, params, order = self._ordering(where, params, options, user)
+        page, page_params = self._page_clause(options)
+        db.cursor.execute(f"SELECT prompts.* FROM {source} WHERE {where} ORDER BY {order}{page}",
+                          params + page_params)
+        # Each row carries its document; only rows without one need the child tables
+        return self.hydrate_prompts(db.cursor.fetchall())
+
+    # Sorts read in the order of an (author_id, <column>, id) index
+    _LENGTH_SORTS = {'tokens': "prompts.token_count", 'chars': "prompts.char_count"}
+
+    @staticmethod
+    def _length_filter(where: str, params: tuple, options: Optional[PromptQueryOptions]):
+        """Add the token budget filters to a WHERE fragment; a range on prompts_I4 within the author scope."""
+        if options and options.min_tokens is not None:
+            where, params = f"{where} AND prompts.token_count >= %s", params + (options.min_tokens,)
+        if options and options.max_tokens is not None:
+            where, params = f"{where} AND prompts.token_count <= %s", params + (options.max_tokens,)
+        return where, params
+
+    def _ordering(self, where: str, params: tuple, options: PromptQueryOptions, user: Optional[User]):
+        """The FROM clause, WHERE fragment and params with the token filters, and ORDER BY for the requested sort."""
+        where, params = self._length_filter(where, params, options)
+        if options.sort in self._LENGTH_SORTS:
+            return "prompts", where, params, f"{self._LENGTH_SORTS[options.sort]}, prompts.id"
+        if options.sort == 'popular':
+            # Walks prompt_usage_I1 for the scope, most used first, joining each prompt by its key
+            scope, scope_params = self._author_scope(user, 'prompt_usage')
+            return ("prompt_usage JOIN prompts ON prompts.id = prompt_usage.prompt_id", f"{scope} AND {where}",
+                    scope_params + params, "prompt_usage.use_count DESC, prompt_usage.prompt_id")
+        return "prompts", where, params, "prompts.id"
+
+    def _select_prompts(self, where: str, params: tuple, options: PromptQueryOptions,
+                        user: Optional[User] = None) -> List[PromptFields]:
+        """Read only the requested fields of the prompts matching `where`, in the requested order."""
+        db = get_current_db_context()
+        try:
+            fields = set(options.fields)
+            document_fields = [field for field in self._DOCUMENT_FIELDS if field in fields]
+            columns = ["prompts.id AS prompt_id"] + [self._FIELD_COLUMNS[field]
+                                                     for field in self._FIELD_COLUMNS if field in fields]
+            if document_fields:
+                columns.append("prompts.document")
+            source, where, params, order = self._ordering(where, params, options, user)
+            page, page_params = self._page_clause(options)
+            db.cursor.execute(f"SELECT {', '.join(columns)} FROM {source} WHERE {where} ORDER BY {order}{page}",
+                              params + page_params)
+            rows = db.cursor.fetchall()
+
+            documents = {}
+            if rows and document_fields:
+                documents = self._row_documents([{'id': row['prompt_id'], 'document': row.pop('document')}
+                                                 for row in rows], document_fields)
+
+            prompts = []
+            for row in rows:
+                row.update(documents.get(row.pop('prompt_id'), {}))
+                if 'guid' in row:
+                    row['guid'] = guid_from_bytes(row['guid'])
+                prompts.append(construct_trusted(PromptFields, **row))
+            return prompts
+        except Exception as e:
+            traceback.print_exc()
+            raise DataValidationError(message=f"Error occurred while reading prompt fields: {e}")
+
+    @staticmethod
+    def _page_clause(options: PromptQueryOptions):
+        if options.limit is None:
+            return "", ()
+        return " LIMIT %s OFFSET %s", (options.limit, options.skip)
+
+    def _get_prompt_id(self, guid: str, user: Optional[User] = None) -> int:
+        db = get_current_db_context()
+        where, params = self._author_scope(user)
+        db.cursor.execute(f"SELECT id FROM prompts WHERE guid = %s AND {where}", (guid_to_bytes(guid),) + params)
+        row = db.cursor.fetchone()
+        if not row:
+            raise RecordNotFoundError(f"Prompt {guid} was not found.")
+        return row['id']
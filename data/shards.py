@@ -0,0 +1,154 @@
+"""
+Routing of prompts to databases by author.
+
+Each author's prompts live on one shard, and the public prompts on PUBLIC_SHARD. Where an author
+lives is recorded in the shard_directory table on the primary (shard 0). An author without an
+entry is placed by a consistent-hash ring over the shards and pinned there by their first write,
+so adding a shard never moves anyone implicitly; the rebalance command moves authors to where the
+ring now places them (see service/sharding.py). Lookups are cached for DIRECTORY_TTL seconds.
+
+With a single database everything is on shard 0 and the directory is never read.
+"""
+import bisect
+import contextvars
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+from . import DatabaseContext, SHARD_COUNT
+
+T = TypeVar('T')
+
+PUBLIC_SHARD = int(os.getenv('DB_PUBLIC_SHARD', '0'))  # Holds the public prompts
+DIRECTORY_TTL = float(os.getenv('SHARD_DIRECTORY_TTL', '5'))  # Seconds a worker may route by a stale entry
+VIRTUAL_NODES = 512  # Ring points per shard; fewer leave shards up to a third apart in authors
+MAX_CACHED = 100000  # Directory entries cached per worker before the cache is emptied
+CURSOR_STRIDE = 64  # Change log cursors given to clients carry their shard: seq * CURSOR_STRIDE + shard
+
+if SHARD_COUNT > CURSOR_STRIDE:
+    raise ValueError(f"At most {CURSOR_STRIDE} shards are supported, {SHARD_COUNT} are configured.")
+if not 0 <= PUBLIC_SHARD < SHARD_COUNT:
+    raise ValueError(f"DB_PUBLIC_SHARD={PUBLIC_SHARD} is not one of the {SHARD_COUNT} configured shards.")
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Author ids hashed onto shards; a new shard takes authors from each of the others in proportion."""
+
+    def __init__(self, shards: int, virtual_nodes: int = VIRTUAL_NODES):
+        points = sorted((_hash(f"{shard}:{node}"), shard) for shard in range(shards) for node in range(virtual_nodes))
+        self.keys = [key for key, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard_for(self, author_id: int) -> int:
+        return self.shards[bisect.bisect(self.keys, _hash(str(author_id))) % len(self.keys)]
+
+
+class ShardRouter:
+    def __init__(self, count: int = SHARD_COUNT, public_shard: int = PUBLIC_SHARD, ttl: float = DIRECTORY_TTL):
+        self.count = count
+        self.public_shard = public_shard
+        self.ttl = ttl
+        self.ring = HashRing(count)
+        self.lock = threading.Lock()
+        self._cache: Dict[int, Tuple[Optional[int], float]] = {}  # author id -> (shard or None, read at)
+
+    @property
+    def sharded(self) -> bool:
+        return self.count > 1
+
+    def shard_for(self, author_id: Optional[int], write: bool = False) -> int:
+        """The shard of an author's prompts, or of the public ones for None. A write pins an unplaced author."""
+        if author_id is None:
+            return self.public_shard
+        if not self.sharded:
+            return 0
+        shard = self._lookup(author_id)
+        if shard is None:
+            shard = self.ring.shard_for(author_id)
+            if write:
+                shard = self._pin(author_id, shard)
+        return shard
+
+    def _lookup(self, author_id: int) -> Optional[int]:
+        cached = self._cache.get(author_id)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            return cached[0]
+        shard = self.placement(author_id)
+        self._remember(author_id, shard)
+        return shard
+
+    def placement(self, author_id: int) -> Optional[int]:
+        """The shard the directory pins an author to, read now rather than from the cache."""
+        with DatabaseContext() as db:
+            db.cursor.execute("SELECT shard FROM shard_directory WHERE author_id = %s", (author_id,))
+            row = db.cursor.fetchone()
+        return row['shard'] if row else None
+
+    def _pin(self, author_id: int, shard: int) -> int:
+        with DatabaseContext() as db:
+            # Another worker may have pinned the author meanwhile, or the rebalance moved them
+            db.cursor.execute("""
+                INSERT INTO shard_directory (author_id, shard) VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE author_id = author_id
+            """, (author_id, shard))
+            db.cursor.execute("SELECT shard FROM shard_directory WHERE author_id = %s", (author_id,))
+            shard = db.cursor.fetchone()['shard']
+            db.commit_transaction()
+        self._remember(author_id, shard)
+        return shard
+
+    def _remember(self, author_id: int, shard: Optional[int]) -> None:
+        with self.lock:
+            if len(self._cache) >= MAX_CACHED:
+                self._cache.clear()
+            self._cache[author_id] = (shard, time.monotonic())
+
+    def place(self, author_id: int, shard: int) -> None:
+        """Point the directory entry of an author at a shard; other workers follow within DIRECTORY_TTL."""
+        with DatabaseContext() as db:
+            db.cursor.execute("""
+                INSERT INTO shard_directory (author_id, shard) VALUES (%s, %s) AS new
+                ON DUPLICATE KEY UPDATE shard = new.shard
+            """, (author_id, shard))
+            db.commit_transaction()
+        self._remember(author_id, shard)
+
+    def directory(self) -> Dict[int, int]:
+        """Every pinned author id -> shard."""
+        with DatabaseContext() as db:
+            db.cursor.execute("SELECT author_id, shard FROM shard_directory")
+            return {row['author_id']: row['shard'] for row in db.cursor.fetchall()}
+
+
+shard_router = ShardRouter()
+
+
+def fan_out(work: Callable[[int], T], shards: Optional[Iterable[int]] = None) -> List[T]:
+    """
+    Run `work(shard)` for every shard (or the given ones) at once, each on its own thread with
+    the caller's context, and return the results in shard order. A failure is raised once all
+    of them have finished.
+    """
+    shards = list(range(SHARD_COUNT)) if shards is None else list(shards)
+    if len(shards) == 1:
+        return [work(shards[0])]
+    with ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix='shard') as executor:
+        futures = [executor.submit(contextvars.copy_context().run, work, shard) for shard in shards]
+    return [future.result() for future in futures]
+
+
+def encode_cursor(seq: int, shard: int) -> int:
+    """A change log position as handed to clients; with a single database it is the seq itself."""
+    return seq * CURSOR_STRIDE + shard if SHARD_COUNT > 1 else seq
+
+
+def decode_cursor(cursor: int) -> Tuple[int, int]:
+    """The (seq, shard) of a cursor from encode_cursor."""
+    return divmod(cursor, CURSOR_STRIDE) if SHARD_COUNT > 1 else (cursor, 0)
@@ -1,6 +1,7 @@
 import traceback
 from typing import Optional
 
+from core import guid_from_bytes
 from core.models import User
 from data import get_current_db_context
 
@@ -21,7 +22,8 @@ class MySQLUserRepository(UserRepositoryInterface):
                 return None
             else:
                 row = user_rows[0]
-                return User(id=row['id'], guid=row['guid'], username=row['username'], password=row['password'])
+                return User(id=row['id'], guid=guid_from_bytes(row['guid']), username=row['username'],
+                            password=row['password'])
         except Exception as e:
             traceback.print_exc()
             return None
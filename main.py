@@ -1,31 +1,125 @@
+import os
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 
-from core.exceptions import PromptException, EXCEPTION_STATUS_CODES
-from web.middleware import LoggingMiddleware, RequestIdMiddleware
-from web.routers import public_prompts, private_prompts
+from core.exceptions import PromptException, EXCEPTION_STATUS_CODES, DeadlineExceededError, \
+    ServiceUnavailableError, find_in_chain
+from core.models import PromptQueryOptions
+from data import init_db_pool, close_db_pool
+from data.prompt_repository import MySQLPromptRepository
+from service.coherence import change_poller, refresh_content_indexes
+from service.content_index import content_indexes
+from service.events import event_publisher
+from service.prompt_service import PromptService
+from service.public_replica import public_replica, refresh_public_replica
+from service.tracing import tracer
+from service.trigram_index import name_index, refresh_names
+from service.usage import usage_counters
+from service.vector_index import vector_index
+from web.middleware import DeadlineMiddleware, LoggingMiddleware, ProfilingMiddleware, RequestIdMiddleware, \
+    RouteSpanMiddleware, TracingMiddleware
+from web.routers import admin, public_prompts, private_prompts
 
-app = FastAPI()
+# Build the content indexes and run the hot queries before reporting ready, instead of on first use
+PRELOAD_CACHES = os.getenv('PRELOAD_CACHES', 'false').lower() in ('1', 'true', 'yes')
+PRELOAD_PUBLIC_PROMPTS = int(os.getenv('PRELOAD_PUBLIC_PROMPTS', '100'))
+
+ready = threading.Event()
+
+
+def preload_caches():
+    repo = MySQLPromptRepository()
+    service = PromptService(repo)
+    with ThreadPoolExecutor(thread_name_prefix='preload') as executor:
+        tasks = [executor.submit(index.ensure_loaded, repo) for index in content_indexes]
+        tasks.append(executor.submit(name_index.ensure_loaded, repo))
+        if public_replica.enabled:
+            tasks.append(executor.submit(public_replica.ensure_loaded, repo))
+        # Tag and classification dictionaries, and the first page of public prompts
+        tasks.append(executor.submit(service.get_facets))
+        tasks.append(executor.submit(service.list_prompts, None, PromptQueryOptions(limit=PRELOAD_PUBLIC_PROMPTS)))
+    for task in tasks:
+        task.result()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    await run_in_threadpool(init_db_pool)
+    pool_ready = time.perf_counter()
+    # Follow the change log so writes made by other workers reach this worker's indexes
+    repo = MySQLPromptRepository()
+    change_poller.subscribe(lambda changes: refresh_content_indexes(repo, changes))
+    change_poller.subscribe(lambda changes: refresh_names(repo, changes))
+    change_poller.subscribe(lambda changes: refresh_public_replica(repo, changes))
+    change_poller.subscribe(event_publisher.submit)
+    await run_in_threadpool(change_poller.start, repo)
+    usage_counters.start(repo)
+    event_publisher.start(repo)
+    if PRELOAD_CACHES:
+        await run_in_threadpool(preload_caches)
+    else:
+        # Rebuild semantic search vectors from MySQL in the background; queries wait for it to finish
+        threading.Thread(target=vector_index.ensure_loaded, args=(MySQLPromptRepository(),), daemon=True).start()
+        if public_replica.enabled:
+            public_replica.start(repo)
+    finished = time.perf_counter()
+    print(f"startup: pool warm {pool_ready - started:.3f}s, preload {finished - pool_ready:.3f}s, "
+          f"total {finished - started:.3f}s")
+    ready.set()
+    yield
+    ready.clear()
+    change_poller.stop()
+    event_publisher.stop()
+    usage_counters.stop()
+    tracer.exporter.stop()
+    close_db_pool()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Register routers
 
 # Include the router with a prefix
 app.include_router(public_prompts.router, prefix="/public", tags=["Public Endpoints"])
 app.include_router(private_prompts.router, prefix="/private", tags=["Private Per-user Endpoints"])
+app.include_router(admin.router, prefix="/admin", tags=["Admin Endpoints"])
 
 # Innermost first
+app.add_middleware(RouteSpanMiddleware)
+app.add_middleware(DeadlineMiddleware)
 app.add_middleware(LoggingMiddleware)
+app.add_middleware(TracingMiddleware)
 app.add_middleware(RequestIdMiddleware)
+app.add_middleware(ProfilingMiddleware)
+
+
+@app.get("/ready", tags=["Health"], summary="Readiness Probe")
+def readiness():
+    # 503 until the pool is warm (and caches are preloaded, if configured)
+    if not ready.is_set():
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    return {"status": "ready"}
 
 
 @app.exception_handler(PromptException)
 async def handle_prompt_exception(request, exc: PromptException):
+    # Timeouts and overload keep their status even when a layer below wrapped them
+    exc = find_in_chain(exc, (DeadlineExceededError, ServiceUnavailableError)) or exc
     # Get the status code from our mapping or default to 500 if not found
     status_code = EXCEPTION_STATUS_CODES.get(type(exc), 500)
     traceback_string = traceback.format_exc()
-    return JSONResponse(status_code=status_code, content={"detail": str(exc), "traceback": traceback_string})
+    retry_after = getattr(exc, "retry_after", None)
+    headers = {"Retry-After": str(retry_after)} if retry_after is not None else None
+    return JSONResponse(status_code=status_code, content={"detail": str(exc), "traceback": traceback_string},
+                        headers=headers)
 
 
 @app.exception_handler(Exception)
@@ -0,0 +1,185 @@
+import io
+from typing import BinaryIO, Iterator, List, Optional
+
+from core import normalize_guid
+from core.exceptions import DataValidationError
+from core.models import Prompt, PromptRecord, ImportResult, User
+from data import DatabaseContext, SHARD_COUNT
+from data.prompt_repository import PromptRepositoryInterface
+from data.shards import shard_router
+from .content_index import index_prompt
+from .transaction import run_in_transaction
+
+CATALOG_FORMATS = ('ndjson', 'parquet')
+BATCH_SIZE = 1000
+
+
+class CatalogServiceInterface:
+
+    def export_prompts(self, fmt: str = 'ndjson', user: Optional[User] = None,
+                       all_scopes: bool = False) -> Iterator[bytes]:
+        pass
+
+    def import_prompts(self, source: BinaryIO, fmt: str = 'ndjson') -> ImportResult:
+        pass
+
+
+class CatalogService(CatalogServiceInterface):
+    """Streams the prompt catalog to and from NDJSON or Parquet files in constant memory."""
+
+    def __init__(self, repository: PromptRepositoryInterface):
+        self.repo = repository
+
+    def export_prompts(self, fmt: str = 'ndjson', user: Optional[User] = None,
+                       all_scopes: bool = False) -> Iterator[bytes]:
+        """
+        Export prompts with their variables, tags and classification as a stream of byte chunks.
+
+        Args:
+            fmt (str): 'ndjson' (one prompt per line) or 'parquet' (one row group per batch).
+            user (User): Export this user's prompts instead of the public ones.
+            all_scopes (bool): Export every prompt regardless of author.
+
+        Raises:
+            DataValidationError: If the format is unknown or its library is not installed.
+        """
+        self._check_format(fmt)
+        batches = self._hydrated_batches(user, all_scopes)
+        return _ndjson_chunks(batches) if fmt == 'ndjson' else _parquet_chunks(batches)
+
+    def import_prompts(self, source: BinaryIO, fmt: str = 'ndjson') -> ImportResult:
+        """
+        Import an export file, committing one chunk of BATCH_SIZE prompts per transaction.
+
+        Prompts keep their guids; those already present are skipped, so an interrupted import
+        can simply be run again. Each prompt goes to its author's shard, and is only skipped
+        if already present there.
+
+        Raises:
+            DataValidationError: If the format is unknown or a record is invalid.
+            ConstraintViolationError: If a database constraint is violated.
+        """
+        self._check_format(fmt)
+        batches = _read_ndjson(source) if fmt == 'ndjson' else _read_parquet(source)
+
+        imported = skipped = 0
+        for batch in batches:
+            by_shard = {}
+            for record in batch:
+                record.guid = normalize_guid(record.guid)
+                by_shard.setdefault(shard_router.shard_for(record.author, write=True), []).append(record)
+            for shard, records in by_shard.items():
+                def insert():
+                    inserted = self.repo.bulk_insert_prompts(records)
+                    # Other workers index these from the change log; here they are indexed below
+                    self.repo.record_prompt_changes([(record.guid, record.author, 'create') for record in inserted])
+                    return inserted
+
+                inserted = run_in_transaction(insert, "An unexpected error occurred while importing prompts.",
+                                              shard=shard)
+                for record in inserted:
+                    index_prompt(record.guid, record.author, record.content)
+                imported += len(inserted)
+                skipped += len(records) - len(inserted)
+
+        return ImportResult(imported=imported, skipped=skipped)
+
+    def _hydrated_batches(self, user: Optional[User], all_scopes: bool) -> Iterator[List[Prompt]]:
+        shards = range(SHARD_COUNT) if all_scopes else [shard_router.shard_for(user.id if user else None)]
+        for shard in shards:
+            for rows in self.repo.stream_prompt_rows(user, all_scopes, BATCH_SIZE, shard):
+                # A short-lived context per batch: the generator may resume on a different thread
+                with DatabaseContext(shard):
+                    prompts = self.repo.hydrate_prompts(rows)
+                yield prompts
+
+    @staticmethod
+    def _check_format(fmt: str) -> None:
+        if fmt not in CATALOG_FORMATS:
+            raise DataValidationError(f"Unknown catalog format '{fmt}', expected one of {', '.join(CATALOG_FORMATS)}.")
+        if fmt == 'parquet':
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise DataValidationError("The parquet format requires the optional pyarrow package.")
+
+
+def _ndjson_chunks(batches: Iterator[List[Prompt]]) -> Iterator[bytes]:
+    for prompts in batches:
+        yield ''.join(prompt.model_dump_json() + '\n' for prompt in prompts).encode('utf-8')
+
+
+def _read_ndjson(source: BinaryIO) -> Iterator[List[PromptRecord]]:
+    records = []
+    for number, line in enumerate(source, start=1):
+        if not line.strip():
+            continue
+        try:
+            records.append(PromptRecord.model_validate_json(line))
+        except ValueError as e:
+            raise DataValidationError(f"Invalid prompt record on line {number}: {e}")
+        if len(records) == BATCH_SIZE:
+            yield records
+            records = []
+    if records:
+        yield records
+
+
+def _parquet_schema():
+    import pyarrow as pa
+
+    variable = pa.struct([('name', pa.string()), ('description', pa.string()),
+                          ('type', pa.string()), ('expected_format', pa.string())])
+    return pa.schema([('guid', pa.string()), ('content', pa.string()), ('author', pa.int64()),
+                      ('classification', pa.string()), ('tags', pa.list_(pa.string())),
+                      ('input_variables', pa.list_(variable)), ('output_variables', pa.list_(variable)),
+                      ('created_at', pa.timestamp('us')), ('updated_at', pa.timestamp('us'))])
+
+
+class _DrainableSink(io.RawIOBase):
+    """A write-only file that hands out what was written so far, while reporting the total offset."""
+
+    def __init__(self):
+        super().__init__()
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def drain(self) -> bytes:
+        data, self.buffer = bytes(self.buffer), bytearray()
+        return data
+
+
+def _parquet_chunks(batches: Iterator[List[Prompt]]) -> Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _parquet_schema()
+    sink = _DrainableSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for prompts in batches:
+        writer.write_table(pa.Table.from_pylist([prompt.model_dump(exclude={'id'}) for prompt in prompts],
+                                                schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def _read_parquet(source: BinaryIO) -> Iterator[List[PromptRecord]]:
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(source).iter_batches(batch_size=BATCH_SIZE):
+        try:
+            yield [PromptRecord.model_validate(row) for row in batch.to_pylist()]
+        except ValueError as e:
+            raise DataValidationError(f"Invalid prompt record: {e}")
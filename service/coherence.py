@@ -0,0 +1,204 @@
+import os
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List, Optional, Set
+
+from core.models import PromptChange
+from data import DatabaseContext, SHARD_COUNT
+from .content_index import index_prompt, unindex_prompt
+from .metrics import metrics
+
+POLL_INTERVAL = float(os.getenv('CHANGE_POLL_INTERVAL', '1.0'))  # Seconds between reads of the change log
+POLL_BATCH_SIZE = int(os.getenv('CHANGE_POLL_BATCH_SIZE', '1000'))
+# Without the PROCESS privilege to read innodb_trx, a seq missing from the log this long after a later one
+# appeared is taken to belong to a rolled back transaction
+GAP_TIMEOUT = float(os.getenv('CHANGE_GAP_TIMEOUT', '60'))
+RETENTION_DAYS = int(os.getenv('CHANGE_LOG_RETENTION_DAYS', '30'))
+PRUNE_INTERVAL = 3600.0
+
+ChangeListener = Callable[[List[PromptChange]], None]
+
+
+class ChangePoller:
+    """
+    Keeps this worker's in-process state coherent with writes made by other workers.
+
+    Every write path appends to the change_log table in its own transaction. The poller reads the
+    entries past its cursor every POLL_INTERVAL seconds and hands the ones this process did not make
+    to the listeners, which refresh only the affected keys. Entries written locally are announced
+    with `note_local` once committed, since the write path already applied them.
+
+    Seqs are assigned at insert time but become visible at commit, so a later seq can be read
+    before an earlier one. The cursor therefore only advances over a contiguous run of seen seqs;
+    while a hole holds it back, each poll first reads the change log horizon, which settles holes
+    from the transactions still open, and moves the cursor up to it once the entries below it have
+    been read. Each poll reads the entries just past the cursor, to see holes filled, then pages on
+    from the highest seq seen.
+
+    Each shard has its own change log, followed by its own poller; see ShardedChangePoller.
+    """
+
+    def __init__(self, shard: int = 0, interval: float = POLL_INTERVAL):
+        self.repo = None
+        self.shard = shard
+        self.interval = interval
+        self.listeners: List[ChangeListener] = []
+        self.cursor = 0  # Every seq at or below this has been handled
+        self._seen: Set[int] = set()  # Handled seqs above the cursor
+        self._local: Set[int] = set()
+        self._local_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_prune = 0.0
+
+    def subscribe(self, listener: ChangeListener) -> None:
+        self.listeners.append(listener)
+
+    def note_local(self, seq: Optional[int]) -> None:
+        """Mark a committed change log entry as already applied in this process."""
+        if seq is None or self._thread is None:
+            return
+        with self._local_lock:
+            if seq > self.cursor and seq not in self._seen:
+                self._local.add(seq)
+
+    def start(self, repo) -> None:
+        self.repo = repo
+        with DatabaseContext(self.shard):
+            self.cursor = self.repo.get_latest_change_seq()
+        self._last_prune = time.monotonic()
+        name = 'change-poller' if self.shard == 0 else f'change-poller-{self.shard}'
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.interval + 5)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+                if time.monotonic() - self._last_prune >= PRUNE_INTERVAL:
+                    self._last_prune = time.monotonic()
+                    self.prune()
+            except Exception:
+                # Keep polling; the cursor has not moved past the entries that failed
+                metrics.increment('change_poll_errors')
+                traceback.print_exc()
+
+    def poll(self) -> int:
+        """Read and dispatch the new change log entries; returns how many were dispatched."""
+        dispatched = 0
+        horizon = None
+        if self._seen:
+            # Read before the entries: whatever is committed at or below it is then visible to the reads below
+            with DatabaseContext(self.shard):
+                horizon = self.repo.get_change_horizon(GAP_TIMEOUT)
+        after = self.cursor
+        while True:
+            with DatabaseContext(self.shard):
+                changes = self.repo.get_changes_since(after, POLL_BATCH_SIZE)
+            dispatched += self._dispatch(changes)
+            if self._stop.is_set():
+                return dispatched
+            if len(changes) < POLL_BATCH_SIZE:
+                if horizon is not None:
+                    self._settle(horizon)
+                return dispatched
+            # Page on past the highest seq seen: while a hole holds the cursor back, the seqs after it
+            # are seen already, and reading from the cursor again would return the same page forever
+            with self._local_lock:
+                after = max(self._seen, default=self.cursor)
+
+    def _dispatch(self, changes: List[PromptChange]) -> int:
+        for change in changes:
+            change.shard = self.shard
+        with self._local_lock:
+            fresh = [change for change in changes if change.seq not in self._seen]
+            remote = [change for change in fresh if change.seq not in self._local]
+        if remote:
+            for listener in self.listeners:
+                listener(remote)
+            metrics.increment('change_poll_applied', len(remote))
+        with self._local_lock:
+            self._local.difference_update(change.seq for change in fresh)
+            self._seen.update(change.seq for change in fresh)
+            self._advance()
+        return len(remote)
+
+    def _advance(self) -> None:
+        while self.cursor + 1 in self._seen:
+            self.cursor += 1
+            self._seen.remove(self.cursor)
+
+    def _settle(self, horizon: int) -> None:
+        """Move the cursor over the holes at or below the horizon, which will never be filled."""
+        with self._local_lock:
+            if horizon <= self.cursor:
+                return
+            self.cursor = horizon
+            self._seen = {seq for seq in self._seen if seq > horizon}
+            self._local = {seq for seq in self._local if seq > horizon}
+            self._advance()
+
+    def prune(self) -> int:
+        pruned = 0
+        while True:
+            with DatabaseContext(self.shard) as db:
+                db.begin_transaction()
+                count = self.repo.prune_changes(RETENTION_DAYS)
+                db.commit_transaction()
+            pruned += count
+            if count == 0 or self._stop.is_set():
+                return pruned
+
+
+class ShardedChangePoller:
+    """A ChangePoller per shard behind the interface of one; the listeners see each shard's changes apart."""
+
+    def __init__(self, shards: int = SHARD_COUNT, interval: float = POLL_INTERVAL):
+        self.pollers = [ChangePoller(shard, interval) for shard in range(shards)]
+
+    def subscribe(self, listener: ChangeListener) -> None:
+        for poller in self.pollers:
+            poller.subscribe(listener)
+
+    def note_local(self, seq: Optional[int], shard: int = 0) -> None:
+        self.pollers[shard].note_local(seq)
+
+    def start(self, repo) -> None:
+        for poller in self.pollers:
+            poller.start(repo)
+
+    def stop(self) -> None:
+        for poller in self.pollers:
+            poller.stop()
+
+    def poll(self) -> int:
+        return sum(poller.poll() for poller in self.pollers)
+
+
+change_poller = ShardedChangePoller()
+
+
+def refresh_content_indexes(repo, changes: List[PromptChange]) -> None:
+    """Re-index the prompts created or updated elsewhere and drop the deleted ones."""
+    latest: Dict[str, PromptChange] = {}
+    for change in changes:
+        latest[change.guid] = change
+    deleted = [guid for guid, change in latest.items() if change.op == 'delete']
+    changed: Dict[int, List[str]] = {}
+    for guid, change in latest.items():
+        if change.op != 'delete':
+            changed.setdefault(change.shard, []).append(guid)
+    for shard, guids in changed.items():
+        with DatabaseContext(shard):
+            rows = repo.get_prompt_contents(guids)
+        for row in rows:
+            index_prompt(row['guid'], row['author_id'], row['content'])
+    for guid in deleted:
+        unindex_prompt(guid)
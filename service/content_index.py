@@ -0,0 +1,94 @@
+import threading
+from typing import List, Optional
+
+from data import DatabaseContext, SHARD_COUNT
+
+
+class ContentIndex:
+    """
+    Base class for the in-process indexes kept over prompt content.
+
+    An index is built lazily from the database the first time it is needed and is then kept
+    current by the PromptService write paths, which call `add` and `remove` after each commit.
+    Writes that arrive while the initial build is running are queued and replayed once it ends.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = False
+        self._loading = False
+        self._pending = []
+        self._pending_lock = threading.Lock()
+
+    def ensure_loaded(self, repo) -> None:
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            self._loading = True
+            try:
+                self.clear()
+                for shard in range(SHARD_COUNT):
+                    with DatabaseContext(shard):
+                        for rows in repo.iter_prompt_contents():
+                            self.add_batch(rows)
+                # Replay before publishing `loaded`: a write applied directly must come after the queued ones
+                with self._pending_lock:
+                    for op, args in self._pending:
+                        self._apply(op, args)
+                    self._pending = []
+                    self.loaded = True
+            finally:
+                self._loading = False
+
+    def add(self, guid: str, author_id: Optional[int], content: str) -> None:
+        if not self._defer('add', (guid, author_id, content)):
+            self._apply('add', (guid, author_id, content))
+
+    def remove(self, guid: str) -> None:
+        if not self._defer('remove', (guid,)):
+            self._apply('remove', (guid,))
+
+    def _apply(self, op, args) -> None:
+        if op == 'add':
+            guid, author_id, content = args
+            self.add_batch([{'guid': guid, 'author_id': author_id, 'content': content}])
+        else:
+            with self.lock:
+                self._remove(*args)
+
+    def _defer(self, op, args) -> bool:
+        """Queue the write while loading; drop it if the index was never loaded (the build will see it)."""
+        if self.loaded:
+            return False
+        with self._pending_lock:
+            if self.loaded:
+                return False
+            if self._loading:
+                self._pending.append((op, args))
+            return True
+
+    def add_batch(self, rows: List[dict]) -> None:
+        """Index rows with `guid`, `author_id` and `content` keys, replacing any previous entries."""
+        raise NotImplementedError
+
+    def _remove(self, guid: str) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+
+# Every index registered here is maintained by the PromptService write paths
+content_indexes: List[ContentIndex] = []
+
+
+def index_prompt(guid: str, author_id: Optional[int], content: str) -> None:
+    for index in content_indexes:
+        index.add(guid, author_id, content)
+
+
+def unindex_prompt(guid: str) -> None:
+    for index in content_indexes:
+        index.remove(guid)
@@ -0,0 +1,66 @@
+import os
+from typing import List, Tuple
+
+from data import DatabaseContext, SHARD_COUNT
+from .transaction import run_in_transaction
+
+BATCH_SIZE = int(os.getenv('DOCUMENT_BATCH_SIZE', '1000'))  # Prompts per backfill transaction or check query
+
+
+def backfill_documents(repo, only_missing: bool = False, batch_size: int = BATCH_SIZE) -> int:
+    """
+    Rebuild the document column of every prompt (or only those without one) from the child
+    tables, one short transaction per batch so writers are never held up for long; returns the
+    number of batches run, over every shard. Safe to run while the service is up.
+    """
+    return _backfill(repo.refresh_documents, only_missing, batch_size,
+                     "An error occurred while backfilling prompt documents.")
+
+
+def backfill_stats(repo, only_missing: bool = False, batch_size: int = BATCH_SIZE) -> int:
+    """Recompute the length statistics of every prompt (or only those without them), like backfill_documents."""
+    return _backfill(repo.refresh_prompt_stats, only_missing, batch_size,
+                     "An error occurred while backfilling prompt statistics.")
+
+
+def backfill_hashes(repo, only_missing: bool = False, batch_size: int = BATCH_SIZE) -> int:
+    """Recompute the normalized content hash of every prompt (or only those without one), like backfill_documents."""
+    return _backfill(repo.refresh_content_hashes, only_missing, batch_size,
+                     "An error occurred while backfilling prompt content hashes.")
+
+
+def backfill_usage(repo, batch_size: int = BATCH_SIZE) -> int:
+    """Add the missing prompt_usage rows, without uses, that sort=popular needs, like backfill_documents."""
+    return _backfill(lambda after_id, size, only_missing: repo.add_missing_usage(after_id, size), True, batch_size,
+                     "An error occurred while backfilling prompt usage rows.")
+
+
+def _backfill(refresh, only_missing: bool, batch_size: int, error_message: str) -> int:
+    batches = 0
+    for shard in range(SHARD_COUNT):
+        after_id = 0
+        while True:
+            after_id = run_in_transaction(lambda: refresh(after_id, batch_size, only_missing), error_message,
+                                          shard=shard)
+            if after_id is None:
+                break
+            batches += 1
+    return batches
+
+
+def check_documents(repo, batch_size: int = BATCH_SIZE) -> Tuple[List[str], List[str]]:
+    """
+    Compare every prompt's document with its child tables. Returns the guids of the prompts
+    without a document and of those whose document is stale, over every shard.
+    """
+    missing, stale = [], []
+    for shard in range(SHARD_COUNT):
+        after_id = 0
+        while True:
+            with DatabaseContext(shard):
+                after_id, batch_missing, batch_stale = repo.check_documents(after_id, batch_size)
+            if after_id is None:
+                break
+            missing += batch_missing
+            stale += batch_stale
+    return missing, stale
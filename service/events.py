@@ -0,0 +1,208 @@
+import asyncio
+import os
+import queue
+import threading
+import traceback
+from collections import OrderedDict, deque
+from typing import Callable, List, Optional, Set, Tuple
+
+from core.models import PromptChange, PromptEvent, construct_trusted
+from data import DatabaseContext
+from data.shards import encode_cursor
+from .metrics import metrics
+
+QUEUE_SIZE = int(os.getenv('EVENTS_QUEUE_SIZE', '256'))  # Prompts pending per subscriber before the oldest is dropped
+RECENT_SEQS = 4096  # Published seqs remembered, so an event reaching the bus twice goes out once
+PUBLISH_QUEUE_SIZE = 10000  # Changes waiting for the publisher before new ones are dropped
+
+EventFilter = Callable[[PromptEvent], bool]
+
+
+class Subscription:
+    """
+    One event stream consumer's queue. Writes happen on any thread and wake the consumer's
+    event loop; the consumer drains everything pending at once.
+
+    Pending events are coalesced per prompt, keeping only the one with the highest seq, so a
+    consumer that falls behind receives the current state rather than every intermediate write;
+    they are handed out in seq order, whatever order they arrived in. When more than `maxsize`
+    prompts are pending the oldest is dropped and counted, and the consumer is told the lowest
+    seq dropped, to resume from.
+    """
+
+    def __init__(self, matches: EventFilter, loop: asyncio.AbstractEventLoop, maxsize: int = QUEUE_SIZE):
+        self.matches = matches
+        self.loop = loop
+        self.maxsize = maxsize
+        self.pending: 'OrderedDict[str, PromptEvent]' = OrderedDict()
+        self.dropped = 0
+        self.lowest_dropped: Optional[int] = None
+        self.first_seq: Optional[int] = None  # The lowest seq offered, where a resuming consumer's replay stops
+        self.lock = threading.Lock()
+        self.ready = asyncio.Event()
+
+    def offer(self, event: PromptEvent) -> None:
+        if not self.matches(event):
+            return
+        with self.lock:
+            if self.first_seq is None or event.seq < self.first_seq:
+                self.first_seq = event.seq
+            current = self.pending.get(event.guid)
+            if current is not None and current.seq > event.seq:
+                return  # Published late; the pending event is newer
+            self.pending.pop(event.guid, None)
+            self.pending[event.guid] = event
+            if len(self.pending) > self.maxsize:
+                _, oldest = self.pending.popitem(last=False)
+                self.dropped += 1
+                if self.lowest_dropped is None or oldest.seq < self.lowest_dropped:
+                    self.lowest_dropped = oldest.seq
+        try:
+            self.loop.call_soon_threadsafe(self.ready.set)
+        except RuntimeError:
+            pass  # The consumer's loop has closed; it is being unsubscribed
+
+    async def get(self, timeout: float) -> Tuple[List[PromptEvent], int, Optional[int]]:
+        """
+        Wait up to `timeout` seconds for events; returns them with the number dropped since the last
+        call and the lowest seq among those.
+        """
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return [], 0, None
+        self.ready.clear()
+        with self.lock:
+            events = sorted(self.pending.values(), key=lambda event: event.seq)
+            self.pending.clear()
+            dropped, self.dropped = self.dropped, 0
+            lowest_dropped, self.lowest_dropped = self.lowest_dropped, None
+        return events, dropped, lowest_dropped
+
+
+class PromptEventBus:
+    """Fans prompt write events out to the event stream subscribers of this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions: Set[Subscription] = set()
+        self._recent = deque(maxlen=RECENT_SEQS)
+        self._recent_set: Set[int] = set()
+
+    def subscribe(self, matches: EventFilter) -> Subscription:
+        subscription = Subscription(matches, asyncio.get_running_loop())
+        with self.lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, events: List[PromptEvent]) -> None:
+        with self.lock:
+            fresh = []
+            for event in events:
+                if event.seq in self._recent_set:
+                    continue
+                if len(self._recent) == self._recent.maxlen:
+                    self._recent_set.discard(self._recent[0])
+                self._recent.append(event.seq)
+                self._recent_set.add(event.seq)
+                fresh.append(event)
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            for event in fresh:
+                subscription.offer(event)
+        metrics.increment('events_published', len(fresh))
+
+
+prompt_events = PromptEventBus()
+
+
+def make_events(repo, changes: List[PromptChange]) -> List[PromptEvent]:
+    """
+    Turn change log entries of one shard into events, reading the current tags and classification
+    of the live prompts. An event's seq is its change's cursor, unique across the shards.
+    """
+    labels = repo.get_prompt_labels([change.guid for change in changes if change.op != 'delete'])
+    events = []
+    for change in changes:
+        label = labels.get(change.guid, {})
+        events.append(construct_trusted(PromptEvent, seq=encode_cursor(change.seq, change.shard), op=change.op,
+                                        guid=change.guid, author=change.author, tags=label.get('tags'),
+                                        classification=label.get('classification')))
+    return events
+
+
+def publish_changes(repo, changes: List[PromptChange]) -> None:
+    """
+    Publish committed changes to the subscribers, reading their labels from the changes' shards.
+    Events are best effort: a failure is logged, and subscribers can catch up by reconnecting
+    with Last-Event-ID.
+    """
+    try:
+        by_shard = {}
+        for change in changes:
+            by_shard.setdefault(change.shard, []).append(change)
+        events = []
+        for shard, shard_changes in by_shard.items():
+            with DatabaseContext(shard):
+                events.extend(make_events(repo, shard_changes))
+        prompt_events.publish(events)
+    except Exception:
+        metrics.increment('events_publish_errors')
+        traceback.print_exc()
+
+
+class EventPublisher:
+    """
+    Publishes committed changes from a background thread, so that neither the write paths nor
+    the change poller wait on a connection to read labels. Everything queued when the thread
+    wakes goes out in one batch; changes submitted while nobody subscribes are not queued at all.
+    """
+
+    def __init__(self, maxsize: int = PUBLISH_QUEUE_SIZE):
+        self.repo = None
+        self.queue: 'queue.Queue[Optional[List[PromptChange]]]' = queue.Queue(maxsize)
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, changes: List[PromptChange]) -> None:
+        """Called by the write paths for their own changes and by the change poller for other workers'."""
+        if self._thread is None or not prompt_events.subscriptions or not changes:
+            return
+        try:
+            self.queue.put_nowait(changes)
+        except queue.Full:
+            metrics.increment('events_publish_dropped', len(changes))
+
+    def start(self, repo) -> None:
+        self.repo = repo
+        self._thread = threading.Thread(target=self._run, name='event-publisher', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join(5)
+
+    def _run(self) -> None:
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            changes = list(batch)
+            while True:
+                try:
+                    batch = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if batch is None:
+                    publish_changes(self.repo, changes)
+                    return
+                changes.extend(batch)
+            publish_changes(self.repo, changes)
+
+
+event_publisher = EventPublisher()
@@ -0,0 +1,22 @@
+import threading
+from collections import Counter
+from typing import Dict
+
+
+class Metrics:
+    """Process-wide counters, read by the admin metrics endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += amount
+
+    def snapshot(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(sorted(self.counters.items()))
+
+
+metrics = Metrics()
@@ -0,0 +1,126 @@
+import re
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .content_index import ContentIndex, content_indexes
+
+NUM_PERM = 128
+BANDS = 32  # 32 bands of 4 rows: pairs above ~0.4 Jaccard are likely to share a bucket
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+MAX_SHINGLES_PER_CHUNK = 65536  # Bounds the (shingles x NUM_PERM) working matrix to ~64MB
+
+_token_pattern = re.compile(r'\w+')
+
+
+def shingle_hashes(content: str) -> np.ndarray:
+    """Hash the word n-grams of the content to unsigned 32-bit integers."""
+    words = _token_pattern.findall(content.lower())
+    if len(words) < SHINGLE_SIZE:
+        shingles = [' '.join(words)] if words else []
+    else:
+        shingles = {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    return np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles), dtype=np.uint64, count=len(shingles))
+
+
+class MinHashIndex(ContentIndex):
+    """
+    MinHash signatures with LSH banding over prompt content, for near-duplicate lookup.
+
+    Signatures use multiply-shift hashing, h(x) = (a * x + b) >> 32 in wrapping 64-bit
+    arithmetic, computed for whole batches of documents at once. A query only scores the
+    prompts sharing at least one band bucket with the probe, never the whole catalog.
+    """
+
+    def __init__(self, seed: int = 1):
+        super().__init__()
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 2 ** 64 - 1, size=NUM_PERM, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 2 ** 64 - 1, size=NUM_PERM, dtype=np.uint64)
+        self.clear()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.signatures: Dict[str, np.ndarray] = {}
+            self.authors: Dict[str, Optional[int]] = {}
+            self.buckets: List[Dict[bytes, set]] = [{} for _ in range(BANDS)]
+
+    def signatures_for(self, contents: List[str]) -> np.ndarray:
+        """Compute a (len(contents), NUM_PERM) uint32 signature matrix, vectorized per chunk of documents."""
+        result = np.full((len(contents), NUM_PERM), np.iinfo(np.uint32).max, dtype=np.uint32)
+        hashes = [shingle_hashes(content) for content in contents]
+
+        start = 0
+        while start < len(hashes):
+            # Group documents until the chunk holds enough shingles to amortize the NumPy calls
+            end, total = start, 0
+            while end < len(hashes) and (end == start or total + len(hashes[end]) <= MAX_SHINGLES_PER_CHUNK):
+                total += len(hashes[end])
+                end += 1
+            docs = [i for i in range(start, end) if len(hashes[i])]
+            if docs:
+                values = np.concatenate([hashes[i] for i in docs])
+                offsets = np.cumsum([0] + [len(hashes[i]) for i in docs[:-1]])
+                # One row per shingle keeps the reduction over contiguous memory; ops are in place
+                with np.errstate(over='ignore'):
+                    permuted = values[:, None] * self.a[None, :]
+                    permuted += self.b
+                permuted >>= np.uint64(32)
+                result[docs] = np.minimum.reduceat(permuted, offsets, axis=0)
+            start = end
+        return result
+
+    def add_batch(self, rows: List[dict]) -> None:
+        signatures = self.signatures_for([row['content'] for row in rows])
+        with self.lock:
+            for row, signature in zip(rows, signatures):
+                guid = row['guid']
+                self._remove(guid)
+                self.signatures[guid] = signature
+                self.authors[guid] = row['author_id']
+                for band, key in enumerate(self._band_keys(signature)):
+                    self.buckets[band].setdefault(key, set()).add(guid)
+
+    def _remove(self, guid: str) -> None:
+        signature = self.signatures.pop(guid, None)
+        if signature is None:
+            return
+        del self.authors[guid]
+        for band, key in enumerate(self._band_keys(signature)):
+            bucket = self.buckets[band].get(key)
+            if bucket is not None:
+                bucket.discard(guid)
+                if not bucket:
+                    del self.buckets[band][key]
+
+    @staticmethod
+    def _band_keys(signature: np.ndarray) -> List[bytes]:
+        return [signature[band * ROWS:(band + 1) * ROWS].tobytes() for band in range(BANDS)]
+
+    def similar(self, guid: str, author_id: Optional[int], threshold: float = 0.5,
+                limit: int = 10) -> Optional[List[Tuple[str, float]]]:
+        """
+        Return (guid, estimated Jaccard) pairs for prompts in the same scope, best first,
+        or None if the probe prompt is not indexed in that scope.
+        """
+        with self.lock:
+            signature = self.signatures.get(guid)
+            if signature is None or self.authors[guid] != author_id:
+                return None
+            candidates = set()
+            for band, key in enumerate(self._band_keys(signature)):
+                candidates |= self.buckets[band].get(key, set())
+            candidates = [c for c in candidates if c != guid and self.authors[c] == author_id]
+            if not candidates:
+                return []
+            matrix = np.stack([self.signatures[c] for c in candidates])
+
+        scores = (matrix == signature).mean(axis=1)
+        order = np.argsort(-scores, kind='stable')
+        return [(candidates[i], float(scores[i])) for i in order if scores[i] >= threshold][:limit]
+
+
+minhash_index = MinHashIndex()
+content_indexes.append(minhash_index)
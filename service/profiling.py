@@ -0,0 +1,229 @@
+import cProfile
+import marshal
+import os
+import pstats
+import secrets
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from core.exceptions import DataValidationError, RecordNotFoundError
+from core.instrumentation import ASYNC_LAYERS, Observer
+from core.models import ProfileRequest, ProfileSession, ProfileSummary
+
+RING_SIZE = int(os.getenv('PROFILE_RING_SIZE', '20'))  # Profiles kept for download, oldest dropped first
+SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))  # Seconds between stack samples
+PROFILE_MODES = ('sampling', 'deterministic')
+PROFILE_FORMATS = {'sampling': 'collapsed', 'deterministic': 'pstats'}
+LAYERS = ('middleware', 'auth', 'service', 'repository', 'pool', 'sql', 'serialization')
+
+
+class ProfileRecorder(Observer):
+    """
+    Profiles one request: sums the time spent in each layer and, while the request runs in one
+    of the synchronous layers, either samples its thread's stack or runs cProfile on that thread.
+    Spans that stay open across awaits are timed but not profiled, since the event loop thread
+    runs other requests in between.
+    """
+
+    def __init__(self, session: ProfileSession, method: str, path: str):
+        self.session = session
+        self.method = method
+        self.path = path
+        self.lock = threading.Lock()
+        self.layers: Counter = Counter()  # layer -> seconds, inclusive of the layers nested in it
+        self.open: Counter = Counter()  # (thread id, layer) -> open spans, so a layer nested in itself counts once
+        self.depths: Dict[int, int] = {}  # thread id -> open synchronous spans
+        self.samples: Counter = Counter()  # collapsed stack -> samples
+        self.profiles: List[cProfile.Profile] = []
+        self._running: Dict[int, cProfile.Profile] = {}
+
+    def start(self, layer: str, name: str):
+        thread_id = threading.get_ident()
+        with self.lock:
+            self.open[thread_id, layer] += 1
+            depth = self.depths.get(thread_id, 0)
+            if layer not in ASYNC_LAYERS:
+                self.depths[thread_id] = depth + 1
+        if depth == 0 and layer not in ASYNC_LAYERS:
+            self._follow(thread_id)
+        return time.perf_counter()
+
+    def end(self, layer: str, name: str, handle, error: Optional[BaseException]) -> None:
+        elapsed = time.perf_counter() - handle
+        thread_id = threading.get_ident()
+        with self.lock:
+            self.open[thread_id, layer] -= 1
+            if not self.open[thread_id, layer]:
+                self.layers[layer] += elapsed
+            depth = self.depths.get(thread_id, 0)
+            if layer not in ASYNC_LAYERS:
+                depth = self.depths[thread_id] = depth - 1
+        if depth == 0 and layer not in ASYNC_LAYERS:
+            self._unfollow(thread_id)
+
+    def _follow(self, thread_id: int) -> None:
+        if self.session.mode == 'sampling':
+            sampler.watch(thread_id, self)
+        else:
+            profile = cProfile.Profile()
+            self._running[thread_id] = profile
+            profile.enable()
+
+    def _unfollow(self, thread_id: int) -> None:
+        if self.session.mode == 'sampling':
+            sampler.unwatch(thread_id)
+        else:
+            profile = self._running.pop(thread_id)
+            profile.disable()
+            with self.lock:
+                self.profiles.append(profile)
+
+    def result(self, status: int, duration: float, request_id: Optional[str]) -> 'ProfileResult':
+        layers = {layer: self.layers[layer] * 1000 for layer in LAYERS if layer in self.layers}
+        if 'app' in self.layers:
+            layers['middleware'] = (duration - self.layers['app']) * 1000
+        summary = ProfileSummary(id=secrets.token_hex(8), session_id=self.session.id, request_id=request_id,
+                                 method=self.method, path=self.path, status=status, mode=self.session.mode,
+                                 duration_ms=duration * 1000, layers_ms=layers, samples=sum(self.samples.values()),
+                                 created_at=datetime.now())
+        if self.session.mode == 'sampling':
+            data = ''.join(f"{stack} {count}\n" for stack, count in self.samples.most_common()).encode('utf-8')
+        else:
+            stats = pstats.Stats(*self.profiles) if self.profiles else None
+            data = marshal.dumps(stats.stats if stats else {})
+        return ProfileResult(summary, data)
+
+
+class ProfileResult:
+    __slots__ = ('summary', 'data')
+
+    def __init__(self, summary: ProfileSummary, data: bytes):
+        self.summary = summary
+        self.data = data  # Collapsed stacks for flamegraph tools, or a pstats file
+
+
+def collapse(frame) -> str:
+    """A stack in the collapsed format of flamegraph.pl and speedscope: root first, frames joined by ';'."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Sampler:
+    """One thread sampling the stacks of the threads currently running a profiled request's layers."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.watched: Dict[int, ProfileRecorder] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def watch(self, thread_id: int, recorder: ProfileRecorder) -> None:
+        with self.lock:
+            self.watched[thread_id] = recorder
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+                self._thread.start()
+
+    def unwatch(self, thread_id: int) -> None:
+        with self.lock:
+            self.watched.pop(thread_id, None)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.watched:
+                    # Stop while no profiled request is running; the next watch starts a new thread
+                    self._thread = None
+                    return
+                watched = list(self.watched.items())
+            frames = sys._current_frames()
+            for thread_id, recorder in watched:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    stack = collapse(frame)
+                    with recorder.lock:
+                        recorder.samples[stack] += 1
+
+
+sampler = Sampler()
+
+
+class Profiler:
+    """
+    Admin-armed profiling of the next requests matching a method and path prefix, optionally
+    only those carrying the session id in an X-Profile header. Finished profiles are kept in a
+    ring of the last RING_SIZE. While no session is armed the middleware does nothing at all.
+    """
+
+    HEADER = 'x-profile'
+
+    def __init__(self, ring_size: int = RING_SIZE):
+        self.lock = threading.Lock()
+        self.sessions: Dict[str, ProfileSession] = {}
+        self.results = deque(maxlen=ring_size)
+
+    def arm(self, request: ProfileRequest) -> ProfileSession:
+        if request.mode not in PROFILE_MODES:
+            raise DataValidationError(f"Unknown mode '{request.mode}', expected one of {', '.join(PROFILE_MODES)}.")
+        if request.count < 1:
+            raise DataValidationError("The count of requests to profile must be at least 1.")
+        session = ProfileSession(id=secrets.token_hex(8), method=request.method.upper() if request.method else None,
+                                 path=request.path, mode=request.mode, remaining=request.count,
+                                 header=request.header, created_at=datetime.now())
+        with self.lock:
+            self.sessions[session.id] = session
+        return session
+
+    def disarm(self, session_id: str) -> None:
+        with self.lock:
+            if self.sessions.pop(session_id, None) is None:
+                raise RecordNotFoundError(f"Profile session {session_id} was not found.")
+
+    def list_sessions(self) -> List[ProfileSession]:
+        with self.lock:
+            return list(self.sessions.values())
+
+    def claim(self, method: str, path: str, header: Optional[str]) -> Optional[ProfileRecorder]:
+        """A recorder for this request if an armed session matches it, counting it against the session."""
+        with self.lock:
+            for session in self.sessions.values():
+                if (session.method is None or session.method == method) and path.startswith(session.path) and \
+                        (not session.header or header == session.id):
+                    session.remaining -= 1
+                    if session.remaining <= 0:
+                        del self.sessions[session.id]
+                    return ProfileRecorder(session, method, path)
+        return None
+
+    def finish(self, recorder: ProfileRecorder, status: int, duration: float,
+               request_id: Optional[str] = None) -> None:
+        result = recorder.result(status, duration, request_id)
+        with self.lock:
+            self.results.append(result)
+
+    def list_results(self) -> List[ProfileSummary]:
+        with self.lock:
+            return [result.summary for result in reversed(self.results)]
+
+    def get_result(self, result_id: str, format: Optional[str] = None) -> ProfileResult:
+        with self.lock:
+            result = next((result for result in self.results if result.summary.id == result_id), None)
+        if result is None:
+            raise RecordNotFoundError(f"Profile {result_id} was not found; only the last {self.results.maxlen} "
+                                      f"are kept.")
+        expected = PROFILE_FORMATS[result.summary.mode]
+        if format is not None and format != expected:
+            raise DataValidationError(f"A {result.summary.mode} profile is available as '{expected}' only.")
+        return result
+
+
+profiler = Profiler()
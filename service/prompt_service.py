@@ -1,23 +1,41 @@
-import traceback
+import difflib
+import re
 import uuid
+from datetime import datetime
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from typing import List, Optional, Tuple, Union
 
-from core import make_guid
+from core import make_guid, normalize_guid
 from core.exceptions import (
     PromptException,
     RecordNotFoundError,
-    ConstraintViolationError, DataValidationError
+    ConstraintViolationError, DataValidationError, CursorExpiredError
 )
-from core.models import Prompt, User, PromptCreate, PromptUpdate
+from core.instrumentation import instrument
+from core.models import Prompt, User, PromptCreate, PromptUpdate, PromptFacets, PromptRevisionInfo, \
+    PromptRevision, PromptDiff, SimilarPrompt, PromptFields, PromptQueryOptions, PromptChanges, PromptChange, \
+    PromptEvent, construct_trusted
 from data import DatabaseContext
 from data.prompt_repository import PromptRepositoryInterface
+from data.shards import shard_router, encode_cursor, decode_cursor
+from .coherence import change_poller, GAP_TIMEOUT
+from .content_index import index_prompt, unindex_prompt
+from .events import Subscription, prompt_events, event_publisher, make_events
+from .transaction import run_in_transaction
+from .usage import usage_counters
+from .minhash_index import minhash_index
+from .public_replica import public_replica, refresh_public_replica
+from .trigram_index import fuzzy_index, note_names
 from .variables_service import VariablesService
+from .vector_index import vector_index
+
+SEARCH_MODES = ('substring', 'semantic', 'fuzzy')
+SORT_ORDERS = ('id', 'popular', 'tokens', 'chars')
 
 
 class PromptServiceInterface:
 
-    def create_prompt(self, prompt: PromptCreate, author: Optional[User] = None) -> str:
+    def create_prompt(self, prompt: PromptCreate, author: Optional[User] = None, dedupe: bool = False) -> str:
         pass
 
     def update_prompt(self, prompt: PromptUpdate, user: Optional[User] = None) -> None:
@@ -26,10 +44,12 @@ class PromptServiceInterface:
     def delete_prompt(self, guid: str, user: Optional[User] = None) -> None:
         pass
 
-    def get_prompt(self, guid: str, user: Optional[User] = None) -> Prompt:
+    def get_prompt(self, guid: str, user: Optional[User] = None,
+                   options: Optional[PromptQueryOptions] = None) -> Union[Prompt, PromptFields]:
         pass
 
-    def list_prompts(self, user: Optional[User] = None) -> List[Prompt]:
+    def list_prompts(self, user: Optional[User] = None,
+                     options: Optional[PromptQueryOptions] = None) -> List[Union[Prompt, PromptFields]]:
         pass
 
     def update_tags_for_prompt(self, guid: str, tags: List[str], user: Optional[User] = None) -> None:
@@ -38,31 +58,88 @@ class PromptServiceInterface:
     def update_classification_for_prompt(self, guid: str, classification: str, user: Optional[User] = None) -> None:
         pass
 
-    def search_prompts(self, query: str, user: Optional[User] = None) -> List[Prompt]:
+    def search_prompts(self, query: str, user: Optional[User] = None, mode: str = 'substring',
+                       limit: int = 10, options: Optional[PromptQueryOptions] = None
+                       ) -> List[Union[Prompt, PromptFields]]:
+        pass
+
+    def get_prompts_by_tags(self, tags: str, user: Optional[User] = None,
+                            options: Optional[PromptQueryOptions] = None) -> List[Union[Prompt, PromptFields]]:
+        pass
+
+    def get_prompts_by_classification(self, classification: str, user: Optional[User] = None,
+                                      options: Optional[PromptQueryOptions] = None
+                                      ) -> List[Union[Prompt, PromptFields]]:
+        pass
+
+    def get_facets(self, query: Optional[str] = None, tags: Optional[str] = None,
+                   user: Optional[User] = None) -> PromptFacets:
+        pass
+
+    def get_prompt_by_hash(self, content_hash: str, user: Optional[User] = None) -> Prompt:
         pass
 
-    def get_prompts_by_tags(self, tags: str, user: Optional[User] = None) -> List[Prompt]:
+    def list_revisions(self, guid: str, user: Optional[User] = None) -> List[PromptRevisionInfo]:
         pass
 
-    def get_prompts_by_classification(self, classification: str, user: Optional[User] = None) -> List[Prompt]:
+    def get_revision(self, guid: str, revision: int, user: Optional[User] = None) -> PromptRevision:
         pass
 
+    def diff_revisions(self, guid: str, from_revision: int, to_revision: int,
+                       user: Optional[User] = None) -> PromptDiff:
+        pass
+
+    def get_similar_prompts(self, guid: str, user: Optional[User] = None, threshold: float = 0.5,
+                            limit: int = 10) -> List[SimilarPrompt]:
+        pass
+
+    def get_prompt_changes(self, since: Optional[int], user: Optional[User] = None, limit: int = 100,
+                           options: Optional[PromptQueryOptions] = None) -> PromptChanges:
+        pass
+
+    def subscribe_events(self, user: Optional[User] = None, tags: Optional[str] = None,
+                         classification: Optional[str] = None) -> Subscription:
+        pass
+
+    def unsubscribe_events(self, subscription: Subscription) -> None:
+        pass
+
+    def get_events_since(self, since: int, user: Optional[User] = None, limit: int = 1000,
+                         before: Optional[int] = None) -> Tuple[List[PromptEvent], int, bool]:
+        pass
+
+
 class PromptService(PromptServiceInterface):
 
     def __init__(self, repository: PromptRepositoryInterface):
         self.repo = repository
-        self.variables_service = VariablesService()
-
-    def create_prompt(self, prompt: PromptCreate, author: Optional[User] = None) -> str:
+        self.variables_service = instrument(VariablesService(), 'service')
+
+    @staticmethod
+    def _shard(user: Optional[User], write: bool = False) -> int:
+        """The database holding the user's prompts, or the public ones."""
+        return shard_router.shard_for(user.id if user else None, write)
+
+    def _committed(self, seq: int, guid: str, user: Optional[User], op: str, shard: int) -> None:
+        """Announce a committed write: the poller skips it, and event stream subscribers are sent it."""
+        change_poller.note_local(seq, shard)
+        change = construct_trusted(PromptChange, seq=seq, guid=guid, author=user.id if user else None, op=op,
+                                   created_at=datetime.now(), shard=shard)
+        refresh_public_replica(self.repo, [change])
+        event_publisher.submit([change])
+
+    def create_prompt(self, prompt: PromptCreate, author: Optional[User] = None, dedupe: bool = False) -> str:
         """
         Create a new prompt in the database.
 
         Args:
             prompt (Prompt): The prompt details.
             author (User): The user creating the prompt.
+            dedupe (bool): Return the GUID of an existing prompt with the same normalized content
+                in the author's scope instead of creating a duplicate.
 
         Returns:
-            str: The GUID of the created prompt.
+            str: The GUID of the created (or, when deduplicating, the existing) prompt.
 
         Raises:
             PromptException: If any other exception is encountered.
@@ -71,21 +148,25 @@ class PromptService(PromptServiceInterface):
             :param prompt:
             :param author:
         """
-        with DatabaseContext() as db:
-            try:
-                self.variables_service.derive_variables(prompt)
-                db.begin_transaction()
+        self.variables_service.derive_variables(prompt)
+        shard = self._shard(author, write=True)
+
+        def create():
+            if dedupe:
+                guid, created = self.repo.create_prompt_once(prompt, author)
+                if not created:
+                    return guid, None
+            else:
                 guid = self.repo.create_prompt(prompt, author)
-                db.commit_transaction()
-                return guid
-            except PromptException as known_exc:
-                traceback.print_exc()
-                db.rollback_transaction()
-                raise known_exc
-            except Exception as e:
-                traceback.print_exc()
-                db.rollback_transaction()
-                raise PromptException("An unexpected error occurred while processing your request.") from e
+            return guid, self.repo.record_prompt_change(guid, author.id if author else None, 'create')
+
+        guid, seq = run_in_transaction(create, "An unexpected error occurred while processing your request.",
+                                       shard=shard)
+        if seq is not None:
+            index_prompt(guid, author.id if author else None, prompt.content)
+            note_names(prompt.tags, prompt.classification, author.id if author else None)
+            self._committed(seq, guid, author, 'create', shard)
+        return guid
 
     def update_prompt(self, prompt: PromptUpdate, user: Optional[User] = None) -> None:
         """
@@ -100,19 +181,18 @@ class PromptService(PromptServiceInterface):
             RecordNotFoundError: If the prompt isn't found in the DB.
             :param user:
         """
-        with DatabaseContext() as db:
+        prompt.guid = normalize_guid(prompt.guid)
+        self.variables_service.derive_variables(prompt)
+        shard = self._shard(user, write=True)
 
-            try:
-                self.variables_service.derive_variables(prompt)
-                db.begin_transaction()
-                self.repo.update_prompt(prompt, user)
-                db.commit_transaction()
-            except PromptException as known_exc:
-                db.rollback_transaction()
-                raise known_exc
-            except Exception as e:
-                db.rollback_transaction()
-                raise PromptException("An unexpected error occurred while updating the prompt.") from e
+        def update():
+            self.repo.update_prompt(prompt, user)
+            return self.repo.record_prompt_change(prompt.guid, user.id if user else None, 'update')
+
+        seq = run_in_transaction(update, "An unexpected error occurred while updating the prompt.", shard=shard)
+        index_prompt(prompt.guid, user.id if user else None, prompt.content)
+        note_names(prompt.tags, prompt.classification, user.id if user else None)
+        self._committed(seq, prompt.guid, user, 'update', shard)
 
     def delete_prompt(self, guid: str, user: Optional[User] = None) -> None:
         """
@@ -126,53 +206,74 @@ class PromptService(PromptServiceInterface):
             ConstraintViolationError: If a database constraint is violated.
             RecordNotFoundError: If the prompt isn't found in the DB.
         """
-        with DatabaseContext() as db:
-            try:
-                db.begin_transaction()
-                self.repo.delete_prompt(guid, user)
-                db.commit_transaction()
-            except PromptException as known_exc:
-                db.rollback_transaction()
-                raise known_exc
-            except Exception as e:
-                db.rollback_transaction()
-                raise PromptException("An unexpected error occurred while deleting the prompt.") from e
+        guid = normalize_guid(guid)
+        shard = self._shard(user, write=True)
+
+        def delete():
+            self.repo.delete_prompt(guid, user)
+            return self.repo.record_prompt_change(guid, user.id if user else None, 'delete')
 
-    def get_prompt(self, guid: str, user: Optional[User] = None) -> Prompt:
+        seq = run_in_transaction(delete, "An unexpected error occurred while deleting the prompt.", shard=shard)
+        unindex_prompt(guid)
+        self._committed(seq, guid, user, 'delete', shard)
+
+    def get_prompt(self, guid: str, user: Optional[User] = None,
+                   options: Optional[PromptQueryOptions] = None) -> Union[Prompt, PromptFields]:
         """
         Retrieve a prompt from the database using its GUID.
 
         Args:
             guid (str): The GUID of the prompt to be fetched.
+            options (PromptQueryOptions): Restricts the returned fields.
 
         Returns:
-            Prompt: The retrieved prompt details.
+            Prompt: The retrieved prompt details, or PromptFields when fields were requested.
 
         Raises:
             PromptException: If any other exception is encountered.
             RecordNotFoundError: If the prompt isn't found in the DB.
+            DataValidationError: If an unknown field is requested.
         """
-        with DatabaseContext():
-            try:
-                return self.repo.get_prompt(guid, user)
-            except PromptException as known_exc:
-                raise known_exc
-            except Exception as e:
-                raise PromptException("An unexpected error occurred while fetching the prompt.") from e
-
-    def list_prompts(self, user: Optional[User] = None) -> List[Prompt]:
+        guid = normalize_guid(guid)
+        self._check_options(options)
+        shard = self._shard(user)
+        replica = public_replica.serving(self.repo, user, options)
+        if replica is not None:
+            prompt = replica.get(guid, options)
+        else:
+            with DatabaseContext(shard):
+                try:
+                    prompt = self.repo.get_prompt(guid, user, options)
+                except PromptException as known_exc:
+                    raise known_exc
+                except Exception as e:
+                    raise PromptException("An unexpected error occurred while fetching the prompt.") from e
+        if prompt is not None:
+            usage_counters.record(guid, shard)
+        return prompt
+
+    def list_prompts(self, user: Optional[User] = None,
+                     options: Optional[PromptQueryOptions] = None) -> List[Union[Prompt, PromptFields]]:
         """
         List all prompts in the database.
 
+        Args:
+            options (PromptQueryOptions): Page (skip/limit) and fields to return.
+
         Returns:
-            List[Prompt]: A list of all prompts.
+            List[Prompt]: A list of all prompts, or of PromptFields when fields were requested.
 
         Raises:
             PromptException: If any other exception is encountered.
+            DataValidationError: If an unknown field is requested.
         """
-        with DatabaseContext():
+        self._check_options(options)
+        replica = public_replica.serving(self.repo, user, options)
+        if replica is not None:
+            return replica.query(None, options)
+        with DatabaseContext(self._shard(user)):
             try:
-                return self.repo.list_prompts(user)
+                return self.repo.list_prompts(user, options)
             except Exception as e:
                 raise PromptException("An unexpected error occurred while listing prompts.") from e
 
@@ -189,18 +290,18 @@ class PromptService(PromptServiceInterface):
             ConstraintViolationError: If a database constraint is violated.
             RecordNotFoundError: If the prompt isn't found in the DB.
         """
-        with DatabaseContext() as db:
-            try:
-                db.begin_transaction()
-                if tags:
-                    self.repo.add_remove_tags_for_prompt(guid, tags, user)
-                db.commit_transaction()
-            except (ConstraintViolationError, RecordNotFoundError) as known_exc:
-                db.rollback_transaction()
-                raise known_exc
-            except Exception as e:
-                db.rollback_transaction()
-                raise PromptException("An error occurred while updating tags for the prompt.") from e
+        if tags:
+            guid = normalize_guid(guid)
+            shard = self._shard(user, write=True)
+
+            def update_tags():
+                self.repo.add_remove_tags_for_prompt(guid, tags, user)
+                return self.repo.record_prompt_change(guid, user.id if user else None, 'update')
+
+            seq = run_in_transaction(update_tags, "An error occurred while updating tags for the prompt.",
+                                     (ConstraintViolationError, RecordNotFoundError), shard)
+            note_names(tags, author=user.id if user else None)
+            self._committed(seq, guid, user, 'update', shard)
 
     def update_classification_for_prompt(self, guid: str, classification: str, user: Optional[User] = None) -> None:
         """
@@ -215,42 +316,274 @@ class PromptService(PromptServiceInterface):
             ConstraintViolationError: If a database constraint is violated.
             RecordNotFoundError: If the prompt isn't found in the DB.
         """
-        with DatabaseContext() as db:
-            try:
-                db.begin_transaction()
-                if classification:
-                    self.repo.add_remove_classification_for_prompt(guid, classification, user)
-                db.commit_transaction()
-            except (ConstraintViolationError, RecordNotFoundError) as known_exc:
-                db.rollback_transaction()
-                raise known_exc
-            except Exception as e:
-                db.rollback_transaction()
-                raise PromptException("An error occurred while updating classification for the prompt.") from e
-
-    def search_prompts(self, query: str, user: Optional[User] = None) -> List[Prompt]:
+        if classification:
+            guid = normalize_guid(guid)
+            shard = self._shard(user, write=True)
+
+            def update_classification():
+                self.repo.add_remove_classification_for_prompt(guid, classification, user)
+                return self.repo.record_prompt_change(guid, user.id if user else None, 'update')
+
+            seq = run_in_transaction(update_classification,
+                                     "An error occurred while updating classification for the prompt.",
+                                     (ConstraintViolationError, RecordNotFoundError), shard)
+            note_names(classification=classification, author=user.id if user else None)
+            self._committed(seq, guid, user, 'update', shard)
+
+    def search_prompts(self, query: str, user: Optional[User] = None, mode: str = 'substring',
+                       limit: int = 10, options: Optional[PromptQueryOptions] = None
+                       ) -> List[Union[Prompt, PromptFields]]:
         """
         Search for prompts based on a given query.
-        """
-        with DatabaseContext():
-            return self.repo.search_prompts(query, user)
 
-    def get_prompts_by_tags(self, tags: str, user: Optional[User] = None) -> List[Prompt]:
+        In 'substring' mode (the default) prompts containing the query are returned. In 'semantic'
+        mode the `limit` prompts whose content is most similar to the query text are returned,
+        best first, using the in-process vector index. In 'fuzzy' mode the query words may be misspelt:
+        prompts are ranked by the trigram similarity of their words to the query's, weighted towards
+        rarer words. In both ranked modes the requested sort does not apply, and matches outside the
+        token filters are left out rather than replaced.
+        """
+        if mode not in SEARCH_MODES:
+            raise DataValidationError(f"Unknown search mode '{mode}', expected one of {', '.join(SEARCH_MODES)}.")
+        self._check_options(options)
+
+        if mode == 'semantic':
+            vector_index.ensure_loaded(self.repo)
+            matches = vector_index.search(query, user.id if user else None, limit)
+            with DatabaseContext(self._shard(user)):
+                return self.repo.get_prompts_by_guids([guid for guid, _ in matches], user, options)
+
+        if mode == 'fuzzy':
+            fuzzy_index.ensure_loaded(self.repo)
+            matches = fuzzy_index.search(query, user.id if user else None, limit)
+            with DatabaseContext(self._shard(user)):
+                return self.repo.get_prompts_by_guids([guid for guid, _ in matches], user, options)
+
+        with DatabaseContext(self._shard(user)):
+            return self.repo.search_prompts(query, user, options)
+
+    def get_prompts_by_tags(self, tags: str, user: Optional[User] = None,
+                            options: Optional[PromptQueryOptions] = None) -> List[Union[Prompt, PromptFields]]:
         """
         Retrieve all prompts associated with a specific tag.
         """
+        self._check_options(options)
         tags_list = tags.split(',')
 
         if not tags_list:
             raise DataValidationError("No tags provided.")
 
-        with DatabaseContext():
-            return self.repo.get_prompts_by_tags(tags_list, user)
+        replica = public_replica.serving(self.repo, user, options)
+        if replica is not None:
+            return replica.query(replica.tagged(tags_list), options)
+        with DatabaseContext(self._shard(user)):
+            return self.repo.get_prompts_by_tags(tags_list, user, options)
 
-    def get_prompts_by_classification(self, classification: str, user: Optional[User] = None) -> List[Prompt]:
+    def get_prompts_by_classification(self, classification: str, user: Optional[User] = None,
+                                      options: Optional[PromptQueryOptions] = None
+                                      ) -> List[Union[Prompt, PromptFields]]:
         """
         Retrieve all prompts associated with a specific classification.
         """
-        with DatabaseContext():
-            return self.repo.get_prompts_by_classification(classification, user)
+        self._check_options(options)
+        replica = public_replica.serving(self.repo, user, options)
+        if replica is not None:
+            return replica.query(replica.classified(classification), options)
+        with DatabaseContext(self._shard(user)):
+            return self.repo.get_prompts_by_classification(classification, user, options)
+
+    @staticmethod
+    def _check_options(options: Optional[PromptQueryOptions]) -> None:
+        if options and options.sort not in SORT_ORDERS:
+            raise DataValidationError(f"Unknown sort '{options.sort}', expected one of {', '.join(SORT_ORDERS)}.")
+        if options and options.fields:
+            unknown = set(options.fields) - set(PromptFields.model_fields)
+            if unknown:
+                raise DataValidationError(f"Unknown fields requested: {', '.join(sorted(unknown))}.")
+
+    def get_facets(self, query: Optional[str] = None, tags: Optional[str] = None,
+                   user: Optional[User] = None) -> PromptFacets:
+        """
+        Count tags and classifications of the prompts in scope, optionally narrowed
+        by a search query and a comma-separated tag selection.
+        """
+        tags_list = [tag for tag in tags.split(',') if tag] if tags else None
+
+        with DatabaseContext(self._shard(user)):
+            return self.repo.get_facets(query, tags_list, user)
+
+    def get_prompt_by_hash(self, content_hash: str, user: Optional[User] = None) -> Prompt:
+        """
+        Retrieve the oldest prompt in scope whose normalized content has the given SHA-256 hash.
+
+        Raises:
+            DataValidationError: If the hash is not a 64-character hex string.
+            RecordNotFoundError: If no prompt in scope has that content.
+        """
+        content_hash = content_hash.lower()
+        if not re.fullmatch(r'[0-9a-f]{64}', content_hash):
+            raise DataValidationError("Content hash must be a 64-character hex SHA-256 digest.")
+
+        shard = self._shard(user)
+        with DatabaseContext(shard):
+            guid = self.repo.find_prompt_guid_by_hash(content_hash, user)
+            if guid is None:
+                raise RecordNotFoundError(f"No prompt with content hash {content_hash} was found.")
+            prompt = self.repo.get_prompt(guid, user)
+        usage_counters.record(guid, shard)
+        return prompt
+
+    def list_revisions(self, guid: str, user: Optional[User] = None) -> List[PromptRevisionInfo]:
+        """
+        List the content revisions recorded for a prompt, oldest first.
+
+        Raises:
+            RecordNotFoundError: If the prompt isn't found in the user's scope.
+        """
+        with DatabaseContext(self._shard(user)):
+            return self.repo.list_revisions(normalize_guid(guid), user)
+
+    def get_revision(self, guid: str, revision: int, user: Optional[User] = None) -> PromptRevision:
+        """
+        Rebuild the content of a prompt as of a given revision.
+
+        Raises:
+            RecordNotFoundError: If the prompt or the revision isn't found.
+        """
+        with DatabaseContext(self._shard(user)):
+            return self.repo.get_revision(normalize_guid(guid), revision, user)
+
+    def diff_revisions(self, guid: str, from_revision: int, to_revision: int,
+                       user: Optional[User] = None) -> PromptDiff:
+        """
+        Produce a unified diff between two revisions of a prompt.
+
+        Raises:
+            RecordNotFoundError: If the prompt or either revision isn't found.
+        """
+        guid = normalize_guid(guid)
+        with DatabaseContext(self._shard(user)):
+            old = self.repo.get_revision(guid, from_revision, user)
+            new = self.repo.get_revision(guid, to_revision, user)
+
+        diff = difflib.unified_diff(old.content.splitlines(keepends=True),
+                                    new.content.splitlines(keepends=True),
+                                    fromfile=f"{guid}@{from_revision}",
+                                    tofile=f"{guid}@{to_revision}")
+        return PromptDiff(guid=guid, from_revision=from_revision, to_revision=to_revision, diff=''.join(diff))
+
+    def get_similar_prompts(self, guid: str, user: Optional[User] = None, threshold: float = 0.5,
+                            limit: int = 10) -> List[SimilarPrompt]:
+        """
+        Find near-duplicates of a prompt within the same scope using the in-process MinHash/LSH index.
+
+        Raises:
+            RecordNotFoundError: If the prompt isn't found in the user's scope.
+        """
+        guid = normalize_guid(guid)
+        minhash_index.ensure_loaded(self.repo)
+        matches = minhash_index.similar(guid, user.id if user else None, threshold, limit)
+        if matches is None:
+            raise RecordNotFoundError(f"Prompt {guid} was not found.")
+        return [SimilarPrompt(guid=match, score=score) for match, score in matches]
+
+    def get_prompt_changes(self, since: Optional[int], user: Optional[User] = None, limit: int = 100,
+                           options: Optional[PromptQueryOptions] = None) -> PromptChanges:
+        """
+        Page through the prompts in scope that changed after the `since` cursor.
+
+        Each page covers up to `limit` change log entries and returns the current state of the
+        prompts they created or updated, plus tombstones for the deleted ones. Without `since` an
+        empty page is returned whose next_cursor is the current position, for a mirror to follow
+        from after listing the catalog.
+
+        With several databases the cursor also names the database whose change log it follows;
+        once the user's prompts have been moved to another, their cursors expire.
+
+        Raises:
+            CursorExpiredError: If entries after the cursor have already been pruned from the log.
+            DataValidationError: If an unknown field is requested.
+        """
+        self._check_options(options)
+        shard = self._shard(user)
+        with DatabaseContext(shard):
+            # Entries past the horizon may still be joined by an earlier seq that has not committed yet
+            horizon = self.repo.get_change_horizon(GAP_TIMEOUT)
+            if since is None:
+                return construct_trusted(PromptChanges, prompts=[], deleted=[],
+                                         next_cursor=encode_cursor(horizon, shard), has_more=False)
+            since, cursor_shard = decode_cursor(since)
+            oldest = self.repo.get_oldest_change_seq()
+            if cursor_shard != shard or (oldest is not None and since < oldest - 1):
+                raise CursorExpiredError()
+
+            changes = self.repo.get_prompt_changes(since, horizon, limit, user)
+            latest = {}
+            for change in changes:
+                latest[change.guid] = change.op
+            deleted = [guid for guid, op in latest.items() if op == 'delete']
+            prompts = self.repo.get_prompts_by_guids([guid for guid, op in latest.items() if op != 'delete'],
+                                                     user, options)
+
+        # A prompt missing now was deleted by an entry on a later page
+        found = {prompt.guid for prompt in prompts}
+        deleted += [guid for guid, op in latest.items() if op != 'delete' and guid not in found]
+        has_more = len(changes) == limit
+        next_cursor = changes[-1].seq if has_more else max(since, horizon)
+        return construct_trusted(PromptChanges, prompts=prompts, deleted=deleted,
+                                 next_cursor=encode_cursor(next_cursor, shard), has_more=has_more)
+
+    def subscribe_events(self, user: Optional[User] = None, tags: Optional[str] = None,
+                         classification: Optional[str] = None) -> Subscription:
+        """
+        Start receiving events for writes to prompts in the user's scope, optionally only those with
+        one of the comma-separated tags or with the classification. Deletes are always sent, as the
+        tags of a deleted prompt are no longer known. Must be called on the consumer's event loop.
+        """
+        author = user.id if user else None
+        wanted_tags = {tag for tag in tags.split(',') if tag} if tags else None
+
+        def matches(event: PromptEvent) -> bool:
+            if event.author != author:
+                return False
+            if event.op == 'delete':
+                return True
+            if wanted_tags and not wanted_tags.intersection(event.tags or ()):
+                return False
+            return classification is None or event.classification == classification
+
+        return prompt_events.subscribe(matches)
+
+    def unsubscribe_events(self, subscription: Subscription) -> None:
+        prompt_events.unsubscribe(subscription)
 
+    def get_events_since(self, since: int, user: Optional[User] = None, limit: int = 1000,
+                         before: Optional[int] = None) -> Tuple[List[PromptEvent], int, bool]:
+        """
+        Replay up to `limit` events in the user's scope after the `since` seq, from the change log,
+        for a subscriber resuming with Last-Event-ID. Returns the events, the cursor to continue
+        from and whether more remain.
+
+        The replay is not held back by the change horizon: it reads every entry committed so far, up
+        to but excluding `before`, the first event the subscriber received live, if any. An entry
+        still in flight commits after the subscription was made and so is received live.
+
+        Raises:
+            CursorExpiredError: If events after `since` have already been pruned from the log.
+        """
+        shard = self._shard(user)
+        since, cursor_shard = decode_cursor(since)
+        with DatabaseContext(shard):
+            if before is not None and decode_cursor(before)[1] == shard:
+                upto = decode_cursor(before)[0] - 1
+            else:
+                upto = self.repo.get_latest_change_seq()
+            oldest = self.repo.get_oldest_change_seq()
+            if cursor_shard != shard or (oldest is not None and since < oldest - 1):
+                raise CursorExpiredError()
+            changes = self.repo.get_prompt_changes(since, upto, limit, user)
+            for change in changes:
+                change.shard = shard
+            events = make_events(self.repo, changes)
+        has_more = len(changes) == limit
+        return events, encode_cursor(changes[-1].seq if has_more else max(since, upto), shard), has_more
@@ -0,0 +1,390 @@
+import os
+import sys
+import threading
+import time
+import traceback
+from array import array
+from datetime import datetime
+from heapq import merge
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Union
+
+from pydantic import BaseModel
+
+from core import guid_to_bytes, guid_from_bytes
+from core.models import Prompt, PromptFields, PromptQueryOptions, PromptChange, ReplicaStats, User, Variable, \
+    construct_trusted
+from data import DatabaseContext
+from data.shards import shard_router
+from .metrics import metrics
+
+# Serve public get, list, tag and classification reads from an in-process snapshot of the public prompts
+PUBLIC_REPLICA = os.getenv('PUBLIC_REPLICA', 'false').lower() in ('1', 'true', 'yes')
+SORTS = ('id', 'tokens', 'chars')  # 'popular' follows use counts, which change on every read; it stays in MySQL
+_SORT_COLUMNS = {'tokens': 'token_count', 'chars': 'char_count'}
+
+
+class CatalogEntry:
+    """One public prompt, in slots rather than a model: about a third of the memory of a Prompt."""
+
+    __slots__ = ('id', 'guid', 'content', 'created_at', 'updated_at', 'char_count', 'token_count',
+                 'input_variable_count', 'output_variable_count', 'input_variables', 'output_variables',
+                 'tags', 'classification')
+
+    def __init__(self, prompt: Prompt, intern):
+        self.id = prompt.id
+        self.guid = prompt.guid
+        self.content = prompt.content
+        self.created_at = prompt.created_at
+        self.updated_at = prompt.updated_at
+        self.char_count = prompt.char_count
+        self.token_count = prompt.token_count
+        self.input_variable_count = prompt.input_variable_count
+        self.output_variable_count = prompt.output_variable_count
+        self.input_variables = intern.variables(prompt.input_variables)
+        self.output_variables = intern.variables(prompt.output_variables)
+        self.tags = tuple(intern.string(tag) for tag in prompt.tags or ())
+        self.classification = intern.string(prompt.classification)
+
+    def field(self, name: str):
+        if name == 'author':
+            return None
+        value = getattr(self, name)
+        return list(value) if isinstance(value, tuple) else value
+
+
+class Interner:
+    """Shares one object between every prompt carrying an equal tag, classification or variable."""
+
+    def __init__(self):
+        self._strings: Dict[str, str] = {}
+        self._variables: Dict[tuple, Variable] = {}
+
+    def string(self, value: Optional[str]) -> Optional[str]:
+        return None if value is None else self._strings.setdefault(value, value)
+
+    def variables(self, values: Optional[List[Variable]]) -> tuple:
+        shared = []
+        for var in values or ():
+            key = (var.name, var.description, var.type, var.expected_format)
+            if key not in self._variables:
+                name, description, type_, expected_format = map(self.string, key)
+                self._variables[key] = construct_trusted(Variable, name=name, description=description, type=type_,
+                                                         expected_format=expected_format)
+            shared.append(self._variables[key])
+        return tuple(shared)
+
+
+class CatalogSnapshot:
+    """
+    One immutable version of the public catalog: the prompts in id order, with guid, tag and
+    classification lookups built up front. Readers keep the reference they took for the whole
+    request; a refresh builds a new snapshot and swaps it in.
+
+    A refresh copies only the guid map and entry list, and the index arrays of the tags and
+    classifications it touches; everything else is shared with the previous snapshot. Updated
+    prompts keep their position, new ones are appended (their ids are the highest), and deleted
+    ones leave a None behind until more than COMPACT_FRACTION of the entries are gone.
+    Tag and classification names are matched case-insensitively, like the MySQL collation.
+    """
+
+    COMPACT_FRACTION = 0.1
+
+    def __init__(self, entries: List[Optional[CatalogEntry]], positions: Dict[str, int],
+                 by_tag: Dict[str, array], by_classification: Dict[str, array]):
+        self.entries = entries
+        self.positions = positions
+        self.by_tag = by_tag
+        self.by_classification = by_classification
+        self._orders: Dict[str, Iterable[int]] = {'id': range(len(entries))}
+        self._memory: Optional[int] = None
+        self.built_at = datetime.now()
+
+    @classmethod
+    def build(cls, entries: List[CatalogEntry]) -> 'CatalogSnapshot':
+        """A snapshot of entries in id order."""
+        by_tag: Dict[str, array] = {}
+        by_classification: Dict[str, array] = {}
+        keys: Dict[str, str] = {}
+        for position, entry in enumerate(entries):
+            for tag in entry.tags:
+                key = keys.get(tag) or keys.setdefault(tag, tag.lower())
+                by_tag.setdefault(key, array('i')).append(position)
+            if entry.classification is not None:
+                key = keys.get(entry.classification) or keys.setdefault(entry.classification,
+                                                                        entry.classification.lower())
+                by_classification.setdefault(key, array('i')).append(position)
+        return cls(entries, {entry.guid: position for position, entry in enumerate(entries)}, by_tag, by_classification)
+
+    def patch(self, prompts: List[Prompt], guids: Iterable[str], intern: Interner) -> 'CatalogSnapshot':
+        """A new snapshot with the given guids replaced by the prompts (those not among them are deleted)."""
+        changed = {entry.guid: entry for entry in (CatalogEntry(prompt, intern) for prompt in prompts)}
+        appended = sorted((entry for guid, entry in changed.items() if guid not in self.positions),
+                          key=lambda entry: entry.id)
+        last = next((entry for entry in reversed(self.entries) if entry is not None), None)
+        deleted = len(self.entries) - len(self.positions) + len(set(guids) - set(changed))
+        if (appended and last is not None and appended[0].id < last.id) or \
+                deleted > self.COMPACT_FRACTION * len(self.entries):
+            # Out of id order (a transaction committed late), or too many holes: rebuild compactly
+            gone = set(guids) | set(changed)
+            kept = [entry for entry in self.entries if entry is not None and entry.guid not in gone]
+            return self.build(list(merge(kept, sorted(changed.values(), key=lambda entry: entry.id),
+                                         key=lambda entry: entry.id)))
+
+        entries, positions = list(self.entries), dict(self.positions)
+        removed: Dict[tuple, set] = {}
+        added: Dict[tuple, set] = {}
+
+        def index(entry: CatalogEntry, position: int, into: Dict[tuple, set]) -> None:
+            for tag in entry.tags:
+                into.setdefault(('tag', tag.lower()), set()).add(position)
+            if entry.classification is not None:
+                into.setdefault(('classification', entry.classification.lower()), set()).add(position)
+
+        for guid in set(guids) | set(changed):
+            position = positions.get(guid)
+            if position is None:
+                continue
+            index(entries[position], position, removed)
+            entry = changed.get(guid)
+            entries[position] = entry
+            if entry is None:
+                del positions[guid]
+            else:
+                index(entry, position, added)
+        for entry in appended:
+            positions[entry.guid] = len(entries)
+            index(entry, len(entries), added)
+            entries.append(entry)
+
+        lookups = {'tag': dict(self.by_tag), 'classification': dict(self.by_classification)}
+        for kind, key in set(removed) | set(added):
+            lookup = lookups[kind]
+            current = set(lookup.get(key, ())) - removed.get((kind, key), set()) | added.get((kind, key), set())
+            if current:
+                lookup[key] = array('i', sorted(current))
+            else:
+                lookup.pop(key, None)
+        return CatalogSnapshot(entries, positions, lookups['tag'], lookups['classification'])
+
+    def get(self, guid: str, options: Optional[PromptQueryOptions] = None) -> Optional[Union[Prompt, PromptFields]]:
+        position = self.positions.get(_normalize(guid))
+        if position is None:
+            return None
+        return self._prompt(self.entries[position], options.fields if options else None)
+
+    def tagged(self, tags_list: List[str]) -> List[int]:
+        """Positions of the prompts with any of the tags, in id order."""
+        found = [self.by_tag.get(tag.lower(), ()) for tag in tags_list]
+        if len(found) == 1:
+            return list(found[0])
+        return sorted(set().union(*found))
+
+    def classified(self, classification: str) -> Iterable[int]:
+        return self.by_classification.get(classification.lower(), ())
+
+    def query(self, positions: Optional[Iterable[int]] = None,
+              options: Optional[PromptQueryOptions] = None) -> List[Union[Prompt, PromptFields]]:
+        """The prompts at the positions (all when None), filtered, sorted and paged like the MySQL queries."""
+        options = options or PromptQueryOptions()
+        if positions is None:
+            order = self._order(options.sort)
+        elif options.sort in _SORT_COLUMNS:
+            order = sorted(positions, key=self._sort_key(options.sort))
+        else:
+            order = positions
+        entries = (self.entries[position] for position in order)
+        if len(self.positions) < len(self.entries):
+            entries = (entry for entry in entries if entry is not None)
+        if options.min_tokens is not None or options.max_tokens is not None:
+            low = options.min_tokens if options.min_tokens is not None else 0
+            high = options.max_tokens if options.max_tokens is not None else sys.maxsize
+            entries = (entry for entry in entries if entry.token_count is not None and low <= entry.token_count <= high)
+        if options.limit is not None:
+            entries = islice(entries, options.skip, options.skip + options.limit)
+        return [self._prompt(entry, options.fields) for entry in entries]
+
+    def _sort_key(self, sort: str):
+        column = _SORT_COLUMNS[sort]
+        entries = self.entries
+        # MySQL sorts NULL first; ties go by id, which is the position
+        def key(position: int) -> tuple:
+            value = getattr(entries[position], column, None)
+            return -1 if value is None else value, position
+        return key
+
+    def _order(self, sort: str) -> Iterable[int]:
+        order = self._orders.get(sort)
+        if order is None:
+            # Built on first use and kept; a concurrent first use only builds it twice
+            order = self._orders[sort] = array('i', sorted(self.positions.values(), key=self._sort_key(sort)))
+        return order
+
+    @staticmethod
+    def _prompt(entry: CatalogEntry, fields: Optional[List[str]]) -> Union[Prompt, PromptFields]:
+        if fields:
+            return construct_trusted(PromptFields, **{field: entry.field(field) for field in dict.fromkeys(fields)})
+        return construct_trusted(Prompt,
+                                 guid=entry.guid,
+                                 id=entry.id,
+                                 content=entry.content,
+                                 author=None,
+                                 created_at=entry.created_at,
+                                 updated_at=entry.updated_at,
+                                 char_count=entry.char_count,
+                                 token_count=entry.token_count,
+                                 input_variable_count=entry.input_variable_count,
+                                 output_variable_count=entry.output_variable_count,
+                                 input_variables=list(entry.input_variables),
+                                 output_variables=list(entry.output_variables),
+                                 tags=list(entry.tags),
+                                 classification=entry.classification)
+
+    def memory_bytes(self) -> int:
+        """Bytes held by the snapshot, counting each shared object once; measured on first use."""
+        if self._memory is None:
+            seen = set()
+            self._memory = (_size(self.entries, seen) + _size(self.positions, seen) + _size(self.by_tag, seen)
+                            + _size(self.by_classification, seen) + _size(self._orders, seen))
+        return self._memory
+
+
+def _size(obj, seen: set) -> int:
+    if obj is None or id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(_size(item, seen) for item in obj)
+    elif isinstance(obj, dict):
+        size += sum(_size(key, seen) + _size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, CatalogEntry):
+        size += sum(_size(getattr(obj, slot), seen) for slot in CatalogEntry.__slots__)
+    elif isinstance(obj, BaseModel):
+        size += _size(obj.__dict__, seen)
+    return size
+
+
+def _normalize(guid: str) -> Optional[str]:
+    return guid_from_bytes(guid_to_bytes(guid))
+
+
+class PublicReplica:
+    """
+    A read-only copy of the public prompts, held by each worker when PUBLIC_REPLICA is set, so
+    public reads take no database round trip.
+
+    The snapshot is loaded in the background on first use; until then, and whenever a refresh
+    fails, reads go to MySQL. It is kept current from the change log rather than from updated_at,
+    since tag maintenance keeps updated_at and deletes leave no row behind: the write paths of
+    this worker and the change poller for the others hand over the changed guids, whose rows are
+    re-read and patched into a new snapshot that replaces the old one in a single assignment.
+    Changes that arrive while the snapshot is loading are applied once it is in place.
+    """
+
+    def __init__(self, enabled: bool = PUBLIC_REPLICA):
+        self.enabled = enabled
+        self.snapshot: Optional[CatalogSnapshot] = None
+        self.lock = threading.Lock()  # One load or patch at a time
+        self.refreshes = 0
+        self._intern = Interner()
+        self._loading = False
+        self._pending: set = set()
+        self._pending_lock = threading.Lock()
+
+    def serving(self, repo, user: Optional[User], options: Optional[PromptQueryOptions]) -> Optional[CatalogSnapshot]:
+        """The snapshot to answer a read from, or None when it has to go to MySQL."""
+        if not self.enabled or user is not None or (options is not None and options.sort not in SORTS):
+            return None
+        snapshot = self.snapshot
+        if snapshot is None:
+            self.start(repo)
+        return snapshot
+
+    def start(self, repo) -> None:
+        """Load the snapshot in a background thread, unless it is loaded or loading."""
+        with self._pending_lock:
+            if self.snapshot is not None or self._loading:
+                return
+            self._loading = True
+        threading.Thread(target=self._load_logged, args=(repo,), name='public-replica', daemon=True).start()
+
+    def ensure_loaded(self, repo) -> None:
+        with self._pending_lock:
+            if self.snapshot is not None:
+                return
+            self._loading = True
+        self._load(repo)
+
+    def _load_logged(self, repo) -> None:
+        try:
+            self._load(repo)
+        except Exception:
+            metrics.increment('public_replica_errors')
+            traceback.print_exc()
+
+    def _load(self, repo) -> None:
+        with self.lock:
+            try:
+                if self.snapshot is not None:
+                    return
+                started = time.perf_counter()
+                intern, entries = Interner(), []
+                with DatabaseContext(shard_router.public_shard):
+                    for rows in repo.stream_prompt_rows():
+                        entries += [CatalogEntry(prompt, intern) for prompt in repo.hydrate_prompts(rows)]
+                snapshot = CatalogSnapshot.build(entries)
+                with self._pending_lock:
+                    pending, self._pending = self._pending, set()
+                    self._intern, self.snapshot = intern, snapshot
+                    self._loading = False
+                print(f"public replica: {len(entries)} prompts loaded in {time.perf_counter() - started:.3f}s")
+                if pending:
+                    self._patch(repo, pending)
+            finally:
+                with self._pending_lock:
+                    self._loading = False
+
+    def apply(self, repo, guids: Iterable[str]) -> None:
+        """Bring the given prompts up to date, after they were written."""
+        guids = {guid for guid in map(_normalize, guids) if guid is not None}
+        with self._pending_lock:
+            if self.snapshot is None:
+                if self._loading:
+                    self._pending.update(guids)
+                return
+        with self.lock:
+            if guids and self.snapshot is not None:
+                self._patch(repo, guids)
+
+    def _patch(self, repo, guids: set) -> None:
+        try:
+            with DatabaseContext(shard_router.public_shard):
+                prompts = repo.get_prompts_by_guids(sorted(guids))
+            self.snapshot = self.snapshot.patch(prompts, guids, self._intern)
+            self.refreshes += 1
+        except Exception:
+            # Serve from MySQL until a reload, rather than from a snapshot missing this write
+            metrics.increment('public_replica_errors')
+            traceback.print_exc()
+            self.snapshot = None
+
+    def stats(self) -> ReplicaStats:
+        snapshot = self.snapshot
+        if snapshot is None:
+            return ReplicaStats(enabled=self.enabled, loaded=False)
+        prompts, memory = len(snapshot.positions), snapshot.memory_bytes()
+        return ReplicaStats(enabled=self.enabled, loaded=True, prompts=prompts, tags=len(snapshot.by_tag),
+                            classifications=len(snapshot.by_classification), memory_bytes=memory,
+                            bytes_per_10k_prompts=memory * 10000 // prompts if prompts else 0,
+                            built_at=snapshot.built_at, refreshes=self.refreshes)
+
+
+public_replica = PublicReplica()
+
+
+def refresh_public_replica(repo, changes: List[PromptChange]) -> None:
+    """Patch the public prompts among the changes into the replica."""
+    guids = [change.guid for change in changes if change.author is None]
+    if guids:
+        public_replica.apply(repo, guids)
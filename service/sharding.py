@@ -0,0 +1,212 @@
+import time
+from typing import List, Optional
+
+from core.models import PromptRecord, ShardMove, ShardStats, User, construct_trusted
+from data import DatabaseContext, SHARD_COUNT
+from data.shards import shard_router, fan_out
+from .transaction import run_in_transaction
+
+BATCH_SIZE = 500  # Prompts copied per transaction
+
+
+def shard_stats(repo) -> List[ShardStats]:
+    """Prompt and author counts of every shard, read from all of them at once."""
+    directory = shard_router.directory() if shard_router.sharded else {}
+    pinned = [0] * SHARD_COUNT
+    for shard in directory.values():
+        if 0 <= shard < SHARD_COUNT:
+            pinned[shard] += 1
+
+    def count(shard: int) -> ShardStats:
+        with DatabaseContext(shard):
+            counts = repo.count_prompts()
+        return ShardStats(shard=shard, pinned_authors=pinned[shard], **counts)
+
+    return fan_out(count)
+
+
+def pin_authors(repo) -> int:
+    """
+    Pin every author with prompts to the shard holding them, so that routing no longer depends on
+    the ring; run before workers start with a shard added. Returns the number of authors pinned.
+    """
+    def authors(shard: int) -> List[int]:
+        with DatabaseContext(shard):
+            return repo.get_author_ids()
+
+    directory = shard_router.directory()
+    pinned = 0
+    for shard, author_ids in enumerate(fan_out(authors)):
+        for author_id in author_ids:
+            if author_id not in directory:
+                shard_router.place(author_id, shard)
+                pinned += 1
+    return pinned
+
+
+def plan_rebalance(limit: Optional[int] = None) -> List[ShardMove]:
+    """The moves that bring pinned authors to the shard the ring places them on now."""
+    moves = []
+    for author_id, shard in sorted(shard_router.directory().items()):
+        target = shard_router.ring.shard_for(author_id)
+        if target != shard:
+            moves.append(ShardMove(author_id=author_id, source=shard, target=target))
+            if limit is not None and len(moves) >= limit:
+                break
+    return moves
+
+
+def move_author(repo, author_id: int, target: int) -> ShardMove:
+    """
+    Move an author's prompts to another shard while the service is up.
+
+    The move is recorded on the source first. The prompts, their revisions and use counts are
+    copied while the author keeps writing to the source. Writes are then fenced off on the source,
+    which waits for those in flight, and the prompts that changed meanwhile are copied again along
+    with every use count. Once the directory points at the target, the source copies are removed
+    after DIRECTORY_TTL, when no worker routes there any more; writes in between fail with a 503
+    and are retried by the client, and uses are held back by the workers until they reach the
+    target. Nothing is logged to the change logs: the prompts keep their guids and content, so no
+    index needs refreshing, but the author's change log cursors expire.
+
+    A move that fails before the directory is updated is rolled back; one interrupted past that,
+    or by the process dying, stays recorded for `resume_move` or `abort_move`.
+    """
+    source = shard_router.shard_for(author_id)
+    if source == target:
+        return ShardMove(author_id=author_id, source=source, target=target)
+    if not 0 <= target < SHARD_COUNT:
+        raise ValueError(f"Shard {target} is not one of the {SHARD_COUNT} configured shards.")
+    if _recorded_move(repo, author_id) is not None:
+        raise ValueError(f"A move of author {author_id} is already recorded; resume or abort it first.")
+    run_in_transaction(lambda: repo.begin_author_move(author_id, target), _error_message(author_id, target),
+                       shard=source)
+    return _run_move(repo, ShardMove(author_id=author_id, source=source, target=target))
+
+
+def resume_move(repo, author_id: int) -> ShardMove:
+    """Finish an interrupted move of an author, from wherever it stopped."""
+    move = _recorded_move(repo, author_id)
+    if move is None:
+        raise ValueError(f"No move of author {author_id} is recorded.")
+    return _run_move(repo, move)
+
+
+def abort_move(repo, author_id: int) -> ShardMove:
+    """Drop the copies of an interrupted move and let the author write to the source again."""
+    move = _recorded_move(repo, author_id)
+    if move is None:
+        raise ValueError(f"No move of author {author_id} is recorded.")
+    if shard_router.placement(author_id) == move.target:
+        raise ValueError(f"Author {author_id} is already routed to shard {move.target}; resume the move instead.")
+    _roll_back(repo, move)
+    return move
+
+
+def _run_move(repo, move: ShardMove) -> ShardMove:
+    author_id, source, target = move.author_id, move.source, move.target
+    author = _scope(author_id)
+    error_message = _error_message(author_id, target)
+
+    if shard_router.placement(author_id) == target:
+        copied = len(_guids(repo, author, target))
+    else:
+        try:
+            # Copies already on the target from an interrupted run are left alone, then reconciled
+            for prompts in _author_prompts(repo, author, source):
+                _copy(repo, prompts, source, target, error_message)
+            run_in_transaction(lambda: repo.fence_author(author_id, target), error_message, shard=source)
+            copied = _reconcile(repo, author, source, target, error_message)
+            shard_router.place(author_id, target)
+        except Exception:
+            # Nothing routes to the copies unless the directory was updated before the failure; if it
+            # was, or the placement cannot be read, the move stays recorded for a resume
+            if shard_router.placement(author_id) != target:
+                _roll_back(repo, move)
+            raise
+    time.sleep(shard_router.ttl)
+
+    guids = _guids(repo, author, source)
+
+    def drop_source():
+        repo.purge_prompts(guids)
+        repo.unfence_author(author_id)
+
+    run_in_transaction(drop_source, error_message, shard=source)
+    return ShardMove(author_id=author_id, source=source, target=target, prompts=copied)
+
+
+def _roll_back(repo, move: ShardMove) -> None:
+    author = _scope(move.author_id)
+    error_message = _error_message(move.author_id, move.target)
+    guids = _guids(repo, author, move.target)
+    run_in_transaction(lambda: repo.purge_prompts(guids), error_message, shard=move.target)
+    run_in_transaction(lambda: repo.unfence_author(move.author_id), error_message, shard=move.source)
+
+
+def _recorded_move(repo, author_id: int) -> Optional[ShardMove]:
+    """The author's move recorded on any shard, which is its source."""
+    def read(shard: int) -> Optional[dict]:
+        with DatabaseContext(shard):
+            return repo.get_author_move(author_id)
+
+    for source, recorded in enumerate(fan_out(read)):
+        if recorded is not None:
+            return ShardMove(author_id=author_id, source=source, target=recorded['target'])
+    return None
+
+
+def _error_message(author_id: int, target: int) -> str:
+    return f"An error occurred while moving author {author_id} to shard {target}."
+
+
+def _scope(author_id: int) -> User:
+    # Only the id is read, to restrict queries to the author's prompts
+    return construct_trusted(User, id=author_id)
+
+
+def _author_prompts(repo, author: User, shard: int):
+    for rows in repo.stream_prompt_rows(author, batch_size=BATCH_SIZE, shard=shard):
+        with DatabaseContext(shard):
+            prompts = repo.hydrate_prompts(rows)
+        yield prompts
+
+
+def _guids(repo, author: User, shard: int) -> List[str]:
+    return [prompt.guid for prompts in _author_prompts(repo, author, shard) for prompt in prompts]
+
+
+def _copy(repo, prompts, source: int, target: int, error_message: str) -> List[PromptRecord]:
+    """Insert prompts on the target, with their history; those already there are left alone."""
+    with DatabaseContext(source):
+        history = repo.get_prompt_history([prompt.guid for prompt in prompts])
+    records = [PromptRecord.model_validate(prompt.model_dump(exclude={'id'})) for prompt in prompts]
+
+    def insert():
+        inserted = repo.bulk_insert_prompts(records)
+        repo.put_prompt_history({record.guid: history[record.guid] for record in inserted if record.guid in history})
+        return inserted
+
+    return run_in_transaction(insert, error_message, shard=target)
+
+
+def _reconcile(repo, author: User, source: int, target: int, error_message: str) -> int:
+    """
+    Bring the target's copies in line with the fenced source: re-copy changed prompts, drop
+    deleted ones and overwrite every use count, which kept changing after the copy. Returns the
+    number of prompts the author has.
+    """
+    expected = {prompt.guid: prompt for prompts in _author_prompts(repo, author, source) for prompt in prompts}
+    copied = {prompt.guid: prompt for prompts in _author_prompts(repo, author, target) for prompt in prompts}
+    stale = [guid for guid, prompt in copied.items()
+             if guid not in expected or expected[guid].model_dump(exclude={'id'}) != prompt.model_dump(exclude={'id'})]
+    run_in_transaction(lambda: repo.purge_prompts(stale), error_message, shard=target)
+    missing = [prompt for guid, prompt in expected.items() if guid not in copied or guid in stale]
+    for start in range(0, len(missing), BATCH_SIZE):
+        _copy(repo, missing[start:start + BATCH_SIZE], source, target, error_message)
+    guids = list(expected)
+    for start in range(0, len(guids), BATCH_SIZE):
+        with DatabaseContext(source):
+            usage = repo.get_usage_counts(guids[start:start + BATCH_SIZE])
+        run_in_transaction(lambda: repo.put_usage_counts(usage), error_message, shard=target)
+    return len(expected)
@@ -0,0 +1,131 @@
+from typing import Callable, List, Optional
+
+from core.exceptions import DataValidationError, RecordNotFoundError
+from core.models import TagRename, TagMerge, TagRetag, TagOperationResult, NameSuggestion, User
+from data.prompt_repository import PromptRepositoryInterface
+from data.shards import fan_out
+from .transaction import run_in_transaction
+from .trigram_index import name_index, note_names
+
+RETAG_SCOPES = ('all', 'public')
+
+
+class TagServiceInterface:
+
+    def rename_tag(self, rename: TagRename) -> TagOperationResult:
+        pass
+
+    def merge_tags(self, merge: TagMerge) -> TagOperationResult:
+        pass
+
+    def retag_prompts(self, retag: TagRetag) -> TagOperationResult:
+        pass
+
+    def suggest_names(self, prefix: str, limit: int = 10, user: Optional[User] = None) -> List[NameSuggestion]:
+        pass
+
+
+class TagService(TagServiceInterface):
+    """
+    Taxonomy maintenance across all prompts. Each operation is a handful of set-based statements
+    in one transaction and logs an update for every prompt it changes, so other workers, delta
+    sync mirrors and event subscribers see the new tags.
+
+    With several databases each shard has its own tags, and an operation runs on all of them at
+    once, one transaction per shard: it is atomic on each shard but not across them.
+    """
+
+    def __init__(self, repository: PromptRepositoryInterface):
+        self.repo = repository
+
+    def rename_tag(self, rename: TagRename) -> TagOperationResult:
+        """
+        Rename a tag on every prompt carrying it.
+
+        Raises:
+            RecordNotFoundError: If the tag doesn't exist.
+            ConstraintViolationError: If a tag with the new name already exists.
+        """
+        old_name, new_name = _clean(rename.old_name), _clean(rename.new_name)
+        affected = _on_every_shard(lambda: self.repo.rename_tag(old_name, new_name),
+                                   "An error occurred while renaming the tag.")
+        name_index.rename('tag', old_name, new_name)
+        return TagOperationResult(affected_prompts=affected)
+
+    def merge_tags(self, merge: TagMerge) -> TagOperationResult:
+        """
+        Retag every prompt carrying the source tag with the target, then delete the source tag.
+
+        Raises:
+            RecordNotFoundError: If the source tag doesn't exist.
+            DataValidationError: If both names are the same tag.
+        """
+        source, target = _clean(merge.source), _clean(merge.target)
+        affected = _on_every_shard(lambda: self.repo.merge_tags(source, target),
+                                   "An error occurred while merging the tags.")
+        name_index.rename('tag', source, target)
+        return TagOperationResult(affected_prompts=affected)
+
+    def retag_prompts(self, retag: TagRetag) -> TagOperationResult:
+        """
+        Add and remove tags on every prompt matching the filters.
+
+        Raises:
+            DataValidationError: If no filter or no tag change is given, a tag is both added and
+                removed, or the scope is unknown.
+        """
+        add = sorted({_clean(tag) for tag in retag.add})
+        remove = sorted({_clean(tag) for tag in retag.remove})
+        if not add and not remove:
+            raise DataValidationError("Nothing to do: give tags to add or remove.")
+        if set(add) & set(remove):
+            raise DataValidationError(f"Tags both added and removed: {', '.join(sorted(set(add) & set(remove)))}.")
+        if not (retag.tags or retag.classification or retag.query):
+            raise DataValidationError("A tags, classification or query filter is required.")
+        if retag.scope not in RETAG_SCOPES:
+            raise DataValidationError(f"Unknown scope '{retag.scope}', expected one of {', '.join(RETAG_SCOPES)}.")
+        tags_list = [tag for tag in retag.tags or [] if tag] or None
+
+        affected = _on_every_shard(
+            lambda: self.repo.retag_prompts(add, remove, tags_list, retag.classification, retag.query,
+                                            all_scopes=(retag.scope == 'all')),
+            "An error occurred while retagging prompts.")
+        # Added to prompts of any author, the names reach their private scopes with the next reload
+        if retag.scope == 'public':
+            note_names(add)
+        return TagOperationResult(affected_prompts=affected)
+
+    def suggest_names(self, prefix: str, limit: int = 10, user: Optional[User] = None) -> List[NameSuggestion]:
+        """
+        Tag and classification names for autocomplete, from the in-process name index: names
+        starting with the prefix first, shortest first, then names that begin like it despite typos.
+        Only names used by public prompts are suggested, and by the user's own prompts given a user.
+        """
+        name_index.ensure_loaded(self.repo)
+        return [NameSuggestion(name=name, kind=kind, score=round(score, 3))
+                for name, kind, score in name_index.suggest(prefix, limit, user.id if user else None)]
+
+
+def _on_every_shard(work: Callable[[], int], error_message: str) -> int:
+    """
+    Run `work` in a transaction on every shard and sum the prompts affected. A tag missing from
+    some shards affects none there; it is only not found when it is missing from all of them.
+    """
+    def run(shard: int) -> int:
+        try:
+            return run_in_transaction(work, error_message, shard=shard)
+        except RecordNotFoundError as e:
+            return e
+
+    results = fan_out(run)
+    found = [result for result in results if not isinstance(result, RecordNotFoundError)]
+    if not found:
+        raise results[0]
+    return sum(found)
+
+
+def _clean(name: str) -> str:
+    name = name.strip()
+    if not name:
+        raise DataValidationError("Tag names cannot be empty.")
+    return name
@@ -0,0 +1,266 @@
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import traceback
+import urllib.request
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+from core.instrumentation import Observer
+from .metrics import metrics
+
+# Share of requests traced; 0 traces none unless TRACE_SLOW_MS is set
+SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+# When set, every request is recorded and those at least this slow, or answered with a 5xx, are kept too
+SLOW_MS = float(os.getenv('TRACE_SLOW_MS')) if os.getenv('TRACE_SLOW_MS') else None
+# A file traces are appended to as JSON lines, or the URL of an OTLP/HTTP collector's /v1/traces
+EXPORT = os.getenv('TRACE_EXPORT', 'traces.jsonl')
+QUEUE_SIZE = int(os.getenv('TRACE_QUEUE_SIZE', '1000'))  # Traces waiting for export; more are dropped
+BATCH_SIZE = 64  # Traces per export
+MAX_SPANS = 2000  # Spans recorded per trace; more are counted, not kept
+MAX_STATEMENT = 2048  # Characters of a SQL statement kept in its span
+
+SERVICE_NAME = 'codepromptu'
+SPAN_KIND_INTERNAL, SPAN_KIND_SERVER, SPAN_KIND_CLIENT = 1, 2, 3
+STATUS_ERROR = 2
+
+_current_span: ContextVar[Optional[str]] = ContextVar('current_span', default=None)
+_whitespace = re.compile(r'\s+')
+_hex = re.compile(r'^[0-9a-f]{32}$')
+
+
+def span_id() -> str:
+    return '%016x' % random.getrandbits(64)
+
+
+def trace_id(request_id: Optional[str]) -> str:
+    """
+    OTLP trace ids are 32 hex digits: the request id, which is 128 random bits, so the tc= of a
+    log line finds its trace, or a random id for a request without one.
+    """
+    if request_id and _hex.match(request_id):
+        return request_id
+    return '%032x' % random.getrandbits(128)
+
+
+def _attributes(values: dict) -> List[dict]:
+    return [{'key': key, 'value': {'intValue': str(value)} if isinstance(value, int) else {'stringValue': value}}
+            for key, value in values.items() if value is not None]
+
+
+class Trace(Observer):
+    """
+    The spans of one request. Each span's parent is the span open in the context that started
+    it, so spans nest across the awaits and worker threads a request runs on.
+    """
+
+    def __init__(self, request_id: Optional[str], method: str, path: str, sampled: bool):
+        self.request_id = request_id
+        self.trace_id = trace_id(request_id)
+        self.root_id = span_id()
+        self.method = method
+        self.path = path
+        self.sampled = sampled
+        self.lock = threading.Lock()
+        self.spans = []  # (span id, parent id, layer, name, start ns, end ns, error)
+        self.dropped = 0
+        self.started_ns = time.perf_counter_ns()
+        self.wall_ns = time.time_ns()  # Wall clock at started_ns, to place the spans in time
+
+    def start(self, layer: str, name: str):
+        child = span_id()
+        parent = _current_span.get() or self.root_id
+        return child, parent, _current_span.set(child), time.perf_counter_ns()
+
+    def end(self, layer: str, name: str, handle, error: Optional[BaseException]) -> None:
+        ended = time.perf_counter_ns()
+        child, parent, token, started = handle
+        _current_span.reset(token)
+        with self.lock:
+            if len(self.spans) < MAX_SPANS:
+                self.spans.append((child, parent, layer, name, started, ended, error))
+            else:
+                self.dropped += 1
+
+    def to_otlp(self, status: int, ended_ns: int) -> List[dict]:
+        """The request's spans in OTLP JSON, the request itself as the root."""
+        root = {'traceId': self.trace_id, 'spanId': self.root_id, 'name': f"{self.method} {self.path}",
+                'kind': SPAN_KIND_SERVER, 'startTimeUnixNano': str(self.wall_ns),
+                'endTimeUnixNano': str(self.wall_ns + ended_ns - self.started_ns),
+                'attributes': _attributes({'http.request.method': self.method, 'url.path': self.path,
+                                           'http.response.status_code': status, 'request.id': self.request_id,
+                                           'spans.dropped': self.dropped or None})}
+        if status >= 500:
+            root['status'] = {'code': STATUS_ERROR}
+        spans = [root]
+        with self.lock:
+            recorded = list(self.spans)
+        for child, parent, layer, name, started, ended, error in recorded:
+            span = {'traceId': self.trace_id, 'spanId': child, 'parentSpanId': parent,
+                    'startTimeUnixNano': str(self.wall_ns + started - self.started_ns),
+                    'endTimeUnixNano': str(self.wall_ns + ended - self.started_ns)}
+            if layer == 'sql':
+                statement = _whitespace.sub(' ', name).strip()
+                span.update(name=statement.split(' ', 1)[0].upper(), kind=SPAN_KIND_CLIENT,
+                            attributes=_attributes({'layer': layer, 'db.system': 'mysql',
+                                                    'db.statement': statement[:MAX_STATEMENT]}))
+            else:
+                span.update(name=name or layer, kind=SPAN_KIND_INTERNAL, attributes=_attributes({'layer': layer}))
+            if error is not None:
+                span['status'] = {'code': STATUS_ERROR, 'message': type(error).__name__}
+            spans.append(span)
+        return spans
+
+
+def otlp_request(spans: List[dict]) -> dict:
+    """An OTLP ExportTraceServiceRequest, as sent to a collector's /v1/traces in JSON."""
+    return {'resourceSpans': [{
+        'resource': {'attributes': _attributes({'service.name': SERVICE_NAME})},
+        'scopeSpans': [{'scope': {'name': SERVICE_NAME}, 'spans': spans}],
+    }]}
+
+
+class TraceExporter:
+    """
+    Exports finished traces from a background thread, in batches, so requests never wait on it:
+    appended to a file as one OTLP JSON request per line, or POSTed to an OTLP/HTTP collector
+    when the target is a URL. Traces that arrive while the queue is full are dropped and counted.
+    """
+
+    def __init__(self, target: str = EXPORT, queue_size: int = QUEUE_SIZE):
+        self.target = target
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, spans: List[dict]) -> None:
+        try:
+            self.queue.put_nowait(spans)
+        except queue.Full:
+            metrics.increment('traces_dropped')
+            return
+        if self._thread is None:
+            with self.lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+                    self._thread.start()
+
+    def stop(self) -> None:
+        """Export what is queued, then stop the thread."""
+        with self.lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join(10)
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            traces = [spans for spans in batch if spans is not None]
+            if traces:
+                self.export(traces)
+            if batch[-1] is None:
+                return
+
+    def export(self, traces: List[List[dict]]) -> None:
+        body = json.dumps(otlp_request([span for spans in traces for span in spans]), separators=(',', ':'))
+        try:
+            if self.target.startswith(('http://', 'https://')):
+                request = urllib.request.Request(self.target, data=body.encode('utf-8'), method='POST',
+                                                 headers={'Content-Type': 'application/json'})
+                with urllib.request.urlopen(request, timeout=5) as response:
+                    response.read()
+            else:
+                with open(self.target, 'a', encoding='utf-8') as out:
+                    out.write(body + '\n')
+        except Exception:
+            traceback.print_exc()
+            metrics.increment('traces_dropped', len(traces))
+            return
+        metrics.increment('traces_exported', len(traces))
+
+
+class Tracer:
+    """
+    Decides which requests are traced. A request is sampled with probability `sample_rate`;
+    with `slow_ms` set every request is recorded and, once it has finished, kept if it was
+    sampled, took at least `slow_ms`, or failed with a 5xx, and discarded otherwise. While
+    neither is set, `begin` returns None and requests are not observed at all.
+    """
+
+    def __init__(self, sample_rate: float = SAMPLE_RATE, slow_ms: Optional[float] = SLOW_MS,
+                 exporter: Optional[TraceExporter] = None):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.exporter = exporter or TraceExporter()
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or self.slow_ms is not None
+
+    def begin(self, request_id: Optional[str], method: str, path: str) -> Optional[Trace]:
+        if not self.enabled:
+            return None
+        sampled = random.random() < self.sample_rate
+        if not sampled and self.slow_ms is None:
+            return None
+        return Trace(request_id, method, path, sampled)
+
+    def finish(self, trace: Trace, status: int) -> None:
+        ended = time.perf_counter_ns()
+        slow = self.slow_ms is not None and (ended - trace.started_ns) / 1e6 >= self.slow_ms
+        if trace.sampled or slow or status >= 500:
+            self.exporter.submit(trace.to_otlp(status, ended))
+        else:
+            metrics.increment('traces_discarded')
+
+
+tracer = Tracer()
+
+
+class _CollectorHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path != '/v1/traces' or self.headers.get('Content-Type', '').split(';')[0] != 'application/json':
+            self.send_error(404 if self.path != '/v1/traces' else 415)
+            return
+        try:
+            request = json.loads(body)
+        except ValueError:
+            self.send_error(400, "Invalid JSON")
+            return
+        with self.server.lock:
+            with open(self.server.output, 'a', encoding='utf-8') as out:
+                out.write(json.dumps(request, separators=(',', ':')) + '\n')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_collector(port: int, output: str) -> None:
+    """
+    A stand-in for an OpenTelemetry collector: accepts OTLP/HTTP JSON trace exports on
+    /v1/traces and appends each to `output` as a JSON line, for development without one.
+    """
+    server = ThreadingHTTPServer(('', port), _CollectorHandler)
+    server.lock = threading.Lock()
+    server.output = output
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,62 @@
+import os
+import random
+import time
+from typing import Callable, Tuple, Type, TypeVar
+
+from core.deadline import get_deadline
+from core.exceptions import PromptException, TransactionConflictError
+from data import DatabaseContext, transient_error_code, ER_LOCK_DEADLOCK
+from .metrics import metrics
+
+T = TypeVar('T')
+
+MAX_ATTEMPTS = int(os.getenv('TRANSACTION_MAX_ATTEMPTS', '4'))
+BASE_DELAY = float(os.getenv('TRANSACTION_RETRY_BASE_DELAY', '0.02'))  # Seconds before the first retry
+MAX_DELAY = float(os.getenv('TRANSACTION_RETRY_MAX_DELAY', '0.5'))
+
+
+def run_in_transaction(work: Callable[[], T], error_message: str,
+                       known_exceptions: Tuple[Type[Exception], ...] = (PromptException,), shard: int = 0) -> T:
+    """
+    Run `work` in a transaction on a fresh DatabaseContext, on the given shard, and return its result.
+
+    The whole unit of work is retried when it fails on a deadlock or lock wait timeout, up to
+    MAX_ATTEMPTS times with full-jitter exponential backoff, and never past the request deadline.
+    The connection goes back to the pool while backing off. `work` must therefore only touch the
+    database, with side effects such as index updates left until this returns.
+
+    Raises:
+        TransactionConflictError: When the retries are exhausted, answered with a 503 and Retry-After.
+        known_exceptions: Re-raised as they are.
+        PromptException: With error_message, for any other exception.
+    """
+    attempt = 1
+    while True:
+        with DatabaseContext(shard) as db:
+            try:
+                db.begin_transaction()
+                result = work()
+                db.commit_transaction()
+                return result
+            except Exception as e:
+                db.rollback_transaction()
+                failure = e
+
+        errno = transient_error_code(failure)
+        if errno is not None:
+            reason = 'deadlock' if errno == ER_LOCK_DEADLOCK else 'lock_wait_timeout'
+            delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** (attempt - 1)))
+            deadline = get_deadline()
+            remaining = deadline.remaining() if deadline is not None else None
+            if attempt < MAX_ATTEMPTS and (remaining is None or remaining > delay):
+                metrics.increment(f'transaction_retries.{reason}')
+                attempt += 1
+                time.sleep(delay)
+                continue
+            metrics.increment(f'transaction_retries_exhausted.{reason}')
+            # Checked before known_exceptions: repositories wrap driver errors as e.g. DataValidationError
+            raise TransactionConflictError() from failure
+
+        if isinstance(failure, known_exceptions):
+            raise failure
+        raise PromptException(error_message) from failure
@@ -0,0 +1,365 @@
+import bisect
+import heapq
+import math
+import os
+import re
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from core.models import PromptChange
+from data import DatabaseContext
+from data.shards import fan_out
+from .content_index import ContentIndex, content_indexes
+
+SIMILARITY = float(os.getenv('FUZZY_SIMILARITY', '0.4'))  # Least trigram similarity for a word to match
+MAX_EXPANSIONS = 8  # Vocabulary words a query word may match, most similar first
+MAX_CANDIDATES = 2000  # Prompts a query word adds to the candidates; the rest of a very common word's are skipped
+MAX_WORDS = 512  # Distinct words indexed per prompt
+NAMES_REFRESH_INTERVAL = float(os.getenv('NAMES_REFRESH_INTERVAL', '300'))  # Seconds between name reloads
+
+_word_pattern = re.compile(r'[^\W\d_]{3,}')
+
+
+def trigrams(text: str, whole: bool = True) -> Set[str]:
+    """
+    The trigrams of lowercase text, padded with two spaces in front and, for a whole word, one
+    behind, so short words and word boundaries count. A prefix is not padded behind.
+    """
+    padded = f"  {text} " if whole else f"  {text}"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(first: Set[str], second: Set[str]) -> float:
+    """Jaccard similarity of two trigram sets."""
+    shared = len(first & second)
+    return shared / (len(first) + len(second) - shared) if shared else 0.0
+
+
+class TrigramVocabulary:
+    """Distinct lowercase terms with a trigram -> term id inverted index, for misspelling-tolerant lookup."""
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.terms: Dict[int, str] = {}
+        self.grams: Dict[int, Set[str]] = {}
+        self.postings: Dict[str, Set[int]] = {}
+        self._next_id = 0
+
+    def add(self, term: str) -> int:
+        term_id = self.ids.get(term)
+        if term_id is None:
+            term_id = self._next_id
+            self._next_id += 1
+            self.ids[term], self.terms[term_id] = term_id, term
+            self.grams[term_id] = trigrams(term)
+            for gram in self.grams[term_id]:
+                self.postings.setdefault(gram, set()).add(term_id)
+        return term_id
+
+    def remove(self, term_id: int) -> None:
+        del self.ids[self.terms.pop(term_id)]
+        for gram in self.grams.pop(term_id):
+            postings = self.postings[gram]
+            postings.discard(term_id)
+            if not postings:
+                del self.postings[gram]
+
+    def candidates(self, grams: Set[str], least_shared: int) -> List[int]:
+        """Term ids sharing at least `least_shared` of the trigrams."""
+        counts = Counter()
+        for gram in grams:
+            postings = self.postings.get(gram)
+            if postings:
+                counts.update(postings)
+        return [term_id for term_id, shared in counts.items() if shared >= least_shared]
+
+    def similar(self, term: str, threshold: float, limit: int) -> List[Tuple[int, float]]:
+        """Up to `limit` (term id, similarity) pairs at or above the threshold, most similar first."""
+        grams = trigrams(term)
+        # Jaccard >= t needs at least t * |grams| shared trigrams, which prunes most candidates unscored
+        scored = ((term_id, similarity(grams, self.grams[term_id]))
+                  for term_id in self.candidates(grams, max(1, math.ceil(threshold * len(grams)))))
+        return heapq.nlargest(limit, ((term_id, score) for term_id, score in scored if score >= threshold),
+                              key=lambda match: match[1])
+
+
+def words(content: str) -> List[str]:
+    """The distinct lowercase words of at least three letters in the text, in first-seen order."""
+    return list(dict.fromkeys(word.lower() for word in _word_pattern.findall(content)))
+
+
+class FuzzyIndex(ContentIndex):
+    """
+    Prompt content words with a trigram vocabulary, for search that tolerates misspellings.
+
+    Each query word is matched to the vocabulary words whose trigrams are similar enough, and a
+    prompt scores, per query word, the best similarity among the words it contains, weighted by
+    that word's inverse document frequency. Query words are taken rarest first: the prompts they
+    find are the candidates, and a word found in more prompts than there are candidates only
+    re-ranks them, so a common word never walks its whole posting list.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.clear()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.vocabulary = TrigramVocabulary()
+            self.postings: Dict[int, Set[str]] = {}  # word id -> guids
+            self.words: Dict[str, List[int]] = {}  # guid -> word ids
+            self.authors: Dict[str, Optional[int]] = {}
+            self.scopes: Dict[Optional[int], Set[str]] = {}  # author_id -> guids
+
+    def add_batch(self, rows: List[dict]) -> None:
+        with self.lock:
+            for row in rows:
+                guid = row['guid']
+                self._remove(guid)
+                word_ids = [self.vocabulary.add(word) for word in words(row['content'])[:MAX_WORDS]]
+                for word_id in word_ids:
+                    self.postings.setdefault(word_id, set()).add(guid)
+                self.words[guid] = word_ids
+                self.authors[guid] = row['author_id']
+                self.scopes.setdefault(row['author_id'], set()).add(guid)
+
+    def _remove(self, guid: str) -> None:
+        word_ids = self.words.pop(guid, None)
+        if word_ids is None:
+            return
+        self.scopes[self.authors.pop(guid)].discard(guid)
+        for word_id in word_ids:
+            postings = self.postings[word_id]
+            postings.discard(guid)
+            if not postings:
+                del self.postings[word_id]
+                self.vocabulary.remove(word_id)
+
+    def search(self, query: str, author_id: Optional[int], limit: int,
+               threshold: float = SIMILARITY) -> List[Tuple[str, float]]:
+        """Return up to `limit` (guid, score) pairs for prompts in the author's scope, best first."""
+        with self.lock:
+            total, scope = len(self.words), self.scopes.get(author_id)
+            if not scope:
+                return []
+            expansions = []
+            for word in words(query):
+                weighted = [(self.postings[word_id], score * math.log(1 + total / len(self.postings[word_id])))
+                            for word_id, score in self.vocabulary.similar(word, threshold, MAX_EXPANSIONS)]
+                if weighted:
+                    expansions.append(sorted(weighted, key=lambda match: match[1], reverse=True))
+            expansions.sort(key=lambda weighted: sum(len(postings) for postings, _ in weighted))
+
+            scores: Dict[str, float] = {}
+            for weighted in expansions:
+                if scores and sum(len(postings) for postings, _ in weighted) > len(scores):
+                    for guid in scores:
+                        scores[guid] += next((weight for postings, weight in weighted if guid in postings), 0.0)
+                    continue
+                best: Dict[str, float] = {}
+                for postings, weight in weighted:
+                    # Walk the smaller of the word's prompts and the author's, best matching word first
+                    members, others = (postings, scope) if len(postings) <= len(scope) else (scope, postings)
+                    for guid in members:
+                        if guid in others and guid not in best:
+                            best[guid] = weight
+                            if len(best) >= MAX_CANDIDATES:
+                                break
+                for guid, weight in best.items():
+                    scores[guid] = scores.get(guid, 0.0) + weight
+            return heapq.nlargest(limit, scores.items(), key=lambda match: match[1])
+
+
+fuzzy_index = FuzzyIndex()
+content_indexes.append(fuzzy_index)
+
+
+class NameIndex:
+    """
+    Tag and classification names for autocomplete: names starting with the typed prefix first,
+    shortest first, then names whose beginning is similar to the prefix, to forgive typos.
+
+    Each name records the scopes it is used in, the authors whose prompts carry it (None for
+    public prompts), and is only suggested to callers who can see one of those scopes; names
+    no prompt carries are not suggested at all.
+
+    Loaded on first use and kept current by the write paths and the change poller; it is also
+    reloaded in the background every NAMES_REFRESH_INTERVAL seconds, which drops deleted names
+    and the scopes a name has left.
+    """
+
+    KINDS = ('tag', 'classification')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded_at: Optional[float] = None
+        self._reloading = False
+        self._clear()
+
+    def _clear(self) -> None:
+        self.names: Dict[str, Dict[str, str]] = {kind: {} for kind in self.KINDS}  # lowercase -> name
+        # lowercase -> the authors whose prompts carry the name, None for public prompts
+        self.scopes: Dict[str, Dict[str, Set[Optional[int]]]] = {kind: {} for kind in self.KINDS}
+        self.sorted: Dict[str, List[str]] = {kind: [] for kind in self.KINDS}
+        self.vocabularies = {kind: TrigramVocabulary() for kind in self.KINDS}
+
+    def ensure_loaded(self, repo) -> None:
+        if self.loaded_at is None:
+            with self.lock:
+                if self.loaded_at is None:
+                    self._load(repo)
+        elif time.monotonic() - self.loaded_at > NAMES_REFRESH_INTERVAL and not self._reloading:
+            self._reloading = True
+            threading.Thread(target=self._reload, args=(repo,), name='names-reload', daemon=True).start()
+
+    def _reload(self, repo) -> None:
+        try:
+            self._load(repo)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self._reloading = False
+
+    def _load(self, repo) -> None:
+        def load(shard: int) -> Dict[str, List[Tuple[str, Optional[int]]]]:
+            with DatabaseContext(shard):
+                return repo.get_label_names()
+
+        fresh = NameIndex()
+        for names in fan_out(load):
+            for kind in self.KINDS:
+                for name, author in names[kind]:
+                    fresh._add(kind, name, author)
+        with self.lock:
+            self.names, self.scopes = fresh.names, fresh.scopes
+            self.sorted, self.vocabularies = fresh.sorted, fresh.vocabularies
+            self.loaded_at = time.monotonic()
+
+    def add(self, kind: str, names: Iterable[str], author: Optional[int] = None) -> None:
+        """Add names used by a prompt of `author`, None for a public prompt."""
+        with self.lock:
+            for name in names:
+                self._add(kind, name, author)
+
+    def _add(self, kind: str, name: str, author: Optional[int]) -> None:
+        if not name:
+            return
+        key = name.lower()
+        if key not in self.names[kind]:
+            self.names[kind][key] = name
+            self.scopes[kind][key] = set()
+            bisect.insort(self.sorted[kind], key)
+            self.vocabularies[kind].add(key)
+        self.scopes[kind][key].add(author)
+
+    def remove(self, kind: str, name: str) -> None:
+        with self.lock:
+            key = name.lower()
+            if self.names[kind].pop(key, None) is not None:
+                del self.scopes[kind][key]
+                keys = self.sorted[kind]
+                del keys[bisect.bisect_left(keys, key)]
+                self.vocabularies[kind].remove(self.vocabularies[kind].ids[key])
+
+    def rename(self, kind: str, old_name: str, new_name: str) -> None:
+        """Replace a name by another, which takes over its scopes; also used for merges."""
+        with self.lock:
+            authors = self.scopes[kind].get(old_name.lower(), set())
+            self.remove(kind, old_name)
+            for author in authors:
+                self._add(kind, new_name, author)
+
+    def keys(self, kind: str) -> Set[str]:
+        with self.lock:
+            return set(self.names[kind])
+
+    def retain(self, kind: str, existing: Set[str], candidates: Set[str]) -> None:
+        """Drop the `candidates` (lowercase names, read before `existing` was) that are not in `existing`."""
+        with self.lock:
+            for key in candidates - existing:
+                self.remove(kind, key)
+
+    def suggest(self, prefix: str, limit: int, author: Optional[int] = None,
+                threshold: float = SIMILARITY) -> List[Tuple[str, str, float]]:
+        """
+        Up to `limit` (name, kind, score) suggestions among the names used by public prompts and,
+        given an author, by that author's prompts; prefix matches score 1.
+        """
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        visible_scopes = {None, author}
+        with self.lock:
+            def visible(kind: str, key: str) -> bool:
+                return not self.scopes[kind][key].isdisjoint(visible_scopes)
+
+            exact = []
+            for kind in self.KINDS:
+                keys = self.sorted[kind]
+                start = bisect.bisect_left(keys, prefix)
+                end = bisect.bisect_left(keys, prefix + '\uffff', start)
+                # Shortest first: the closest completions of what was typed
+                exact += [(len(key), key, kind) for key in
+                          heapq.nsmallest(limit, (key for key in keys[start:end] if visible(kind, key)), key=len)]
+            suggestions = [(self.names[kind][key], kind, 1.0) for _, key, kind in sorted(exact)[:limit]]
+            if len(suggestions) >= limit:
+                return suggestions
+
+            seen = {(name.lower(), kind) for name, kind, _ in suggestions}
+            grams = trigrams(prefix, whole=False)
+            fuzzy = []
+            for kind in self.KINDS:
+                vocabulary = self.vocabularies[kind]
+                for term_id in vocabulary.candidates(grams, max(1, math.ceil(threshold * len(grams)))):
+                    key = vocabulary.terms[term_id]
+                    if (key, kind) in seen or not visible(kind, key):
+                        continue
+                    # Against beginnings one letter shorter and longer too, for a dropped or doubled letter
+                    score = max(similarity(grams, trigrams(key[:length], whole=False))
+                                for length in range(len(prefix) - 1, len(prefix) + 2))
+                    if score >= threshold:
+                        fuzzy.append((score, self.names[kind][key], kind))
+            fuzzy = heapq.nlargest(limit - len(suggestions), fuzzy, key=lambda match: (match[0], -len(match[1])))
+            return suggestions + [(name, kind, score) for score, name, kind in fuzzy]
+
+
+name_index = NameIndex()
+
+
+def note_names(tags: Optional[Iterable[str]] = None, classification: Optional[str] = None,
+               author: Optional[int] = None) -> None:
+    """Add names a committed write to a prompt of `author` (None if public) may have created, if the index is loaded."""
+    if name_index.loaded_at is not None:
+        name_index.add('tag', tags or [], author)
+        name_index.add('classification', [classification] if classification else [], author)
+
+
+def refresh_names(repo, changes: List[PromptChange]) -> None:
+    """
+    Add the names carried by prompts written by other workers, and drop the tags those writes
+    renamed or merged away, which no longer exist on any shard. Only the entries logged by a tag
+    rename or merge trigger that read of every tag name; other dropped names wait for the
+    NAMES_REFRESH_INTERVAL reload.
+    """
+    if name_index.loaded_at is None:
+        return
+    by_shard: Dict[int, Dict[str, Optional[int]]] = {}
+    for change in changes:
+        if change.op != 'delete':
+            by_shard.setdefault(change.shard, {})[change.guid] = change.author
+    for shard, authors in by_shard.items():
+        with DatabaseContext(shard):
+            labels = repo.get_prompt_labels(list(authors))
+        for guid, label in labels.items():
+            note_names(label['tags'], label['classification'], authors[guid])
+    if any(change.tag_renamed for change in changes):
+        def load(shard: int) -> List[str]:
+            with DatabaseContext(shard):
+                return repo.get_tag_names()
+
+        # Only names indexed before the read: one added by a write committed since must stay
+        candidates = name_index.keys('tag')
+        name_index.retain('tag', {name.lower() for names in fan_out(load) for name in names}, candidates)
@@ -0,0 +1,126 @@
+import os
+import threading
+import traceback
+from collections import Counter
+from typing import Optional
+
+from data.shards import shard_router
+from .metrics import metrics
+from .transaction import run_in_transaction
+
+FLUSH_INTERVAL = float(os.getenv('USAGE_FLUSH_INTERVAL', '10'))  # Seconds between flushes to prompt_usage
+# Uses held in memory before a flush is forced: the most a worker loses if it crashes
+MAX_PENDING = int(os.getenv('USAGE_MAX_PENDING', '10000'))
+
+
+class UsageCounters:
+    """
+    Per-worker prompt use counters, written behind the read path.
+
+    `record` only bumps an in-memory counter. A background thread adds the counts to the
+    prompt_usage table every FLUSH_INTERVAL seconds, or as soon as MAX_PENDING uses are held,
+    with one batched upsert. A crash loses at most MAX_PENDING uses; if a flush fails the counts
+    are kept for the next one, and beyond MAX_PENDING the least used are dropped and counted.
+    Counts are kept per shard and each shard's are written to its own prompt_usage. Those of an
+    author being moved off a shard are held back by author, and written to whichever shard the
+    author is routed to at a later flush.
+    """
+
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL, max_pending: int = MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.repo = None
+        self.lock = threading.Lock()
+        self.counts = Counter()  # (shard, guid) -> uses
+        self.held = Counter()  # (author id, guid) -> uses held back during a move
+        self.pending = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def record(self, guid: str, shard: int = 0) -> None:
+        with self.lock:
+            self.counts[(shard, guid)] += 1
+            self.pending += 1
+            full = self.pending >= self.max_pending
+        if full:
+            self._wake.set()
+
+    def start(self, repo) -> None:
+        self.repo = repo
+        self._thread = threading.Thread(target=self._run, name='usage-flusher', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the flusher after a last flush."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(self.flush_interval + 5)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """Write the pending counts; returns the number of uses written."""
+        with self.lock:
+            counts, self.counts = self.counts, Counter()
+            held, self.held = self.held, Counter()
+            self.pending = 0
+        by_shard = {}  # shard -> (uses by guid, counts and held uses to restore if the write fails)
+        for (shard, guid), count in counts.items():
+            uses, restore, restore_held = by_shard.setdefault(shard, (Counter(), Counter(), Counter()))
+            uses[guid] += count
+            restore[(shard, guid)] += count
+        for (author_id, guid), count in held.items():
+            try:
+                shard = shard_router.shard_for(author_id)
+            except Exception:
+                traceback.print_exc()
+                self._restore(Counter(), Counter({(author_id, guid): count}), count)
+                continue
+            uses, restore, restore_held = by_shard.setdefault(shard, (Counter(), Counter(), Counter()))
+            uses[guid] += count
+            restore_held[(author_id, guid)] += count
+        written = 0
+        for shard, (uses, restore, restore_held) in by_shard.items():
+            total = sum(uses.values())
+            try:
+                held_back = run_in_transaction(lambda: self.repo.add_prompt_usage(uses),
+                                               "An error occurred while flushing prompt usage.", shard=shard)
+            except Exception:
+                traceback.print_exc()
+                self._restore(restore, restore_held, total)
+                continue
+            if held_back:
+                self._restore(Counter(), held_back, sum(held_back.values()))
+            written += total - sum(held_back.values())
+        if written:
+            metrics.increment('usage_flushed', written)
+        return written
+
+    def _restore(self, counts: Counter, held: Counter, total: int) -> None:
+        with self.lock:
+            room = self.max_pending - self.pending
+            if total > room:
+                # Keep the most used prompts' counts; the rest are lost
+                kept, kept_held, kept_total = Counter(), Counter(), 0
+                entries = [(count, kept, key) for key, count in counts.items()] + \
+                          [(count, kept_held, key) for key, count in held.items()]
+                for count, into, key in sorted(entries, key=lambda entry: entry[0], reverse=True):
+                    if kept_total + count > room:
+                        break
+                    into[key] = count
+                    kept_total += count
+                metrics.increment('usage_dropped', total - kept_total)
+                counts, held, total = kept, kept_held, kept_total
+            self.counts.update(counts)
+            self.held.update(held)
+            self.pending += total
+
+
+usage_counters = UsageCounters()
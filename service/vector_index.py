@@ -0,0 +1,161 @@
+import atexit
+import math
+import os
+import re
+import tempfile
+import zlib
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .content_index import ContentIndex, content_indexes
+
+DIM = int(os.getenv('VECTOR_INDEX_DIM', '256'))
+INITIAL_CAPACITY = 1024
+SCAN_CHUNK_ROWS = 65536  # Rows scored per matrix product; bounds the temporary score matrix
+PUBLIC_AUTHOR = -1  # Stored in place of NULL author_id
+
+_token_pattern = re.compile(r'\w+')
+
+
+def embed(content: str) -> np.ndarray:
+    """
+    Embed text with the hashing trick: unigrams and bigrams are hashed into DIM signed
+    buckets weighted by 1 + log(tf), and the vector is L2-normalized. No model, no network.
+    """
+    words = _token_pattern.findall(content.lower())
+    features = Counter(words)
+    features.update(f"{first} {second}" for first, second in zip(words, words[1:]))
+
+    vector = np.zeros(DIM, dtype=np.float32)
+    for feature, tf in features.items():
+        h = zlib.crc32(feature.encode('utf-8'))
+        vector[h % DIM] += (1.0 if h & 0x80000000 else -1.0) * (1.0 + math.log(tf))
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class VectorIndex(ContentIndex):
+    """
+    Hashed TF-IDF vectors in a memory-mapped float32 matrix, for "find prompts like this text".
+
+    Rows are addressed through a guid -> row map; deleted rows are recycled. Stored vectors carry
+    term frequencies only, and IDF weights from document frequencies maintained incrementally per
+    bucket are applied to both the query and each scanned row, so inserts never rewrite existing
+    rows. Queries scan the matrix in chunks with one matrix product per chunk, so the page cache
+    rather than the Python heap holds the vectors (1M prompts at 256 dimensions is a 1GB file).
+    The scan runs outside the lock, over the rows as they were when it started.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        super().__init__()
+        # The backing file is created by the first clear(), when the index is built, not at import
+        self.path = path
+        self.rows: Dict[str, int] = {}
+
+    def clear(self) -> None:
+        with self.lock:
+            if self.path is None:
+                fd, self.path = tempfile.mkstemp(prefix='codepromptu-vectors-', suffix='.f32',
+                                                 dir=os.getenv('VECTOR_INDEX_DIR'))
+                os.close(fd)
+                atexit.register(os.remove, self.path)
+            self.capacity = INITIAL_CAPACITY
+            self.matrix = np.memmap(self.path, dtype=np.float32, mode='w+', shape=(self.capacity, DIM))
+            self.authors = np.full(self.capacity, PUBLIC_AUTHOR, dtype=np.int64)
+            self.valid = np.zeros(self.capacity, dtype=bool)
+            self.rows: Dict[str, int] = {}
+            self.guids: List[Optional[str]] = []
+            self.free_rows: List[int] = []
+            self.df = np.zeros(DIM, dtype=np.int64)
+
+    def _grow(self) -> None:
+        capacity = self.capacity * 2
+        self.matrix.flush()
+        del self.matrix
+        with open(self.path, 'r+b') as f:
+            f.truncate(capacity * DIM * 4)
+        self.matrix = np.memmap(self.path, dtype=np.float32, mode='r+', shape=(capacity, DIM))
+        self.authors = np.concatenate([self.authors, np.full(capacity - self.capacity, PUBLIC_AUTHOR, np.int64)])
+        self.valid = np.concatenate([self.valid, np.zeros(capacity - self.capacity, dtype=bool)])
+        self.capacity = capacity
+
+    def add_batch(self, rows: List[dict]) -> None:
+        vectors = [embed(row['content']) for row in rows]
+        with self.lock:
+            for row, vector in zip(rows, vectors):
+                guid = row['guid']
+                self._remove(guid)
+                if self.free_rows:
+                    index = self.free_rows.pop()
+                else:
+                    index = len(self.guids)
+                    if index == self.capacity:
+                        self._grow()
+                    self.guids.append(None)
+                self.matrix[index] = vector
+                self.authors[index] = PUBLIC_AUTHOR if row['author_id'] is None else row['author_id']
+                self.valid[index] = True
+                self.rows[guid] = index
+                self.guids[index] = guid
+                self.df += vector != 0
+
+    def _remove(self, guid: str) -> None:
+        index = self.rows.pop(guid, None)
+        if index is None:
+            return
+        self.df -= self.matrix[index] != 0
+        self.valid[index] = False
+        self.guids[index] = None
+        self.free_rows.append(index)
+
+    def search(self, text: str, author_id: Optional[int], k: int = 10) -> List[Tuple[str, float]]:
+        return self.search_batch([text], author_id, k)[0]
+
+    def search_batch(self, texts: List[str], author_id: Optional[int],
+                     k: int = 10) -> List[List[Tuple[str, float]]]:
+        """Return the top-k (guid, cosine score) pairs in the author's scope for each query text."""
+        embedded = np.stack([embed(text) for text in texts])
+        owner = PUBLIC_AUTHOR if author_id is None else author_id
+        with self.lock:
+            # The matrix itself is not copied: a write may change a row meanwhile, which the results are checked for
+            used = len(self.guids)
+            matrix, guids = self.matrix, list(self.guids)
+            in_scope = self.valid[:used] & (self.authors[:used] == owner)
+            idf = np.log((1.0 + len(self.rows)) / (1.0 + self.df)).astype(np.float32) + 1.0
+
+        queries = embedded * idf
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries /= np.where(norms == 0, 1, norms)
+        best_scores = np.empty((len(texts), 0), dtype=np.float32)
+        best_rows = np.empty((len(texts), 0), dtype=np.int64)
+        for start in range(0, used, SCAN_CHUNK_ROWS):
+            end = min(start + SCAN_CHUNK_ROWS, used)
+            block = matrix[start:end] * idf
+            block_norms = np.linalg.norm(block, axis=1)
+            scores = (queries @ block.T) / np.where(block_norms == 0, 1, block_norms)
+            scores[:, ~in_scope[start:end]] = -np.inf
+            # Keep a running top-k per query across chunks
+            scores = np.concatenate([best_scores, scores], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, end), (len(texts), end - start))],
+                                  axis=1)
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                rows = np.take_along_axis(rows, top, axis=1)
+            best_scores, best_rows = scores, rows
+
+        results = []
+        with self.lock:
+            for scores, rows in zip(best_scores, best_rows):
+                order = np.argsort(-scores, kind='stable')
+                # A row recycled for another prompt during the scan is left out
+                results.append([(guids[rows[i]], float(scores[i])) for i in order
+                                if np.isfinite(scores[i]) and scores[i] > 0
+                                and self.rows.get(guids[rows[i]]) == rows[i]])
+        return results
+
+
+vector_index = VectorIndex()
+content_indexes.append(vector_index)
@@ -1,46 +1,100 @@
+import os
 from typing import Optional
 
-from fastapi import Depends, HTTPException, Security
+from fastapi import Depends, HTTPException, Query, Security
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 import secrets
 
-from core.models import User
+from core.deadline import get_deadline
+from core.instrumentation import instrument, span
+from core.models import User, PromptQueryOptions
 from data.prompt_repository import MySQLPromptRepository, PromptRepositoryInterface
 from data.user_repository import MySQLUserRepository, UserRepositoryInterface
+from service.catalog_service import CatalogServiceInterface, CatalogService
 from service.prompt_service import PromptServiceInterface, PromptService
+from service.tag_service import TagServiceInterface, TagService
 from service.user_service import UserServiceInterface, UserService
 
 security = HTTPBasic()
 
 
 def get_prompt_repository() -> PromptRepositoryInterface:
-    return MySQLPromptRepository()
+    return instrument(MySQLPromptRepository(), 'repository')
 
 
 def get_user_repository() -> UserRepositoryInterface:
-    return MySQLUserRepository()
+    return instrument(MySQLUserRepository(), 'repository')
 
 
 def get_prompt_service(repo: PromptRepositoryInterface = Depends(get_prompt_repository)) -> PromptServiceInterface:
-    return PromptService(repo)
+    return instrument(PromptService(repo), 'service')
 
 
 def get_user_service(repo: UserRepositoryInterface = Depends(get_user_repository)) -> UserServiceInterface:
-    return UserService(repo)
+    return instrument(UserService(repo), 'auth')
+
+
+def get_catalog_service(repo: PromptRepositoryInterface = Depends(get_prompt_repository)) -> CatalogServiceInterface:
+    return instrument(CatalogService(repo), 'service')
+
+
+def get_tag_service(repo: PromptRepositoryInterface = Depends(get_prompt_repository)) -> TagServiceInterface:
+    return instrument(TagService(repo), 'service')
+
+# Per-route deadline defaults, in seconds, for routes that differ from REQUEST_TIMEOUT
+SEARCH_REQUEST_TIMEOUT = float(os.getenv('SEARCH_REQUEST_TIMEOUT', '10'))
+
+
+def route_deadline(timeout: Optional[float]):
+    """A route dependency setting the request's deadline unless the client sent X-Request-Timeout; None lifts it."""
+    def dependency() -> None:
+        deadline = get_deadline()
+        if deadline is not None:
+            deadline.apply_default(timeout)
+    return dependency
+
+
+def get_query_options(fields: Optional[str] = Query(None, description="Comma-separated prompt fields to return, "
+                                                                       "e.g. guid,tags,updated_at")
+                      ) -> PromptQueryOptions:
+    return PromptQueryOptions(fields=[field.strip() for field in fields.split(',') if field.strip()] if fields else None)
+
+
+def get_sorted_options(sort: str = Query('id', description="'id', 'popular' for the most used first, "
+                                                             "or 'tokens' or 'chars' for the shortest first"),
+                       min_tokens: Optional[int] = Query(None, ge=0, description="Only prompts of at least this "
+                                                                                 "many (approximate) tokens"),
+                       max_tokens: Optional[int] = Query(None, ge=0, description="Only prompts of at most this "
+                                                                                 "many (approximate) tokens"),
+                       options: PromptQueryOptions = Depends(get_query_options)) -> PromptQueryOptions:
+    return options.model_copy(update={'sort': sort, 'min_tokens': min_tokens, 'max_tokens': max_tokens})
+
+
+def get_list_options(skip: int = 0, limit: int = 10,
+                     options: PromptQueryOptions = Depends(get_sorted_options)) -> PromptQueryOptions:
+    return options.model_copy(update={'skip': skip, 'limit': limit})
+
 
 def require_admin_user(credentials: HTTPBasicCredentials = Depends(security),
                         user_service: UserService = Depends(get_user_service)) -> Optional[User]:
-    user = user_service.get_user_by_username(credentials.username)
-    if user is not None and credentials.password == user.password and user.username == "steve72":
-        return user
-    return None
+    with span('auth', 'require_admin_user'):
+        user = user_service.get_user_by_username(credentials.username)
+        if user is not None and credentials.password == user.password and user.username == "steve72":
+            return user
+        return None
 
 def require_current_user(credentials: HTTPBasicCredentials = Depends(security),
                          user_service: UserService = Depends(get_user_service)) -> User:
-    user = user_service.get_user_by_username(credentials.username)
+    with span('auth', 'require_current_user'):
+        user = user_service.get_user_by_username(credentials.username)
 
-    if user is None or not credentials.password == user.password:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
+        if user is None or not credentials.password == user.password:
+            raise HTTPException(status_code=401, detail="Invalid credentials")
 
-    return user
+        return user
 
+
+def require_admin(user: Optional[User] = Depends(require_admin_user)) -> User:
+    if user is None:
+        raise HTTPException(status_code=403, detail="Admin user required")
+    return user
@@ -0,0 +1,74 @@
+import os
+from typing import AsyncIterator, Optional
+
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from core.exceptions import CursorExpiredError
+from core.models import PromptEvent, User
+from service.prompt_service import PromptServiceInterface
+from web.responses import dumps
+
+HEARTBEAT_INTERVAL = float(os.getenv('EVENTS_HEARTBEAT_INTERVAL', '15'))  # Seconds between keep-alive comments
+
+
+def _format(event: PromptEvent) -> bytes:
+    return b"id: %d\nevent: %s\ndata: %s\n\n" % (event.seq, event.op.encode(), dumps(event.__dict__))
+
+
+def _notice(name: str, data: dict, event_id: Optional[int] = None) -> bytes:
+    notice = b"event: %s\ndata: %s\n\n" % (name.encode(), dumps(data))
+    return notice if event_id is None else b"id: %d\n" % event_id + notice
+
+
+async def _stream(service: PromptServiceInterface, user: Optional[User], tags: Optional[str],
+                  classification: Optional[str], last_event_id: Optional[int]) -> AsyncIterator[bytes]:
+    # Subscribe before replaying, so nothing written during the replay is missed
+    subscription = service.subscribe_events(user, tags, classification)
+    try:
+        # The replay covers what was committed before the first live event; the seqs it sent are not
+        # sent again when they are also received live
+        replayed = set()
+        cursor = last_event_id
+        while cursor is not None:
+            try:
+                events, next_cursor, more = await run_in_threadpool(service.get_events_since, cursor, user,
+                                                                    before=subscription.first_seq)
+            except CursorExpiredError as e:
+                yield _notice('reset', {'detail': str(e)})
+                break
+            for event in events:
+                if subscription.matches(event):
+                    replayed.add(event.seq)
+                    yield _format(event)
+            cursor = next_cursor
+            if not more:
+                break
+
+        while True:
+            events, dropped, lowest_dropped = await subscription.get(HEARTBEAT_INTERVAL)
+            if dropped:
+                # The events still pending are newer than some dropped ones, so sending them would move the
+                # client's Last-Event-ID past the gap. End the stream instead, with the notice's id set
+                # below everything undelivered: a client reconnecting from it is replayed all of it
+                resume = min([event.seq for event in events] + [lowest_dropped]) - 1
+                yield _notice('overflow', {'dropped': dropped, 'last_event_id': resume}, event_id=resume)
+                break
+            if not events:
+                yield b": keep-alive\n\n"
+            for event in events:
+                if event.seq not in replayed:
+                    yield _format(event)
+    finally:
+        service.unsubscribe_events(subscription)
+
+
+def event_stream_response(service: PromptServiceInterface, user: Optional[User], tags: Optional[str],
+                          classification: Optional[str], last_event_id: Optional[int]) -> StreamingResponse:
+    """
+    A text/event-stream of prompt writes in the user's scope. Each event's id is its change log
+    seq, so a client reconnecting with Last-Event-ID is first sent the events it missed.
+    """
+    return StreamingResponse(_stream(service, user, tags, classification, last_event_id),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -1,13 +1,23 @@
+import asyncio
 import hashlib
 import logging
-import socket
+import os
 import threading
+import time
 from datetime import datetime
 
 from fastapi import Request, Response
 from starlette.middleware.base import BaseHTTPMiddleware
 
+from core.deadline import Deadline, set_deadline, reset_deadline
+from core.instrumentation import attach, detach, span
 from service import set_request_id, get_request_id
+from service.profiling import profiler
+from service.tracing import tracer
+
+# Seconds a request may run when neither the client nor the route asks for a different limit
+DEFAULT_REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', '30'))
+MAX_REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT_MAX', '120'))
 
 
 class RequestIdMiddleware(BaseHTTPMiddleware):
@@ -18,18 +28,15 @@ class RequestIdMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
         request_id = self._generate_request_id()
         set_request_id(request_id)
+        request.scope["request_id"] = request_id  # For the middleware inside, which may run on another task
         response: Response = await call_next(request)
         set_request_id("")
         return response
 
     @staticmethod
     def _generate_request_id():
-        current_time = datetime.now().strftime('%Y%m%d%H%M%S%f')
-        thread_id = threading.current_thread().ident
-        hostname = socket.gethostname()
-        request_id = f"{current_time}-{thread_id}-{hostname}"
-
-        return _hashify(request_id)
+        # 128 random bits, as 32 hex digits: unique enough to double as the request's trace id
+        return os.urandom(16).hex()
 
 
 def _hashify(request_id):
@@ -75,3 +82,137 @@ class LoggingMiddleware(BaseHTTPMiddleware):
                       + f"[{thread_id}] REQUEST END: {request_method} {request_uri} "
                       + f"response=\"{status_code}\" duration=\"{duration}ms\"")
         print(log_string)
+
+
+class DeadlineMiddleware:
+    """
+    Gives each request a Deadline, from the X-Request-Timeout header (seconds) or the default,
+    and cancels it when the client disconnects.
+
+    A plain ASGI middleware rather than a BaseHTTPMiddleware, because noticing the disconnect
+    means reading `receive` while the endpoint runs; the messages read are passed on to the
+    app through a queue.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        deadline = self._make_deadline(dict(scope["headers"]).get(b"x-request-timeout"))
+        messages = asyncio.Queue(maxsize=16)
+
+        async def watch_client():
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    deadline.cancel()
+                    return
+
+        watcher = asyncio.create_task(watch_client())
+        token = set_deadline(deadline)
+        try:
+            await self.app(scope, messages.get, send)
+        finally:
+            reset_deadline(token)
+            watcher.cancel()
+
+    @staticmethod
+    def _make_deadline(header):
+        try:
+            timeout = float(header) if header else 0
+        except ValueError:
+            timeout = 0
+        if timeout > 0:
+            return Deadline(min(timeout, MAX_REQUEST_TIMEOUT), explicit=True)
+        return Deadline(DEFAULT_REQUEST_TIMEOUT)
+
+
+class ProfilingMiddleware:
+    """
+    Profiles the requests claimed by an admin-armed profile session. Added outermost, so a
+    profile's duration covers the whole middleware stack; while no session is armed, requests
+    pass straight through.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not profiler.sessions:
+            await self.app(scope, receive, send)
+            return
+        header = dict(scope["headers"]).get(profiler.HEADER.encode())
+        recorder = profiler.claim(scope["method"], scope["path"], header.decode('latin-1') if header else None)
+        if recorder is None:
+            await self.app(scope, receive, send)
+            return
+
+        send = _StatusSend(send)
+        token = attach(recorder)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            detach(token)
+            # Set in the shared scope by RequestIdMiddleware, further in; the thread's request id belongs to
+            # whichever request the event loop ran last
+            profiler.finish(recorder, send.status, time.perf_counter() - started, scope.get("request_id"))
+
+
+class TracingMiddleware:
+    """
+    Traces the requests the tracer picks, with the request id as the trace id. Added just inside
+    RequestIdMiddleware, so that the trace covers the rest of the middleware stack.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        trace = tracer.begin(scope.get("request_id"), scope["method"], scope["path"]) \
+            if scope["type"] == "http" else None
+        if trace is None:
+            await self.app(scope, receive, send)
+            return
+
+        send = _StatusSend(send)
+        token = attach(trace)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            detach(token)
+            tracer.finish(trace, send.status)
+
+
+class _StatusSend:
+    """Passes messages on to `send`, noting the response status; 500 if the app never starts one."""
+
+    __slots__ = ('send', 'status')
+
+    def __init__(self, send):
+        self.send = send
+        self.status = 500
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.status = message["status"]
+        await self.send(message)
+
+
+class RouteSpanMiddleware:
+    """
+    Added innermost: marks where the middleware stack hands the request to the router, so that
+    observers can tell the time spent in middleware from the time spent in the route.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        with span('app', scope.get("path", "")):
+            await self.app(scope, receive, send)
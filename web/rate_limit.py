@@ -0,0 +1,150 @@
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from fastapi import Depends, Request
+
+from core.exceptions import RateLimitExceededError, ServiceUnavailableError
+from core.models import User
+from data import admissions
+from data.shards import shard_router
+from web.dependencies import require_current_user
+
+# Endpoint cost classes, in tokens per request; override with RATE_LIMIT_COSTS="read=1,search=5,..."
+READ, SEARCH, WRITE, BULK = 'read', 'search', 'write', 'bulk'
+COSTS = {READ: 1.0, SEARCH: 5.0, WRITE: 2.0, BULK: 20.0}
+COSTS.update({name.strip(): float(cost) for name, cost in
+              (item.split('=') for item in os.getenv('RATE_LIMIT_COSTS', '').split(',') if '=' in item)})
+
+ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+# Tokens refilled per second and bucket capacity, per authenticated user and per anonymous client address
+USER_RATE = float(os.getenv('RATE_LIMIT_USER_RATE', '10'))
+USER_BURST = float(os.getenv('RATE_LIMIT_USER_BURST', '40'))
+ANONYMOUS_RATE = float(os.getenv('RATE_LIMIT_ANONYMOUS_RATE', '5'))
+ANONYMOUS_BURST = float(os.getenv('RATE_LIMIT_ANONYMOUS_BURST', '20'))
+# Requests costing at least a search are shed while fewer than this many connections to the caller's
+# shard are free, keeping the remaining connections for cheap reads and writes
+RESERVED_CONNECTIONS = int(os.getenv('RATE_LIMIT_RESERVED_CONNECTIONS', '2'))
+
+
+class BucketStore:
+    def take(self, key: str, cost: float, rate: float, burst: float) -> float:
+        """Take `cost` tokens from the bucket; return 0 if admitted, otherwise the seconds until it would be."""
+        raise NotImplementedError
+
+
+def _refill(tokens: float, updated: float, now: float, rate: float, burst: float) -> float:
+    return min(burst, tokens + (now - updated) * rate)
+
+
+class MemoryBucketStore(BucketStore):
+    """Buckets in a dict, shared by the threads of one worker process."""
+
+    MAX_KEYS = 100_000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> (tokens, updated, seconds an idle bucket takes to refill at its own rate)
+        self.buckets: Dict[str, Tuple[float, float, float]] = {}
+
+    def take(self, key: str, cost: float, rate: float, burst: float) -> float:
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated, _ = self.buckets.get(key, (burst, now, 0.0))
+            tokens = _refill(tokens, updated, now, rate, burst)
+            if tokens < cost:
+                self.buckets[key] = (tokens, now, burst / rate)
+                return (cost - tokens) / rate
+            self.buckets[key] = (tokens - cost, now, burst / rate)
+            if len(self.buckets) > self.MAX_KEYS:
+                self._prune(now)
+            return 0.0
+
+    def _prune(self, now: float) -> None:
+        # A bucket idle long enough to have refilled is the same as a missing one
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if now - bucket[1] < bucket[2]}
+
+
+class SqliteBucketStore(BucketStore):
+    """
+    Buckets in a local SQLite file, so every worker process on the host draws from the same
+    buckets. Each take is one short IMMEDIATE transaction; if the file stays locked past the busy
+    timeout the request is admitted rather than failed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=0.5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+    def take(self, key: str, cost: float, rate: float, burst: float) -> float:
+        now = time.time()  # Wall clock, as monotonic clocks are not comparable across processes
+        conn = self._connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = _refill(*row, now, rate, burst) if row else burst
+                wait = 0.0 if tokens >= cost else (cost - tokens) / rate
+                if not wait:
+                    tokens -= cost
+                conn.execute("INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                             "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                             (key, tokens, now))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            return wait
+        except sqlite3.OperationalError:
+            return 0.0
+
+
+def _make_store() -> BucketStore:
+    if os.getenv('RATE_LIMIT_BACKEND', 'memory') == 'sqlite':
+        return SqliteBucketStore(os.getenv('RATE_LIMIT_SQLITE_PATH',
+                                           os.path.join(tempfile.gettempdir(), 'codepromptu-ratelimit.sqlite3')))
+    return MemoryBucketStore()
+
+
+store = _make_store()
+
+
+def _admit(key: str, cost_class: str, rate: float, burst: float, author_id: Optional[int] = None) -> None:
+    """Charge the bucket; `author_id` is the caller's scope, None for the public prompts."""
+    if not ENABLED:
+        return
+    cost = COSTS[cost_class]
+    if cost >= COSTS[SEARCH] and admissions[shard_router.shard_for(author_id)].available() < RESERVED_CONNECTIONS:
+        raise ServiceUnavailableError("The service is busy, please retry shortly.", retry_after=1)
+    wait = store.take(key, cost, rate, burst)
+    if wait:
+        raise RateLimitExceededError(f"Rate limit exceeded for {cost_class} requests.", retry_after=math.ceil(wait))
+
+
+def limit_user(cost_class: str):
+    """A route dependency charging `cost_class` to the authenticated user's bucket."""
+    def dependency(user: User = Depends(require_current_user)) -> None:
+        _admit(f"user:{user.id}", cost_class, USER_RATE, USER_BURST, user.id)
+    return dependency
+
+
+def limit_anonymous(cost_class: str):
+    """A route dependency charging `cost_class` to the calling address's anonymous bucket."""
+    def dependency(request: Request) -> None:
+        client = request.client.host if request.client else 'unknown'
+        _admit(f"anonymous:{client}", cost_class, ANONYMOUS_RATE, ANONYMOUS_BURST)
+    return dependency
@@ -0,0 +1,68 @@
+import json
+from datetime import datetime
+from typing import Iterable, Union
+
+from fastapi import Response
+
+from core.instrumentation import span
+from core.models import Prompt, PromptFields, PromptChanges
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is in requirements.txt, the stdlib encoder is a fallback
+    orjson = None
+
+_VARIABLE_FIELDS = ('input_variables', 'output_variables')
+
+
+def prompt_dict(prompt: Union[Prompt, PromptFields]) -> dict:
+    """
+    A prompt as a dict orjson can write directly, without a pydantic serialization pass. Only the
+    fields the prompt was built with are included, as with response_model_exclude_unset; Variables
+    are passed as their field dicts.
+    """
+    values = prompt.__dict__
+    fields_set = prompt.model_fields_set
+    if len(fields_set) == len(values):
+        result = values.copy()
+    else:
+        result = {name: value for name, value in values.items() if name in fields_set}
+    for name in _VARIABLE_FIELDS:
+        variables = result.get(name)
+        if variables is not None:
+            result[name] = [variable.__dict__ for variable in variables]
+    return result
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value) -> bytes:
+    with span('serialization', 'dumps'):
+        if orjson is not None:
+            return orjson.dumps(value)
+        return json.dumps(value, default=_default, separators=(',', ':')).encode('utf-8')
+
+
+class PromptListResponse(Response):
+    """
+    Renders a list of prompts straight to JSON bytes. Returning it from an endpoint bypasses the
+    response_model validation and serialization pass, so the models must come from trusted code
+    such as the repository; the route's response_model still documents the schema.
+    """
+    media_type = "application/json"
+
+    def render(self, content: Iterable[Union[Prompt, PromptFields]]) -> bytes:
+        return dumps([prompt_dict(prompt) for prompt in content])
+
+
+class PromptChangesResponse(Response):
+    """Renders a PromptChanges page the same way PromptListResponse renders its prompts."""
+    media_type = "application/json"
+
+    def render(self, content: PromptChanges) -> bytes:
+        return dumps({'prompts': [prompt_dict(prompt) for prompt in content.prompts], 'deleted': content.deleted,
+                      'next_cursor': content.next_cursor, 'has_more': content.has_more})
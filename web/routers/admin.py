@@ -0,0 +1,136 @@
+import tempfile
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from core.models import User, ImportResult, TagRename, TagMerge, TagRetag, TagOperationResult, ReplicaStats, \
+    ProfileRequest, ProfileSession, ProfileSummary, ShardStats
+from data.prompt_repository import PromptRepositoryInterface
+from service.catalog_service import CatalogServiceInterface
+from service.metrics import metrics
+from service.profiling import PROFILE_FORMATS, profiler
+from service.public_replica import public_replica
+from service.sharding import shard_stats
+from service.tag_service import TagServiceInterface
+from web.dependencies import get_catalog_service, get_prompt_repository, get_tag_service, require_admin, \
+    route_deadline
+from web.rate_limit import limit_user, BULK
+
+router = APIRouter()
+
+CATALOG_MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+PROFILE_MEDIA_TYPES = {
+    'collapsed': ('text/plain; charset=utf-8', 'txt'),
+    'pstats': ('application/octet-stream', 'pstats'),
+}
+
+
+@router.get("/catalog/export",
+            dependencies=[Depends(limit_user(BULK)), Depends(route_deadline(None))],
+            summary="Stream the Prompt Catalog (requires admin user)")
+def export_catalog(format: str = Query("ndjson", description="'ndjson' or 'parquet'"),
+                   scope: str = Query("all", description="'all' prompts or only 'public' ones"),
+                   service: CatalogServiceInterface = Depends(get_catalog_service),
+                   user: User = Depends(require_admin)):
+    chunks = service.export_prompts(format, all_scopes=(scope == "all"))
+    return StreamingResponse(chunks, media_type=CATALOG_MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="prompts.{format}"'})
+
+
+@router.post("/catalog/import",
+             dependencies=[Depends(limit_user(BULK)), Depends(route_deadline(None))],
+             response_model=ImportResult, summary="Load a Catalog Export (requires admin user)")
+async def import_catalog(request: Request,
+                         format: str = Query("ndjson", description="'ndjson' or 'parquet'"),
+                         service: CatalogServiceInterface = Depends(get_catalog_service),
+                         user: User = Depends(require_admin)):
+    # Spool the upload (to disk past 16MB) so the import can read it as a file in bounded memory
+    with tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024) as upload:
+        async for chunk in request.stream():
+            upload.write(chunk)
+        upload.seek(0)
+        return await run_in_threadpool(service.import_prompts, upload, format)
+
+
+@router.post("/tags/rename",
+             dependencies=[Depends(limit_user(BULK)), Depends(route_deadline(None))],
+             response_model=TagOperationResult, summary="Rename a Tag Everywhere (requires admin user)")
+def rename_tag(rename: TagRename, service: TagServiceInterface = Depends(get_tag_service),
+               user: User = Depends(require_admin)):
+    return service.rename_tag(rename)
+
+
+@router.post("/tags/merge",
+             dependencies=[Depends(limit_user(BULK)), Depends(route_deadline(None))],
+             response_model=TagOperationResult, summary="Merge One Tag into Another (requires admin user)")
+def merge_tags(merge: TagMerge, service: TagServiceInterface = Depends(get_tag_service),
+               user: User = Depends(require_admin)):
+    return service.merge_tags(merge)
+
+
+@router.post("/tags/retag",
+             dependencies=[Depends(limit_user(BULK)), Depends(route_deadline(None))],
+             response_model=TagOperationResult, summary="Add or Remove Tags on Matching Prompts (requires admin user)")
+def retag_prompts(retag: TagRetag, service: TagServiceInterface = Depends(get_tag_service),
+                  user: User = Depends(require_admin)):
+    return service.retag_prompts(retag)
+
+
+@router.get("/metrics", response_model=Dict[str, int], summary="Read the Process Counters (requires admin user)")
+def get_metrics(user: User = Depends(require_admin)):
+    return metrics.snapshot()
+
+
+@router.get("/public-replica", response_model=ReplicaStats,
+            summary="Describe This Worker's Public Catalog Replica (requires admin user)")
+def get_public_replica(user: User = Depends(require_admin)):
+    return public_replica.stats()
+
+
+@router.get("/shards", response_model=List[ShardStats],
+            summary="Count the Prompts and Authors on Each Database (requires admin user)")
+def get_shards(repo: PromptRepositoryInterface = Depends(get_prompt_repository), user: User = Depends(require_admin)):
+    return shard_stats(repo)
+
+
+@router.post("/profiles", response_model=ProfileSession,
+             status_code=201, summary="Arm Profiling of the Next Matching Requests (requires admin user)")
+def arm_profile(request: ProfileRequest, user: User = Depends(require_admin)):
+    return profiler.arm(request)
+
+
+@router.get("/profiles", response_model=List[ProfileSession],
+            summary="List the Armed Profile Sessions (requires admin user)")
+def list_profile_sessions(user: User = Depends(require_admin)):
+    return profiler.list_sessions()
+
+
+@router.delete("/profiles/{session_id}",
+               status_code=204, summary="Disarm a Profile Session (requires admin user)")
+def disarm_profile(session_id: str, user: User = Depends(require_admin)):
+    profiler.disarm(session_id)
+    return {}  # Return an empty response for 204 status
+
+
+@router.get("/profiles/results", response_model=List[ProfileSummary],
+            summary="List the Recent Profiles, Newest First (requires admin user)")
+def list_profiles(user: User = Depends(require_admin)):
+    return profiler.list_results()
+
+
+@router.get("/profiles/results/{result_id}",
+            summary="Download a Profile: Collapsed Stacks or a pstats File (requires admin user)")
+def download_profile(result_id: str,
+                     format: Optional[str] = Query(None, description="'collapsed' for sampling profiles, "
+                                                                     "'pstats' for deterministic ones"),
+                     user: User = Depends(require_admin)):
+    result = profiler.get_result(result_id, format)
+    media_type, extension = PROFILE_MEDIA_TYPES[format or PROFILE_FORMATS[result.summary.mode]]
+    return Response(result.data, media_type=media_type,
+                    headers={"Content-Disposition": f'attachment; filename="profile-{result_id}.{extension}"'})
@@ -1,40 +1,115 @@
-from typing import List
+from typing import List, Optional
 
-from fastapi import APIRouter, Depends, Query, HTTPException
+from fastapi import APIRouter, Depends, Header, Query, HTTPException
 
 from core.exceptions import RecordNotFoundError
-from core.models import Prompt, User, PromptCreate, PromptUpdate
+from core.models import Prompt, User, PromptCreate, PromptUpdate, PromptFacets, PromptRevisionInfo, \
+    PromptRevision, PromptDiff, SimilarPrompt, PromptFields, PromptQueryOptions, PromptChanges, NameSuggestion
 from service.prompt_service import PromptServiceInterface
-from web.dependencies import require_current_user, get_prompt_service
+from service.tag_service import TagServiceInterface
+from web.dependencies import require_current_user, get_prompt_service, get_query_options, get_list_options, \
+    get_sorted_options, get_tag_service, route_deadline, SEARCH_REQUEST_TIMEOUT
+from web.rate_limit import limit_user, READ, SEARCH, WRITE
+from web.events import event_stream_response
+from web.responses import PromptListResponse, PromptChangesResponse
 
 router = APIRouter()
 
 
-@router.post("/prompt/", status_code=201, summary="Add a New Private Prompt")
-async def add_prompt(prompt: PromptCreate,
-                     service: PromptServiceInterface = Depends(get_prompt_service),
-                     user: User = Depends(require_current_user)):
-    return service.create_prompt(prompt, user)
-
-
-@router.get("/prompt/{guid}", response_model=Prompt, summary="Retrieve a Private Prompt by GUID")
-def get_prompt(guid: str, service: PromptServiceInterface = Depends(get_prompt_service),
-                        user: User = Depends(require_current_user)):
+@router.post("/prompt/", dependencies=[Depends(limit_user(WRITE))],
+             status_code=201, summary="Add a New Private Prompt")
+def add_prompt(prompt: PromptCreate,
+               dedupe: bool = Query(False, description="Return the existing prompt's GUID for duplicate content"),
+               service: PromptServiceInterface = Depends(get_prompt_service),
+               user: User = Depends(require_current_user)):
+    return service.create_prompt(prompt, user, dedupe)
+
+
+@router.get("/prompt/events", dependencies=[Depends(limit_user(READ)), Depends(route_deadline(None))],
+            summary="Stream Private Prompt Changes as Server-Sent Events")
+async def stream_prompt_events(tags: Optional[str] = Query(None, description="Only prompts with one of these "
+                                                                              "comma-separated tags"),
+                               classification: Optional[str] = None,
+                               last_event_id: Optional[int] = Header(None, description="Resume after this event"),
+                               service: PromptServiceInterface = Depends(get_prompt_service),
+                               user: User = Depends(require_current_user)):
+    return event_stream_response(service, user, tags, classification, last_event_id)
+
+
+@router.get("/prompt/changes", dependencies=[Depends(limit_user(READ))],
+            response_model=PromptChanges, summary="Page Through Private Prompts Changed Since a Cursor")
+def get_prompt_changes(since: Optional[int] = Query(None, ge=0, description="next_cursor from the previous page; "
+                                                                            "omit to get the current cursor"),
+                       limit: int = Query(100, ge=1, le=1000, description="Change log entries per page"),
+                       options: PromptQueryOptions = Depends(get_query_options),
+                       service: PromptServiceInterface = Depends(get_prompt_service),
+                       user: User = Depends(require_current_user)):
+    return PromptChangesResponse(service.get_prompt_changes(since, user, limit, options))
+
+
+@router.get("/tags/suggest", dependencies=[Depends(limit_user(SEARCH))],
+            response_model=List[NameSuggestion], summary="Suggest Tag and Classification Names for a Prefix")
+def suggest_tags(prefix: str = Query(..., min_length=1, max_length=100, description="What has been typed so far"),
+                 limit: int = Query(10, ge=1, le=50),
+                 service: TagServiceInterface = Depends(get_tag_service),
+                 user: User = Depends(require_current_user)):
+    return service.suggest_names(prefix, limit, user)
+
+
+@router.get("/prompt/facets",
+            dependencies=[Depends(limit_user(SEARCH)), Depends(route_deadline(SEARCH_REQUEST_TIMEOUT))],
+            response_model=PromptFacets, summary="Count Tags and Classifications of Private Prompts")
+def get_facets(query: Optional[str] = None,
+               tags: Optional[str] = Query(None, title="Tags", description="Comma-separated list of tags to filter by"),
+               service: PromptServiceInterface = Depends(get_prompt_service),
+               user: User = Depends(require_current_user)):
+    return service.get_facets(query, tags, user)
+
+
+@router.get("/prompt/by-hash/{content_hash}", dependencies=[Depends(limit_user(READ))],
+            response_model=Prompt, summary="Retrieve a Private Prompt by Content Hash")
+def get_prompt_by_hash(content_hash: str, service: PromptServiceInterface = Depends(get_prompt_service),
+                       user: User = Depends(require_current_user)):
+    return service.get_prompt_by_hash(content_hash, user)
+
+
+@router.get("/prompt/search",
+            dependencies=[Depends(limit_user(SEARCH)), Depends(route_deadline(SEARCH_REQUEST_TIMEOUT))],
+            response_model=List[PromptFields], response_model_exclude_unset=True,
+            summary="Search Private Prompts")
+def search_prompts(query: str,
+                   mode: str = Query("substring", description="'substring' match, 'semantic' similarity or "
+                                                              "'fuzzy' typo-tolerant words"),
+                   limit: int = Query(10, ge=1, le=100, description="Maximum results in ranked modes"),
+                   options: PromptQueryOptions = Depends(get_sorted_options),
+                   service: PromptServiceInterface = Depends(get_prompt_service),
+                   user: User = Depends(require_current_user)):
+    return PromptListResponse(service.search_prompts(query, user, mode, limit, options))
+
+
+@router.get("/prompt/{guid}", dependencies=[Depends(limit_user(READ))],
+            response_model=PromptFields, response_model_exclude_unset=True,
+            summary="Retrieve a Private Prompt by GUID")
+def get_prompt(guid: str, options: PromptQueryOptions = Depends(get_query_options),
+               service: PromptServiceInterface = Depends(get_prompt_service),
+               user: User = Depends(require_current_user)):
     try:
-        return service.get_prompt(guid, user)
+        return service.get_prompt(guid, user, options)
     except RecordNotFoundError:
         raise HTTPException(status_code=404, detail="Prompt not found")
-@router.delete("/prompt/{guid}", status_code=204, summary="Delete a Private Prompt by GUID")
-async def delete_prompt(guid: str,
-                        service: PromptServiceInterface = Depends(get_prompt_service),
-                        user: User = Depends(require_current_user)):
+@router.delete("/prompt/{guid}", dependencies=[Depends(limit_user(WRITE))],
+               status_code=204, summary="Delete a Private Prompt by GUID")
+def delete_prompt(guid: str,
+                  service: PromptServiceInterface = Depends(get_prompt_service),
+                  user: User = Depends(require_current_user)):
     service.delete_prompt(guid, user)
     return {}  # Return an empty response for 204 status
 
 
-@router.put("/prompt/{guid}", status_code=204, summary="Update a Private Prompt by GUID")
-async def update_prompt(guid: str, prompt: PromptCreate, service: PromptServiceInterface = Depends(get_prompt_service),
-                        user: User = Depends(require_current_user)):
+@router.put("/prompt/{guid}", dependencies=[Depends(limit_user(WRITE))],
+            status_code=204, summary="Update a Private Prompt by GUID")
+def update_prompt(guid: str, prompt: PromptCreate, service: PromptServiceInterface = Depends(get_prompt_service),
+                  user: User = Depends(require_current_user)):
     service.update_prompt(PromptUpdate(content=prompt.content,
                                               input_variables=prompt.input_variables,
                                               output_variables=prompt.output_variables,
@@ -43,33 +118,73 @@ async def update_prompt(guid: str, prompt: PromptCreate, service: PromptServiceI
                                               guid=guid), user)
     return {}
 
-@router.get("/prompt/", response_model=List[Prompt], summary="List all Private Prompts")
-def list_prompts(skip: int = 0, limit: int = 10,
+@router.get("/prompt/", dependencies=[Depends(limit_user(READ))],
+            response_model=List[PromptFields], response_model_exclude_unset=True,
+            summary="List all Private Prompts")
+def list_prompts(options: PromptQueryOptions = Depends(get_list_options),
                  service: PromptServiceInterface = Depends(get_prompt_service),
                  user: User = Depends(require_current_user)):
-    # Using pagination with skip and limit.
+    # Pagination (skip and limit) and the field selection are pushed down into the query.
     # You can enhance this further by allowing filters like tags, authors, etc.
-    return service.list_prompts(user)[skip: skip+limit]
-
-
-@router.get("/prompt/search", response_model=List[Prompt], summary="Search Private Prompts")
-async def search_prompts(query: str, service: PromptServiceInterface = Depends(get_prompt_service),
-                         user: User = Depends(require_current_user)):
-    return service.search_prompts(query,user)
-
+    return PromptListResponse(service.list_prompts(user, options))
+
+
+@router.get("/prompt/tags/",
+            dependencies=[Depends(limit_user(SEARCH)), Depends(route_deadline(SEARCH_REQUEST_TIMEOUT))],
+            response_model=List[PromptFields], response_model_exclude_unset=True,
+            summary="List Private Prompts by Tag")
+def get_prompts_by_tag(tags: str = Query("", title="Tags", description="Comma-separated list of tags to search for"),
+                       options: PromptQueryOptions = Depends(get_sorted_options),
+                       service: PromptServiceInterface = Depends(get_prompt_service),
+                       user: User = Depends(require_current_user)):
+    list = service.get_prompts_by_tags(tags, user, options)
+    return PromptListResponse(list)
+
+
+@router.get("/prompt/classification/{classification}/",
+            dependencies=[Depends(limit_user(SEARCH)), Depends(route_deadline(SEARCH_REQUEST_TIMEOUT))],
+            response_model=List[PromptFields],
+            response_model_exclude_unset=True, summary="List Private Prompts by Classification")
+def get_prompts_by_classification(classification: str,
+                                  options: PromptQueryOptions = Depends(get_sorted_options),
+                                  service: PromptServiceInterface = Depends(get_prompt_service),
+                                  user: User = Depends(require_current_user)):
+    return PromptListResponse(service.get_prompts_by_classification(classification, user, options))
+
+
+@router.get("/prompt/{guid}/revisions", dependencies=[Depends(limit_user(READ))],
+            response_model=List[PromptRevisionInfo],
+            summary="List the Revisions of a Private Prompt")
+def list_revisions(guid: str,
+                   service: PromptServiceInterface = Depends(get_prompt_service),
+                   user: User = Depends(require_current_user)):
+    return service.list_revisions(guid, user)
+
+
+@router.get("/prompt/{guid}/revisions/{revision}", dependencies=[Depends(limit_user(READ))],
+            response_model=PromptRevision,
+            summary="Retrieve a Revision of a Private Prompt")
+def get_revision(guid: str, revision: int,
+                 service: PromptServiceInterface = Depends(get_prompt_service),
+                 user: User = Depends(require_current_user)):
+    return service.get_revision(guid, revision, user)
 
-@router.get("/prompt/tags/", response_model=List[Prompt], summary="List Private Prompts by Tag")
-async def get_prompts_by_tag(tags: str = Query("", title="Tags", description="Comma-separated list of tags to search for"),
-                             service: PromptServiceInterface = Depends(get_prompt_service),
-                             user: User = Depends(require_current_user)):
-    list = service.get_prompts_by_tags(tags, user)
-    return list
 
+@router.get("/prompt/{guid}/diff", dependencies=[Depends(limit_user(READ))],
+            response_model=PromptDiff, summary="Diff two Revisions of a Private Prompt")
+def diff_revisions(guid: str, from_revision: int, to_revision: int,
+                   service: PromptServiceInterface = Depends(get_prompt_service),
+                   user: User = Depends(require_current_user)):
+    return service.diff_revisions(guid, from_revision, to_revision, user)
 
-@router.get("/prompt/classification/{classification}/", response_model=List[Prompt],
-            summary="List Private Prompts by Classification")
-async def get_prompts_by_classification(classification: str,
-                                        service: PromptServiceInterface = Depends(get_prompt_service),
-                                        user: User = Depends(require_current_user)):
-    return service.get_prompts_by_classification(classification,user)
 
+@router.get("/prompt/{guid}/similar",
+            dependencies=[Depends(limit_user(SEARCH)), Depends(route_deadline(SEARCH_REQUEST_TIMEOUT))],
+            response_model=List[SimilarPrompt],
+            summary="Find Near-duplicates of a Private Prompt")
+def get_similar_prompts(guid: str,
+                        threshold: float = Query(0.5, ge=0.0, le=1.0, description="Minimum estimated Jaccard score"),
+                        limit: int = Query(10, ge=1, le=100),
+                        service: PromptServiceInterface = Depends(get_prompt_service),
+                        user: User = Depends(require_current_user)):
+    return service.get_similar_prompts(guid, user, threshold, limit)
@@ -1,29 +1,39 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
 
 from core.exceptions import RecordNotFoundError
-from core.models import Prompt, User, PromptCreate, PromptUpdate
+from core.models import Prompt, User, PromptCreate, PromptUpdate, PromptFacets, PromptRevisionInfo, \
+    PromptRevision, PromptDiff, SimilarPrompt, PromptFields, PromptQueryOptions, PromptChanges, NameSuggestion
 from service.prompt_service import PromptServiceInterface
-from typing import List
+from service.tag_service import TagServiceInterface
+from typing import List, Optional
 
-from web.dependencies import get_prompt_service, require_admin_user
+from web.dependencies import get_prompt_service, require_admin_user, get_query_options, get_list_options, \
+    get_sorted_options, get_tag_service, route_deadline, SEARCH_REQUEST_TIMEOUT
+from web.rate_limit import limit_anonymous, READ, SEARCH, WRITE
+from web.events import event_stream_response
+from web.responses import PromptListResponse, PromptChangesResponse
 
 router = APIRouter()
 
 
-@router.post("/prompt/", status_code=201, summary="Add a New Prompt (requires admin user)")
-async def add_prompt(prompt: PromptCreate,
-                     service: PromptServiceInterface = Depends(get_prompt_service),
-                     user: User = Depends(require_admin_user)):
-    return service.create_prompt(prompt)
+@router.post("/prompt/", dependencies=[Depends(limit_anonymous(WRITE))],
+             status_code=201, summary="Add a New Prompt (requires admin user)")
+def add_prompt(prompt: PromptCreate,
+               dedupe: bool = Query(False, description="Return the existing prompt's GUID for duplicate content"),
+               service: PromptServiceInterface = Depends(get_prompt_service),
+               user: User = Depends(require_admin_user)):
+    return service.create_prompt(prompt, dedupe=dedupe)
 
-@router.delete("/prompt/{guid}", status_code=204, summary="Delete a Public Prompt by GUID (requires admin user)")
+@router.delete("/prompt/{guid}", dependencies=[Depends(limit_anonymous(WRITE))],
+               status_code=204, summary="Delete a Public Prompt by GUID (requires admin user)")
 def delete_prompt(guid: str,
                         service: PromptServiceInterface = Depends(get_prompt_service),
                         user: User = Depends(require_admin_user)):
     service.delete_prompt(guid)
     return {}  # Return an empty response for 204 status
 
-@router.put("/prompt/{guid}", status_code=204, summary="Update a Public Prompt by GUID (requires admin user) ")
+@router.put("/prompt/{guid}", dependencies=[Depends(limit_anonymous(WRITE))],
+            status_code=204, summary="Update a Public Prompt by GUID (requires admin user) ")
 def update_prompt(guid: str, prompt: PromptCreate, service: PromptServiceInterface = Depends(get_prompt_service),
                         user: User = Depends(require_admin_user)):
     # Fill in the PromptUpdate constructor below with named params
@@ -35,37 +45,132 @@ def update_prompt(guid: str, prompt: PromptCreate, service: PromptServiceInterfa
                                               guid=guid))
     return {}  # Return an empty response for 204 status
 
-@router.get("/prompt/{guid}", response_model=Prompt, summary="Retrieve a Public Prompt by GUID")
-def get_prompt(guid: str, service: PromptServiceInterface = Depends(get_prompt_service)):
+@router.get("/prompt/events", dependencies=[Depends(limit_anonymous(READ)), Depends(route_deadline(None))],
+            summary="Stream Public Prompt Changes as Server-Sent Events")
+async def stream_prompt_events(tags: Optional[str] = Query(None, description="Only prompts with one of these "
+                                                                              "comma-separated tags"),
+                               classification: Optional[str] = None,
+                               last_event_id: Optional[int] = Header(None, description="Resume after this event"),
+                               service: PromptServiceInterface = Depends(get_prompt_service)):
+    return event_stream_response(service, None, tags, classification, last_event_id)
+
+
+@router.get("/prompt/changes", dependencies=[Depends(limit_anonymous(READ))],
+            response_model=PromptChanges, summary="Page Through Public Prompts Changed Since a Cursor")
+def get_prompt_changes(since: Optional[int] = Query(None, ge=0, description="next_cursor from the previous page; "
+                                                                            "omit to get the current cursor"),
+                       limit: int = Query(100, ge=1, le=1000, description="Change log entries per page"),
+                       options: PromptQueryOptions = Depends(get_query_options),
+                       service: PromptServiceInterface = Depends(get_prompt_service)):
+    return PromptChangesResponse(service.get_prompt_changes(since, limit=limit, options=options))
+
+
+@router.get("/tags/suggest", dependencies=[Depends(limit_anonymous(SEARCH))],
+            response_model=List[NameSuggestion], summary="Suggest Tag and Classification Names for a Prefix")
+def suggest_tags(prefix: str = Query(..., min_length=1, max_length=100, description="What has been typed so far"),
+                 limit: int = Query(10, ge=1, le=50),
+                 service: TagServiceInterface = Depends(get_tag_service)):
+    return service.suggest_names(prefix, limit)
+
+
+@router.get("/prompt/facets",
+            dependencies=[Depends(limit_anonymous(SEARCH)), Depends(route_deadline(SEARCH_REQUEST_TIMEOUT))],
+            response_model=PromptFacets, summary="Count Tags and Classifications of Public Prompts")
+def get_facets(query: Optional[str] = None,
+               tags: Optional[str] = Query(None, title="Tags", description="Comma-separated list of tags to filter by"),
+               service: PromptServiceInterface = Depends(get_prompt_service)):
+    return service.get_facets(query, tags)
+
+
+@router.get("/prompt/by-hash/{content_hash}", dependencies=[Depends(limit_anonymous(READ))],
+            response_model=Prompt, summary="Retrieve a Public Prompt by Content Hash")
+def get_prompt_by_hash(content_hash: str, service: PromptServiceInterface = Depends(get_prompt_service)):
+    return service.get_prompt_by_hash(content_hash)
+
+
+@router.get("/prompt/{guid}", dependencies=[Depends(limit_anonymous(READ))],
+            response_model=PromptFields, response_model_exclude_unset=True,
+            summary="Retrieve a Public Prompt by GUID")
+def get_prompt(guid: str, options: PromptQueryOptions = Depends(get_query_options),
+               service: PromptServiceInterface = Depends(get_prompt_service)):
     try:
-        return service.get_prompt(guid)
+        return service.get_prompt(guid, options=options)
     except RecordNotFoundError:
         raise HTTPException(status_code=404, detail="Prompt not found")
 
 
-@router.get("/prompt/", response_model=List[Prompt], summary="List all Public Prompts")
-def list_prompts(skip: int = 0, limit: int = 10, service: PromptServiceInterface = Depends(get_prompt_service)):
-    # Using pagination with skip and limit.
+@router.get("/prompt/", dependencies=[Depends(limit_anonymous(READ))],
+            response_model=List[PromptFields], response_model_exclude_unset=True,
+            summary="List all Public Prompts")
+def list_prompts(options: PromptQueryOptions = Depends(get_list_options),
+                 service: PromptServiceInterface = Depends(get_prompt_service)):
+    # Pagination (skip and limit) and the field selection are pushed down into the query.
     # You can enhance this further by allowing filters like tags, authors, etc.
-    return service.list_prompts()[skip: skip+limit]
-
-
-@router.get("/prompt/search/", response_model=List[Prompt], summary="Search Public Prompts")
-def search_prompts(query: str, service: PromptServiceInterface = Depends(get_prompt_service)):
+    return PromptListResponse(service.list_prompts(options=options))
+
+
+@router.get("/prompt/search/",
+            dependencies=[Depends(limit_anonymous(SEARCH)), Depends(route_deadline(SEARCH_REQUEST_TIMEOUT))],
+            response_model=List[PromptFields], response_model_exclude_unset=True,
+            summary="Search Public Prompts")
+def search_prompts(query: str,
+                   mode: str = Query("substring", description="'substring' match, 'semantic' similarity or "
+                                                              "'fuzzy' typo-tolerant words"),
+                   limit: int = Query(10, ge=1, le=100, description="Maximum results in ranked modes"),
+                   options: PromptQueryOptions = Depends(get_sorted_options),
+                   service: PromptServiceInterface = Depends(get_prompt_service)):
     # Assuming the service has a method to search prompts. This can be implemented in various ways.
-    return service.search_prompts(query)
+    return PromptListResponse(service.search_prompts(query, mode=mode, limit=limit, options=options))
 
 
 @router.get("/prompt/tags/",
-            response_model=List[Prompt], summary="List Public Prompts by Tag")
+            dependencies=[Depends(limit_anonymous(SEARCH)), Depends(route_deadline(SEARCH_REQUEST_TIMEOUT))],
+            response_model=List[PromptFields], response_model_exclude_unset=True,
+            summary="List Public Prompts by Tag")
 def get_prompts_by_tag(
     tags: str = Query("", title="Tags", description="Comma-separated list of tags to search for"),
+    options: PromptQueryOptions = Depends(get_sorted_options),
     service: PromptServiceInterface = Depends(get_prompt_service)):
-    return service.get_prompts_by_tags(tags)
+    return PromptListResponse(service.get_prompts_by_tags(tags, options=options))
 
 
-@router.get("/prompt/classification/{classification}", response_model=List[Prompt],
-            summary="List Public Prompts by Classification")
-def get_prompts_by_classification(classification: str, service: PromptServiceInterface = Depends(get_prompt_service)):
+@router.get("/prompt/classification/{classification}",
+            dependencies=[Depends(limit_anonymous(SEARCH)), Depends(route_deadline(SEARCH_REQUEST_TIMEOUT))],
+            response_model=List[PromptFields],
+            response_model_exclude_unset=True, summary="List Public Prompts by Classification")
+def get_prompts_by_classification(classification: str, options: PromptQueryOptions = Depends(get_sorted_options),
+                                  service: PromptServiceInterface = Depends(get_prompt_service)):
     # Assuming the service has a method to get prompts by classification.
-    return service.get_prompts_by_classification(classification)
+    return PromptListResponse(service.get_prompts_by_classification(classification, options=options))
+
+
+@router.get("/prompt/{guid}/revisions", dependencies=[Depends(limit_anonymous(READ))],
+            response_model=List[PromptRevisionInfo],
+            summary="List the Revisions of a Public Prompt")
+def list_revisions(guid: str, service: PromptServiceInterface = Depends(get_prompt_service)):
+    return service.list_revisions(guid)
+
+
+@router.get("/prompt/{guid}/revisions/{revision}", dependencies=[Depends(limit_anonymous(READ))],
+            response_model=PromptRevision,
+            summary="Retrieve a Revision of a Public Prompt")
+def get_revision(guid: str, revision: int, service: PromptServiceInterface = Depends(get_prompt_service)):
+    return service.get_revision(guid, revision)
+
+
+@router.get("/prompt/{guid}/diff", dependencies=[Depends(limit_anonymous(READ))],
+            response_model=PromptDiff, summary="Diff two Revisions of a Public Prompt")
+def diff_revisions(guid: str, from_revision: int, to_revision: int,
+                   service: PromptServiceInterface = Depends(get_prompt_service)):
+    return service.diff_revisions(guid, from_revision, to_revision)
+
+
+@router.get("/prompt/{guid}/similar",
+            dependencies=[Depends(limit_anonymous(SEARCH)), Depends(route_deadline(SEARCH_REQUEST_TIMEOUT))],
+            response_model=List[SimilarPrompt],
+            summary="Find Near-duplicates of a Public Prompt")
+def get_similar_prompts(guid: str,
+                        threshold: float = Query(0.5, ge=0.0, le=1.0, description="Minimum estimated Jaccard score"),
+                        limit: int = Query(10, ge=1, le=100),
+                        service: PromptServiceInterface = Depends(get_prompt_service)):
+    return service.get_similar_prompts(guid, threshold=threshold, limit=limit)